@@ -1,6 +1,5 @@
 import os
 import psutil
-import torch
 from pathlib import Path
 
 # ตำแหน่งไฟล์ต่างๆ
@@ -22,29 +21,72 @@ MAX_RAM_USAGE = min(TOTAL_RAM * 0.7, 11)  # ใช้ไม่เกิน 70% 
 MAX_CPU_USAGE = max(1, int(CPU_COUNT * 0.8))  # ใช้ไม่เกิน 80% ของ CPU cores
 
 # การตั้งค่า PyTorch
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 MIXED_PRECISION = True  # ใช้ mixed precision training ถ้าเป็นไปได้
 TORCH_COMPILE = True  # ใช้ torch.compile() ถ้าเป็นไปได้
 CUDA_MEMORY_FRACTION = 0.8  # ใช้ GPU memory ไม่เกิน 80%
 
-if DEVICE == "cpu":
-    # ถ้าไม่มี GPU ให้ใช้ Intel MKL ถ้ามี
-    torch.set_num_threads(MAX_CPU_USAGE)
-elif DEVICE == "cuda":
-    # ตั้งค่า CUDA
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.allow_tf32 = True
-    if CUDA_MEMORY_FRACTION < 1.0:
-        torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION)
+def _configure_torch() -> str:
+    """import torch ตั้งค่าตาม device แล้วคืนค่า device ("cuda" หรือ "cpu")
+    เรียกครั้งแรกที่มีการใช้ DEVICE เพื่อไม่ให้การ import settings ต้องโหลด torch (ช่วยให้ UI เปิดเร็วขึ้น)"""
+    import torch
+    
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu":
+        # ถ้าไม่มี GPU ให้ใช้ Intel MKL ถ้ามี (ค่าเริ่มต้น ระหว่างทำงาน ThreadBudget ปรับตามงานที่ทำพร้อมกัน)
+        torch.set_num_threads(MAX_CPU_USAGE)
+    elif device == "cuda":
+        # ตั้งค่า CUDA
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        if CUDA_MEMORY_FRACTION < 1.0:
+            torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION)
+    return device
+
+def __getattr__(name):
+    # DEVICE ถูกคำนวณเมื่อใช้งานครั้งแรก (เช่น from app.config.settings import DEVICE ใน ai_engine)
+    if name == "DEVICE":
+        globals()["DEVICE"] = _configure_torch()
+        return globals()["DEVICE"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # การตั้งค่าโมเดล AI
 MUSICGEN_MODEL_SIZE = "small"  # small, medium, large
 MUSICGEN_MODEL_NAME = f"facebook/musicgen-{MUSICGEN_MODEL_SIZE}"
 
+# ระดับคุณภาพของคำขอ -> ขนาดโมเดล (โหลดค้างไว้ได้หลายขนาดพร้อมกัน ตราบที่ RAM ไม่เกิน MAX_RAM_USAGE)
+QUALITY_TIERS = {
+    "preview": "small",
+    "standard": MUSICGEN_MODEL_SIZE,
+    "final": "medium",
+}
+DEFAULT_QUALITY = "standard"
+# ระดับคุณภาพที่ผู้ใช้เลือกได้ในหน้าสร้างเพลง (ปุ่มตัวอย่างใช้ "preview" เสมอ)
+QUALITY_LABELS = {
+    "standard": "มาตรฐาน",
+    "final": "สูงสุด (ช้ากว่า)",
+}
+# RAM โดยประมาณของโมเดลแต่ละขนาด (GB) ใช้ตัดสินใจปลดโมเดลอื่นก่อนโหลด (หลังโหลดใช้ขนาดที่วัดได้จริง)
+MODEL_MEMORY_ESTIMATE_GB = {"small": 2.5, "medium": 7.5, "large": 15.0}
+
 # การตั้งค่า Model Optimization
-MODEL_QUANTIZATION = None  # None, "8bit", "4bit" - ใช้ quantization เมื่อมี GPU เท่านั้น
+MODEL_QUANTIZATION = None  # None, "8bit", "4bit" (BitsAndBytes ต้องมี GPU), "dynamic_int8" (สำหรับ CPU)
 MODEL_PRUNING = 0.3  # ตัดพารามิเตอร์ที่มีค่าน้อยออก 30%
+MODEL_ARTIFACT_CACHE = True  # เก็บโมเดลที่ผ่าน optimization แล้วไว้ใน MODELS_DIR เพื่อให้เปิดโปรแกรมครั้งถัดไปเร็วขึ้น
+
+# Backend สำหรับรัน decoder และ EnCodec: "torch" หรือ "onnx" (ONNX Runtime บน CPU)
+INFERENCE_BACKEND = "torch"
+ONNX_OPSET = 17
+ONNX_INTRA_OP_THREADS = PHYSICAL_CORES or MAX_CPU_USAGE  # thread ภายใน operator (ใช้ core จริงได้ผลดีที่สุด)
+ONNX_INTER_OP_THREADS = 1  # graph ของ decoder รันทีละ node อยู่แล้ว
+
+# จอง KV cache ของ decoder ไว้ล่วงหน้าตามจำนวน token ที่จะสร้าง แล้วเขียนลงตำแหน่งเดิม (PyTorch backend)
+# แทนการต่อ tensor ใหม่ทุก token ซึ่งช้าลงเรื่อย ๆ ตามความยาวเพลง
+STATIC_KV_CACHE = True
+
+# ใช้ลูปสร้าง token ที่เขียนเฉพาะสำหรับ MusicGen (รวม CFG, temperature, top-k/top-p และ repetition penalty
+# เป็น tensor op ไม่กี่ตัวต่อ token) แทน model.generate ของ transformers
+FUSED_SAMPLER = True
 
 # การตั้งค่า Generation
 GENERATION_CONFIG = {
@@ -58,6 +100,49 @@ GENERATION_CONFIG = {
     "use_cache": True
 }
 
+# การตั้งค่าการสร้างเพลงยาวแบบแบ่งช่วง (segmented generation)
+# เพลงที่ยาวกว่า SEGMENT_DURATION จะถูกสร้างทีละช่วง โดยใช้เสียงท้ายช่วงก่อนหน้าเป็น audio prompt
+# ทำให้ขนาด KV cache และหน่วยความจำคงที่ไม่ว่าเพลงจะยาวแค่ไหน
+SEGMENTED_GENERATION = True
+SEGMENT_DURATION = 30  # ความยาวแต่ละช่วง (วินาที)
+SEGMENT_CONTEXT = 10  # ความยาวเสียงท้ายช่วงก่อนหน้าที่ใช้เป็น audio prompt (วินาที)
+SEGMENT_CROSSFADE = 1.0  # ความยาว crossfade ตรงรอยต่อระหว่างช่วง (วินาที)
+
+# การตั้งค่า dynamic batching ของคิวการสร้างเพลง
+# คำขอที่เข้ามาใกล้กันและมี config/ความยาวใกล้เคียงกันจะถูกรวมเป็น model.generate ครั้งเดียว
+BATCH_WINDOW_MS = 50  # เวลารอรวบรวมคำขอก่อนเริ่มสร้าง (มิลลิวินาที)
+MAX_BATCH_SIZE = 4  # จำนวนเพลงสูงสุดต่อ batch
+BATCH_DURATION_BUCKET = 10  # รวมเฉพาะคำขอที่ความยาวอยู่ในช่วงเดียวกัน (วินาที) เพื่อลด padding
+GENERATION_QUEUE_MAX_SIZE = 32  # จำนวนคำขอสูงสุดที่รอในคิว (เกินนี้จะปฏิเสธหรือให้ผู้เรียกรอ)
+PREEMPTION_ENABLED = True  # ให้ตัวอย่างเพลงแทรกเพลงยาวที่กำลังสร้างได้ (พักไว้แล้วสร้างต่อ)
+
+# Admission control: ประมาณ RAM สูงสุดของคำขอก่อนเริ่มสร้าง ถ้าไม่พอจะสร้างทีละคำขอ/แบ่งช่วงสั้นลง
+# รอให้หน่วยความจำว่าง หรือปฏิเสธคำขอที่ใช้เกิน MAX_RAM_USAGE (ค่าประมาณถูกปรับจาก RSS ที่วัดได้จริง)
+MEMORY_ADMISSION = True
+ADMISSION_MAX_DEFER = 120  # เวลารอหน่วยความจำว่างสูงสุดก่อนยกเลิกคำขอ (วินาที)
+ADMISSION_POLL_INTERVAL = 0.5  # ความถี่ตรวจสอบหน่วยความจำระหว่างรอ (วินาที)
+ADMISSION_POSTPROCESS_COPIES = 2  # จำนวนสำเนาของเสียงระหว่าง normalize/fade ก่อนบันทึก
+
+# การแบ่ง thread ของ CPU (MAX_CPU_USAGE) ระหว่างงานที่ทำพร้อมกัน ตามน้ำหนักของงานแต่ละประเภท
+THREAD_BUDGET_WEIGHTS = {
+    "generation": 4.0,
+    "post_processing": 1.0,
+    "export": 1.0,
+}
+
+# การเปิดโปรแกรม: เวลาสูงสุดที่ยอมให้ import หน้าต่างหลัก (วินาที) ตรวจสอบด้วย python -m app.core.startup
+STARTUP_IMPORT_BUDGET = 0.5
+
+# Worker pool: โหลดโมเดลไว้หลาย process แต่ละ process ใช้ core ชุดของตัวเอง (0 หรือ 1 = process เดียว)
+WORKER_POOL_SIZE = 0
+WORKER_MAX_PENDING = 2  # จำนวนงานสูงสุดที่ส่งให้ worker หนึ่งตัวได้ (รวมงานที่กำลังทำ)
+
+# การรายงานความคืบหน้าระหว่างสร้างเพลง
+PROGRESS_UPDATE_INTERVAL = 0.5  # ส่งความคืบหน้าไปยัง UI ไม่ถี่กว่านี้ (วินาที)
+
+# Cache ผลลัพธ์ของ text encoder (T5) ตาม prompt ที่ปรับแล้ว
+TEXT_CONDITIONING_CACHE_MB = 64  # หน่วยความจำสูงสุดของ cache (0 = ปิด)
+
 # ตัวเลือกเครื่องดนตรี (แยกตามประเภท)
 INSTRUMENT_CATEGORIES = {
     "เปียโนและคีย์บอร์ด": ["Piano", "Electric Piano", "Organ", "Synth"],
@@ -95,5 +180,29 @@ SAMPLE_RATE = 44100  # Hz
 AUDIO_FORMAT = "wav"  # wav หรือ mp3
 
 # การตั้งค่าการแคช
-CACHE_SIZE = 10  # จำนวนเพลงล่าสุดที่เก็บในแคช
+CACHE_MAX_SIZE_MB = 4096  # ขนาดรวมสูงสุดของไฟล์ cache เกินนี้จะลบรายการที่คุ้มค่าน้อยที่สุดออก
+# น้ำหนักของขนาดไฟล์ในการเลือกรายการที่จะลบ (GreedyDual-Size: เวลาสร้าง / ขนาด^น้ำหนัก)
+# 1.0 = เก็บตามเวลาสร้างต่อ byte, ค่าน้อยลงให้เพลงยาวที่ใช้เวลาสร้างนานอยู่ได้นานกว่าเพลงสั้นหลายเพลง
+CACHE_EVICTION_SIZE_WEIGHT = 0.5
+# ลบรายการที่สร้างมานานเกินกี่วันตอนเปิดโปรแกรม ไม่สนเวลาสร้างหรือการใช้งาน (0 = ปิด ลบตามขนาดอย่างเดียว)
+CACHE_MAX_AGE_DAYS = 0
+# รูปแบบการเก็บเสียงใน cache บนดิสก์: "raw" (float32 เปิดแบบ mmap), "pcm16" (int16 + scale เล็กลง 2 เท่า)
+# หรือ "flac" (FLAC 16 bit เล็กลงประมาณ 3-5 เท่า) เข้ารหัสใน thread แยกหลังบันทึก
+CACHE_CODEC = "flac"
+CACHE_MEMORY_SIZE_MB = 256  # cache ผลลัพธ์ล่าสุดในหน่วยความจำก่อนอ่านจากดิสก์ (0 = ปิด)
+# ผลลัพธ์ที่ใหญ่กว่านี้ไม่ถูกคัดลอกเข้าหน่วยความจำ (รายการ raw บนดิสก์ใช้ mmap ต่อ) ประมาณ 4 นาทีที่ 32 kHz
+CACHE_MEMORY_MAX_ENTRY_MB = 32
+# เก็บ token ของ EnCodec (4 codebook ที่ 50 Hz) แทนข้อมูลเสียง แล้วถอดรหัสใหม่เมื่อถูกใช้
+# (เล็กกว่าเสียง float32 หลายร้อยเท่า แลกกับเวลาถอดรหัสของ EnCodec ตอน hit)
+CACHE_STORE_CODES = True
+# ใช้ผลลัพธ์ใน cache ที่ต่างจากคำขอแค่ความยาว: คำขอที่สั้นกว่าได้ส่วนต้นของเพลงที่ยาวกว่า (fade out ตรงรอยตัด)
+# ส่วนคำขอที่ยาวกว่าสร้างต่อจาก token ของเพลงที่สั้นกว่าเฉพาะส่วนที่ขาด
+CACHE_PREFIX_REUSE = True
+CACHE_PREFIX_FADE = 0.1  # ความยาว fade out ตรงรอยตัดของเพลงที่ตัดจากเพลงที่ยาวกว่า (วินาที)
+CACHE_WAVEFORM_HOT_HITS = 2  # รายการที่ถูกใช้ครบกี่ครั้ง (นับต่อ process) จึงเก็บข้อมูลเสียงไว้ด้วย ไม่ต้องถอดรหัสซ้ำ (0 = ไม่เก็บ)
 MAX_STORAGE_PERCENT = 90  # ลบไฟล์เก่าเมื่อพื้นที่เหลือน้อยกว่า 10%
+CACHE_INDEX_FLUSH_INTERVAL = 5.0  # เขียนเวลาเข้าถึง cache ที่ค้างไว้ลง index อย่างน้อยทุกกี่วินาที
+CACHE_INDEX_FLUSH_COUNT = 64  # หรือเมื่อค้างครบจำนวนนี้
+# lock ของแต่ละรายการใน cache (ใช้ร่วมกันได้หลาย process ที่ชี้ไปที่ cache เดียวกัน)
+CACHE_LOCK_TIMEOUT = 30.0  # รอ lock ได้นานสุด (วินาที)
+CACHE_LOCK_STALE = 300.0  # ไฟล์ lock ที่เก่ากว่านี้ถือว่าค้างจาก process ที่ปิดไปแล้ว
@@ -0,0 +1,335 @@
+import os
+import json
+import math
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Thread, Event, Lock
+from typing import Dict, Any, List, Optional, Callable
+
+import psutil
+
+from app.config.settings import (
+    MODELS_DIR, MAX_RAM_USAGE, SEGMENTED_GENERATION, SEGMENT_DURATION, SEGMENT_CONTEXT,
+    ADMISSION_POSTPROCESS_COPIES, ADMISSION_POLL_INTERVAL
+)
+from app.core.utilities import logger
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# จำนวน channel โดยประมาณของ activation ใน decoder ของ EnCodec ที่ความละเอียดเท่ากับเสียงที่ได้
+# (ชั้นบนสุดของ decoder) ใช้ประมาณหน่วยความจำตอนถอดรหัส token เป็นเสียง ค่าจริงปรับด้วย calibration
+_DECODE_ACTIVATION_CHANNELS = 64
+# ปรับ calibration เฉพาะการสร้างที่ใช้หน่วยความจำมากพอจะวัดได้ (การสร้างสั้นๆ ถูกกลบด้วย noise ของ allocator)
+_MIN_CALIBRATION_BYTES = 32 * MB
+_CALIBRATION_ALPHA = 0.3
+_SCALE_RANGE = (0.5, 8.0)
+
+class MemoryEstimate:
+    """RAM สูงสุดโดยประมาณของคำขอหนึ่งชุด (byte) แยกตามส่วนประกอบ"""
+    
+    def __init__(self,
+                 weights: int = 0,
+                 kv_cache: int = 0,
+                 decode: int = 0,
+                 waveform: int = 0,
+                 post_processing: int = 0,
+                 scale: float = 1.0):
+        self.weights = weights
+        self.kv_cache = kv_cache
+        self.decode = decode
+        self.waveform = waveform
+        self.post_processing = post_processing
+        self.scale = scale  # ตัวคูณจาก calibration ใช้กับส่วนที่เกิดระหว่างสร้าง
+    
+    @property
+    def raw_generation(self) -> int:
+        """หน่วยความจำระหว่างสร้างตามสูตร (ก่อนคูณ calibration)"""
+        return self.kv_cache + self.decode + self.waveform
+    
+    @property
+    def generation(self) -> int:
+        return int(self.raw_generation * self.scale)
+    
+    @property
+    def transient(self) -> int:
+        """หน่วยความจำที่ต้องเพิ่มจากที่ใช้อยู่ (โมเดลโหลดอยู่แล้ว)"""
+        return self.generation + self.post_processing
+    
+    @property
+    def total(self) -> int:
+        return self.weights + self.transient
+    
+    def to_dict(self) -> Dict[str, float]:
+        """ขนาดแต่ละส่วน (MB)"""
+        return {
+            "weights_mb": self.weights / MB,
+            "kv_cache_mb": self.kv_cache / MB,
+            "decode_mb": self.decode / MB,
+            "waveform_mb": self.waveform / MB,
+            "post_processing_mb": self.post_processing / MB,
+            "scale": self.scale,
+            "total_mb": self.total / MB
+        }
+
+class AdmissionDecision:
+    """ผลการตัดสินใจของ MemoryAdmission"""
+    ADMIT = "admit"  # เริ่มได้ทันที
+    DEFER = "defer"  # ยังไม่พอ รอให้หน่วยความจำว่างก่อน
+    REJECT = "reject"  # ไม่มีทางพอแม้จะปลดทุกอย่างแล้ว
+    
+    def __init__(self,
+                 action: str,
+                 estimate: MemoryEstimate,
+                 segment_duration: Optional[int] = None,
+                 unbatched: bool = False,
+                 reason: str = ""):
+        self.action = action
+        self.estimate = estimate
+        self.segment_duration = segment_duration  # None = ใช้ค่าปกติ
+        self.unbatched = unbatched  # สร้างทีละคำขอแทนการรวม batch
+        self.reason = reason
+    
+    @property
+    def low_memory(self) -> bool:
+        return self.segment_duration is not None or self.unbatched
+
+class MemoryAdmission:
+    """ตรวจสอบหน่วยความจำก่อนเริ่มสร้างเพลง (admission control)
+    
+    ประมาณ RAM สูงสุดของคำขอจากขนาดโมเดล: น้ำหนักโมเดล, KV cache ตามจำนวน token,
+    activation ตอนถอดรหัสเสียง, เสียงที่ได้ และสำเนาระหว่าง post-processing (normalize/fade)
+    แล้วเทียบกับหน่วยความจำที่เหลือ (MAX_RAM_USAGE - RSS ของ process และ RAM ว่างของเครื่อง)
+    
+    ถ้าไม่พอจะลองโหมดที่ใช้หน่วยความจำน้อยลงก่อน (สร้างทีละคำขอแทน batch, แบ่งช่วงสั้นลง)
+    ถ้ายังไม่พอแต่จะพอเมื่อหน่วยความจำว่าง ให้รอ (DEFER) ถ้าไม่มีทางพอให้ปฏิเสธ (REJECT)
+    
+    ส่วนที่เกิดระหว่างสร้างถูกปรับด้วยตัวคูณที่เรียนจาก RSS สูงสุดที่วัดได้จริง (measure)
+    แยกตามโมเดล และบันทึกไว้ใน MODELS_DIR
+    """
+    
+    def __init__(self,
+                 max_gb: float = MAX_RAM_USAGE,
+                 calibration_file: Path = MODELS_DIR / "memory_calibration.json"):
+        self.max_bytes = int(max_gb * GB)
+        self.calibration_file = calibration_file
+        self._calibration: Dict[str, Dict[str, float]] = {}
+        self._lock = Lock()
+        self.admitted = 0
+        self.lowered = 0
+        self.deferred = 0
+        self.rejected = 0
+        self._load_calibration()
+    
+    def _load_calibration(self):
+        if self.calibration_file.exists():
+            try:
+                with open(self.calibration_file, 'r', encoding='utf-8') as f:
+                    self._calibration = json.load(f)
+            except Exception as e:
+                logger.warning(f"ไม่สามารถโหลด calibration ของหน่วยความจำได้: {e}")
+                self._calibration = {}
+    
+    def _save_calibration(self):
+        # worker หลาย process บันทึกไฟล์เดียวกัน: เขียนไฟล์ชั่วคราวแล้วแทนที่ ไม่ให้อ่านเจอไฟล์ที่เขียนไม่ครบ
+        tmp_file = self.calibration_file.with_name(f"{self.calibration_file.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self._calibration, f, indent=2)
+            os.replace(tmp_file, self.calibration_file)
+        except Exception as e:
+            logger.warning(f"ไม่สามารถบันทึก calibration ของหน่วยความจำได้: {e}")
+    
+    def scale_for(self, model_name: str) -> float:
+        with self._lock:
+            return self._calibration.get(model_name, {}).get("scale", 1.0)
+    
+    @staticmethod
+    def rss_bytes() -> int:
+        return psutil.Process().memory_info().rss
+    
+    def headroom(self) -> int:
+        """หน่วยความจำที่ใช้เพิ่มได้ (byte) ไม่เกิน MAX_RAM_USAGE และไม่เกิน RAM ว่างของเครื่อง"""
+        return min(self.max_bytes - self.rss_bytes(), psutil.virtual_memory().available)
+    
+    def estimate(self,
+                 model,
+                 model_name: str,
+                 durations: List[float],
+                 tokens_per_sec: int,
+                 guidance_scale: float,
+                 segment_duration: Optional[int] = None,
+                 weights: int = 0) -> MemoryEstimate:
+        """ประมาณหน่วยความจำของการสร้างเพลงความยาว durations (วินาที) ใน batch เดียว
+        segment_duration = ความยาวแต่ละช่วงถ้าสร้างแบบแบ่งช่วง (None = สร้างครั้งเดียวทั้งเพลง)"""
+        decoder_config = model.config.decoder
+        num_codebooks = model.decoder.num_codebooks
+        model_rate = model.config.audio_encoder.sampling_rate
+        element_size = next(model.decoder.parameters()).element_size()
+        batch_size = len(durations)
+        longest = max(durations)
+        
+        # จำนวน token ของการ generate หนึ่งครั้ง (ช่วงถัดไปรวม audio prompt ความยาว SEGMENT_CONTEXT)
+        seconds_per_call = min(longest, segment_duration) if segment_duration else longest
+        tokens = int(math.ceil(seconds_per_call * tokens_per_sec)) + num_codebooks
+        rows = batch_size * (2 if guidance_scale > 1 else 1)
+        
+        kv_cache = 2 * decoder_config.num_hidden_layers * rows * tokens * decoder_config.hidden_size * element_size
+        decode = int(batch_size * seconds_per_call * model_rate) * 4 * _DECODE_ACTIVATION_CHANNELS
+        # เสียงทั้ง batch ยาวเท่าคำขอที่ยาวที่สุด (float32) ส่วน post-processing ทำทีละเพลง
+        waveform = int(batch_size * longest * model_rate) * 4
+        post_processing = int(longest * model_rate) * 4 * ADMISSION_POSTPROCESS_COPIES
+        
+        return MemoryEstimate(
+            weights=weights,
+            kv_cache=kv_cache,
+            decode=decode,
+            waveform=waveform,
+            post_processing=post_processing,
+            scale=self.scale_for(model_name)
+        )
+    
+    @staticmethod
+    def _modes(durations: List[float]) -> List[tuple]:
+        """โหมดการสร้างที่ลองตามลำดับ (ความยาวใน batch, ความยาวช่วง, สร้างทีละคำขอ)
+        ปกติ, สร้างทีละคำขอแทน batch, แบ่งช่วงสั้นลง (ช่วงต้องยาวกว่า audio prompt)"""
+        longest = max(durations)
+        segment = SEGMENT_DURATION if SEGMENTED_GENERATION and longest > SEGMENT_DURATION else None
+        modes = [(durations, segment, False)]
+        if len(durations) > 1:
+            modes.append(([longest], segment, True))
+        effective = segment or longest
+        for shorter in (SEGMENT_CONTEXT * 2, SEGMENT_CONTEXT + 5):
+            if shorter < effective and longest > shorter:
+                modes.append(([longest], shorter, len(durations) > 1))
+        return modes
+    
+    def _rejection(self, estimate: MemoryEstimate) -> AdmissionDecision:
+        with self._lock:
+            self.rejected += 1
+        return AdmissionDecision(
+            AdmissionDecision.REJECT, estimate,
+            reason=(
+                f"เพลงนี้ต้องใช้หน่วยความจำประมาณ {estimate.total / GB:.1f} GB "
+                f"เกิน MAX_RAM_USAGE ({self.max_bytes / GB:.1f} GB) กรุณาลดความยาวหรือระดับคุณภาพลง"
+            )
+        )
+    
+    def check_feasible(self,
+                       model,
+                       model_name: str,
+                       duration: float,
+                       tokens_per_sec: int,
+                       guidance_scale: float,
+                       weights: int = 0) -> Optional[AdmissionDecision]:
+        """ตรวจสอบตอนรับคำขอเข้าคิว: คืนค่า REJECT ถ้าโหมดที่ใช้หน่วยความจำน้อยที่สุดยังเกิน MAX_RAM_USAGE
+        (คำขอนี้ไม่มีทางสร้างได้) มิฉะนั้นคืนค่า None"""
+        durations, segment_duration, _ = self._modes([duration])[-1]
+        lowest = self.estimate(
+            model, model_name, durations, tokens_per_sec, guidance_scale, segment_duration, weights
+        )
+        if lowest.total > self.max_bytes:
+            return self._rejection(lowest)
+        return None
+    
+    def decide(self,
+               model,
+               model_name: str,
+               durations: List[float],
+               tokens_per_sec: int,
+               guidance_scale: float,
+               weights: int = 0) -> AdmissionDecision:
+        """ตัดสินใจว่าจะเริ่มคำขอชุดนี้ได้หรือไม่ (ดู AdmissionDecision)
+        weights = ขนาดของโมเดลที่ใช้ (โหลดอยู่แล้ว จึงไม่นับกับหน่วยความจำที่เหลือ)"""
+        modes = self._modes(durations)
+        default_segment = modes[0][1]
+        headroom = self.headroom()
+        for batch, segment_duration, unbatched in modes:
+            estimate = self.estimate(
+                model, model_name, batch, tokens_per_sec, guidance_scale, segment_duration, weights
+            )
+            if estimate.transient <= headroom:
+                decision = AdmissionDecision(
+                    AdmissionDecision.ADMIT, estimate,
+                    segment_duration=segment_duration if segment_duration != default_segment else None,
+                    unbatched=unbatched
+                )
+                with self._lock:
+                    self.admitted += 1
+                    self.lowered += int(decision.low_memory)
+                return decision
+        
+        # โหมดที่ใช้หน่วยความจำน้อยที่สุดยังไม่พอ: รอถ้าจะพอเมื่อหน่วยความจำว่าง มิฉะนั้นปฏิเสธ
+        if estimate.total > self.max_bytes:
+            return self._rejection(estimate)
+        with self._lock:
+            self.deferred += 1
+        return AdmissionDecision(
+            AdmissionDecision.DEFER, estimate,
+            segment_duration=segment_duration if segment_duration != default_segment else None,
+            unbatched=unbatched,
+            reason=f"หน่วยความจำว่าง {max(headroom, 0) / GB:.2f} GB ไม่พอสำหรับ {estimate.transient / GB:.2f} GB"
+        )
+    
+    def wait_for(self,
+                 needed_bytes: int,
+                 timeout: float,
+                 cancelled: Optional[Callable[[], bool]] = None) -> bool:
+        """รอจนหน่วยความจำว่างพอ needed_bytes (คืนค่า False ถ้าหมดเวลาหรือถูกยกเลิก)"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if cancelled is not None and cancelled():
+                return False
+            if self.headroom() >= needed_bytes:
+                return True
+            time.sleep(ADMISSION_POLL_INTERVAL)
+        return self.headroom() >= needed_bytes
+    
+    @contextmanager
+    def measure(self, model_name: str, estimate: MemoryEstimate, skip: Optional[Callable[[], bool]] = None):
+        """วัด RSS สูงสุดระหว่างสร้าง แล้วปรับตัวคูณของโมเดลนี้ให้ใกล้ค่าที่วัดได้
+        skip() คืนค่า True ถ้าไม่ควรใช้ผลการวัดครั้งนี้ (เช่น การสร้างถูกยกเลิกกลางทาง)"""
+        start = self.rss_bytes()
+        peak = [start]
+        stop = Event()
+        
+        def _poll():
+            while not stop.wait(ADMISSION_POLL_INTERVAL / 10):
+                peak[0] = max(peak[0], self.rss_bytes())
+        
+        poller = Thread(target=_poll, daemon=True)
+        poller.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            poller.join()
+            peak[0] = max(peak[0], self.rss_bytes())
+            if skip is None or not skip():
+                self._calibrate(model_name, estimate, peak[0] - start)
+    
+    def _calibrate(self, model_name: str, estimate: MemoryEstimate, measured_bytes: int):
+        if estimate.raw_generation < _MIN_CALIBRATION_BYTES:
+            return
+        ratio = min(max(measured_bytes / estimate.raw_generation, _SCALE_RANGE[0]), _SCALE_RANGE[1])
+        with self._lock:
+            entry = self._calibration.setdefault(model_name, {"scale": 1.0, "runs": 0})
+            entry["scale"] = (1 - _CALIBRATION_ALPHA) * entry["scale"] + _CALIBRATION_ALPHA * ratio
+            entry["runs"] += 1
+            self._save_calibration()
+        logger.info(
+            f"หน่วยความจำที่ใช้จริง {measured_bytes / MB:.0f} MB "
+            f"(ประมาณไว้ {estimate.raw_generation / MB:.0f} MB) ตัวคูณของ {model_name} = {entry['scale']:.2f}"
+        )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "admitted": self.admitted,
+                "low_memory": self.lowered,
+                "deferred": self.deferred,
+                "rejected": self.rejected,
+                "headroom_gb": self.headroom() / GB,
+                "calibration": {name: dict(entry) for name, entry in self._calibration.items()}
+            }
@@ -1,45 +1,84 @@
 import os
 import gc
+import math
 import time
 import torch
 import logging
 import numpy as np
 from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
-from threading import Thread
-from queue import Queue
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import multiprocessing
+from contextlib import nullcontext, contextmanager
+from threading import Thread, Event, Lock
+from queue import Full
 
 # ดึงการตั้งค่าและ managers
 from app.config.settings import (
-    DEVICE, MUSICGEN_MODEL_NAME, MUSICGEN_MODEL_SIZE,
-    MAX_DURATION, SAMPLE_RATE, AUDIO_FORMAT,
-    MAX_CPU_USAGE, MIXED_PRECISION, TORCH_COMPILE,
-    MODEL_QUANTIZATION, MODEL_PRUNING, GENERATION_CONFIG
+    DEVICE, MUSICGEN_MODEL_NAME, MUSICGEN_MODEL_SIZE, QUALITY_TIERS, DEFAULT_QUALITY,
+    MAX_DURATION, SAMPLE_RATE, AUDIO_FORMAT, MAX_RAM_USAGE,
+    MIXED_PRECISION, TORCH_COMPILE,
+    MODEL_QUANTIZATION, MODEL_PRUNING, MODEL_ARTIFACT_CACHE, GENERATION_CONFIG,
+    INFERENCE_BACKEND, STATIC_KV_CACHE, FUSED_SAMPLER, WORKER_POOL_SIZE, PREEMPTION_ENABLED,
+    SEGMENTED_GENERATION, SEGMENT_DURATION, SEGMENT_CONTEXT, SEGMENT_CROSSFADE,
+    BATCH_DURATION_BUCKET, MEMORY_ADMISSION, ADMISSION_MAX_DEFER, CACHE_PREFIX_REUSE, CACHE_PREFIX_FADE
 )
 
 # ใช้ utilities และ managers
 from app.core.utilities import logger, clean_old_files
 from app.core.cache_manager import cache_manager
+from app.core.request_fingerprint import request_fingerprint, prefix_family
+from app.core.generation_queue import (
+    GenerationQueue, GenerationRequest,
+    PRIORITY_PREVIEW, PRIORITY_NORMAL, PRIORITY_BATCH
+)
+from app.core.admission import MemoryAdmission, MemoryEstimate, AdmissionDecision
+from app.core.cancellation import CancellationToken, GenerationInterrupt
+from app.core.generation_progress import GenerationProgress
+from app.core.model_artifacts import load_artifact, save_artifact
+from app.core.model_registry import ModelRegistry, ResidentModel, model_memory_bytes
+from app.core.sampler import MusicGenSampler
+from app.core.thread_budget import thread_budget
+from app.core.text_conditioning import TextConditioningCache
+from app.core.worker_pool import WorkerPool
 
 class MusicGenerator:
     """คลาสสำหรับการจัดการโมเดล AI สำหรับสร้างเพลง"""
-    def __init__(self):
+    def __init__(self,
+                 quantization: Optional[str] = MODEL_QUANTIZATION,
+                 backend: str = INFERENCE_BACKEND,
+                 static_kv_cache: bool = STATIC_KV_CACHE,
+                 fused_sampler: bool = FUSED_SAMPLER,
+                 workers: int = WORKER_POOL_SIZE,
+                 num_threads: Optional[int] = None,
+                 max_ram_gb: float = MAX_RAM_USAGE):
         self.model = None
+        self.processor = None
         self.device = DEVICE
+        self.model_size = MUSICGEN_MODEL_SIZE
         self.model_name = MUSICGEN_MODEL_NAME
+        # โมเดลหลายขนาดที่โหลดค้างไว้ self.model คือโมเดลที่ใช้งานอยู่ (ดู _use_model)
+        # max_ram_gb ของ worker แต่ละตัวคือส่วนแบ่งของ MAX_RAM_USAGE (ดู _start_worker_pool)
+        self.max_ram_gb = max_ram_gb
+        self._registry = ModelRegistry(self._load_resident, max_gb=max_ram_gb)
+        self._admission = MemoryAdmission(max_gb=max_ram_gb) if MEMORY_ADMISSION else None
+        self.quantization = quantization
+        self.backend = backend
+        self.onnx_backend = None
+        self.static_kv_cache = static_kv_cache
+        self.kv_cache = None
+        self.fused_sampler = fused_sampler
+        self.workers = workers
+        self.num_threads = num_threads  # None = ใช้ค่าจาก settings (MAX_CPU_USAGE)
+        self._worker_pool = None
+        self._thread_lease = None  # ส่วนแบ่ง thread ของการสร้างที่กำลังทำ (ดู _generation_threads)
         self.sample_rate = SAMPLE_RATE
         self.is_loading = False
         self.is_ready = False
-        self.progress_callback = None
-        self._generation_queue = Queue()
+        self.progress_callback = None  # รับความคืบหน้าของทุกงาน (นอกเหนือจาก callback ของแต่ละคำขอ)
+        self._generation_queue = GenerationQueue(key_func=self._batch_key)
         self._processing_thread = None
-        
-        # ThreadPool สำหรับ batch processing
-        self.thread_pool = ThreadPoolExecutor(
-            max_workers=min(MAX_CPU_USAGE, multiprocessing.cpu_count())
-        )
+        self._text_cache = TextConditioningCache()
+        # การค้นหาใน cache ผลลัพธ์ (normalized_hits = hit ที่ได้เพราะคีย์ถูกปรับรูปแบบ)
+        self._cache_lookups = {"lookups": 0, "hits": 0, "normalized_hits": 0, "prefix_hits": 0, "resumed": 0}
         
     def load_model(self, callback=None):
         """โหลดโมเดล MusicGen พร้อม optimization"""
@@ -52,76 +91,20 @@ class MusicGenerator:
         def _load():
             logger.info(f"กำลังโหลดโมเดล {self.model_name}...")
             try:
-                # ทำ import ภายในฟังก์ชันเพื่อลดเวลาการโหลดตอนเริ่มโปรแกรม
-                from transformers import AutoProcessor, MusicgenForConditionalGeneration
-                from transformers import BitsAndBytesConfig
-                
                 # โหลดโมเดลและ processor
                 start_time = time.time()
-                
-                # เรียกให้มีการแสดง log
-                logger.info(f"กำลังโหลด processor จาก {self.model_name}...")
-                self.processor = AutoProcessor.from_pretrained(self.model_name)
-                
-                # ตั้งค่า Quantization
-                quantization_config = None
-                if MODEL_QUANTIZATION == "8bit":
-                    quantization_config = BitsAndBytesConfig(load_in_8bit=True)
-                    logger.info("ใช้ 8-bit quantization")
-                elif MODEL_QUANTIZATION == "4bit":
-                    quantization_config = BitsAndBytesConfig(
-                        load_in_4bit=True,
-                        bnb_4bit_compute_dtype=torch.float16,
-                        bnb_4bit_quant_type="nf4",
-                        bnb_4bit_use_double_quant=True,
-                    )
-                    logger.info("ใช้ 4-bit quantization (NF4)")
-                    
-                # ตั้งค่า dtype สำหรับ mixed precision
-                torch_dtype = torch.float16 if MIXED_PRECISION and self.device == "cuda" else torch.float32
-                
-                logger.info(f"กำลังโหลด model จาก {self.model_name}...")
-                self.model = MusicgenForConditionalGeneration.from_pretrained(
-                    self.model_name,
-                    torch_dtype=torch_dtype,
-                    quantization_config=quantization_config,
-                    # device_map="auto" # อาจจะใช้แทน .to(device) แต่ต้องทดสอบ
-                )
-                
-                # ย้ายโมเดลไปยัง device ที่เหมาะสม (ถ้าไม่ได้ใช้ device_map)
-                if not hasattr(self.model, 'hf_device_map'):
-                    self.model.to(self.device)
-                    
-                # Model Pruning (ตัวอย่าง - อาจต้องปรับปรุง)
-                if MODEL_PRUNING > 0:
-                    try:
-                        from torch.nn.utils import prune
-                        parameters_to_prune = []
-                        for module in self.model.modules():
-                            if isinstance(module, torch.nn.Linear):
-                                parameters_to_prune.append((module, 'weight'))
-                        
-                        if parameters_to_prune:
-                            prune.global_unstructured(
-                                parameters_to_prune,
-                                pruning_method=prune.L1Unstructured,
-                                amount=MODEL_PRUNING,
-                            )
-                            logger.info(f"ทำการ Pruning โมเดล {MODEL_PRUNING*100}%")
-                            # ทำให้ pruning มีผลถาวร (อาจไม่จำเป็น)
-                            # for module, name in parameters_to_prune:
-                            #     prune.remove(module, name)
-                        else:
-                            logger.warning("ไม่พบ layers ที่จะทำการ pruning")
-                            
-                    except Exception as e:
-                        logger.warning(f"ไม่สามารถทำการ pruning ได้: {e}")
+                if self.workers > 1 and self.device == "cpu":
+                    # โมเดลอยู่ใน worker process แต่ละตัว ไม่ต้องโหลดใน process หลัก
+                    self._start_worker_pool()
+                else:
+                    self._use_model()
                 
                 # ใช้ torch.compile ถ้าเปิดใช้งานและมี PyTorch 2.0+
-                if TORCH_COMPILE and self.device == "cuda" and hasattr(torch, 'compile'):
+                if TORCH_COMPILE and self.device == "cuda" and self.model is not None and hasattr(torch, 'compile'):
                     try:
                         logger.info("กำลังใช้ torch.compile เพื่อเพิ่มความเร็ว...")
                         self.model = torch.compile(self.model, mode="reduce-overhead")
+                        self._registry.get(self.model_size).model = self.model
                     except Exception as e:
                         logger.warning(f"ไม่สามารถใช้ torch.compile ได้: {e}")
                 
@@ -146,147 +129,677 @@ class MusicGenerator:
         load_thread = Thread(target=_load)
         load_thread.start()
         
+    def _start_worker_pool(self):
+        """เริ่ม worker process ตามจำนวน self.workers โดยแบ่ง core ให้แต่ละตัวไม่ซ้อนกัน
+        แต่ละ worker ตรวจสอบหน่วยความจำของตัวเองด้วย MAX_RAM_USAGE / จำนวน worker
+        (process หลักไม่ได้โหลดโมเดล จึงประมาณหน่วยความจำของคำขอเองไม่ได้)"""
+        max_ram_gb = self.max_ram_gb / self.workers
+        pool = WorkerPool(self.workers, {
+            "quantization": self.quantization,
+            "backend": self.backend,
+            "static_kv_cache": self.static_kv_cache,
+            "fused_sampler": self.fused_sampler,
+            "max_ram_gb": max_ram_gb
+        })
+        logger.info(f"worker แต่ละตัวใช้หน่วยความจำได้ไม่เกิน {max_ram_gb:.1f} GB")
+        if not pool.start():
+            pool.shutdown()
+            raise RuntimeError("ไม่สามารถเริ่ม worker process ได้")
+        self._worker_pool = pool
+        self.sample_rate = pool.sample_rate or self.sample_rate
+        
+    def _load_resident(self, size: str) -> ResidentModel:
+        """โหลดโมเดลขนาด size (ใช้เป็น loader ของ ModelRegistry)"""
+        self.model_size = size
+        self.model_name = f"facebook/musicgen-{size}"
+        # kv_cache/onnx_backend ของโมเดลก่อนหน้าอยู่ใน ResidentModel ของมันแล้ว
+        self.kv_cache = None
+        self.onnx_backend = None
+        model, processor = self._build_model()
+        return ResidentModel(
+            size, self.model_name, model, processor,
+            kv_cache=self.kv_cache, onnx_backend=self.onnx_backend,
+            memory_bytes=model_memory_bytes(model)
+        )
+        
+    def _activate_size(self, size: str):
+        """ทำให้โมเดลขนาด size เป็นโมเดลที่ใช้งานอยู่ (โหลดหรือปลดโมเดลอื่นผ่าน registry ถ้าจำเป็น)"""
+        if self.model is not None and size == self.model_size:
+            self._registry.touch(size)
+            return
+        previous_size = self.model_size
+        # ปล่อย reference ของโมเดลปัจจุบันก่อน เพื่อให้ registry ปลดโมเดลนี้ได้จริงถ้าต้องการที่ว่าง
+        self.model = None
+        self.processor = None
+        self.kv_cache = None
+        self.onnx_backend = None
+        try:
+            entry = self._registry.get(size)
+        except Exception:
+            # โหลดไม่สำเร็จ (เช่น หน่วยความจำไม่พอ) กลับไปใช้โมเดลเดิมถ้ายังโหลดอยู่
+            if previous_size in self._registry.resident_sizes():
+                self._activate_size(previous_size)
+            else:
+                self.model_size = previous_size
+                self.model_name = f"facebook/musicgen-{previous_size}"
+            raise
+        self.model_size = entry.size
+        self.model_name = entry.model_name
+        self.model = entry.model
+        self.processor = entry.processor
+        self.kv_cache = entry.kv_cache
+        self.onnx_backend = entry.onnx_backend
+        
+    def _use_model(self, quality: Optional[str] = None):
+        """เลือกโมเดลตามระดับคุณภาพของคำขอ (ดู QUALITY_TIERS) None = DEFAULT_QUALITY"""
+        self._activate_size(self._model_size_for(quality))
+        
+    @staticmethod
+    def _model_size_for(quality: Optional[str]) -> str:
+        quality = quality or DEFAULT_QUALITY
+        if quality not in QUALITY_TIERS:
+            raise ValueError(f"ไม่รู้จักระดับคุณภาพ {quality} (มี {', '.join(QUALITY_TIERS)})")
+        return QUALITY_TIERS[quality]
+        
+    def get_model_stats(self) -> Dict[str, Any]:
+        """โมเดลที่โหลดอยู่ในหน่วยความจำและโมเดลที่ใช้งานอยู่"""
+        stats = self._registry.get_stats()
+        stats["active"] = self.model_size if self.model is not None else None
+        return stats
+        
+    def _model_options(self) -> Dict[str, Any]:
+        """การตั้งค่าที่มีผลต่อน้ำหนักของโมเดล ใช้เป็นคีย์ของ artifact ใน MODELS_DIR"""
+        # dynamic int8 ทำหลังโหลดทุกครั้ง จึงใช้ artifact เดียวกับ fp32
+        return {
+            "quantization": self.quantization if self.quantization in ("8bit", "4bit") else None,
+            "pruning": MODEL_PRUNING,
+            "dtype": str(self._torch_dtype())
+        }
+        
+    def _torch_dtype(self) -> torch.dtype:
+        """dtype ของน้ำหนักโมเดลสำหรับ mixed precision"""
+        return torch.float16 if MIXED_PRECISION and self.device == "cuda" else torch.float32
+        
+    def _build_model(self):
+        """โหลดโมเดลที่ optimize แล้วจาก MODELS_DIR ถ้ามี
+        ไม่เช่นนั้นโหลดจากต้นฉบับ ทำ pruning แล้วบันทึกเป็น artifact ไว้ใช้ครั้งถัดไป
+        คืนค่า (model, processor)"""
+        # ทำ import ภายในฟังก์ชันเพื่อลดเวลาการโหลดตอนเริ่มโปรแกรม
+        from transformers import AutoProcessor, MusicgenForConditionalGeneration
+        from transformers import BitsAndBytesConfig
+        
+        # worker process ใช้ thread เท่ากับจำนวน core ที่ได้รับเท่านั้น
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        
+        # ตั้งค่า Quantization
+        quantization_config = None
+        if self.quantization == "8bit":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            logger.info("ใช้ 8-bit quantization")
+        elif self.quantization == "4bit":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.float16,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+            )
+            logger.info("ใช้ 4-bit quantization (NF4)")
+            
+        # ตั้งค่า dtype สำหรับ mixed precision
+        load_kwargs = {"torch_dtype": self._torch_dtype()}
+        if quantization_config is not None:
+            load_kwargs["quantization_config"] = quantization_config
+        options = self._model_options()
+        
+        # ใช้ artifact ที่ optimize ไว้แล้วถ้ามี (ไม่ต้องโหลดต้นฉบับและ pruning ใหม่)
+        loaded = load_artifact(self.model_name, options, **load_kwargs) if MODEL_ARTIFACT_CACHE else None
+        if loaded is not None:
+            model, processor = loaded
+        else:
+            # เรียกให้มีการแสดง log
+            logger.info(f"กำลังโหลด processor จาก {self.model_name}...")
+            processor = AutoProcessor.from_pretrained(self.model_name)
+            
+            logger.info(f"กำลังโหลด model จาก {self.model_name}...")
+            model = MusicgenForConditionalGeneration.from_pretrained(
+                self.model_name,
+                **load_kwargs
+                # device_map="auto" # อาจจะใช้แทน .to(device) แต่ต้องทดสอบ
+            )
+            
+            self._apply_pruning(model)
+            
+            # 4-bit ยังบันทึกเป็นไฟล์ไม่ได้ใน transformers เวอร์ชันนี้
+            if MODEL_ARTIFACT_CACHE and self.quantization != "4bit":
+                save_artifact(model, processor, self.model_name, options)
+        
+        # export/โหลด ONNX จากน้ำหนัก fp32 ก่อน dynamic int8 (quantize แล้ว export ไม่ได้)
+        if self.backend == "onnx":
+            self.onnx_backend = self._attach_onnx_backend(model, options)
+                
+        # น้ำหนัก int8 แบบ packed บันทึกเป็น safetensors ไม่ได้ จึง quantize หลังโหลดทุกครั้ง (ใช้เวลาไม่กี่วินาที)
+        if self.quantization == "dynamic_int8":
+            self._apply_dynamic_quantization(model)
+            
+        # decoder ที่รันผ่าน ONNX Runtime จัดการ KV cache เอง
+        if self.static_kv_cache and self.onnx_backend is None:
+            from app.core.static_cache import StaticKVCache
+            self.kv_cache = StaticKVCache(model)
+            self.kv_cache.attach()
+                
+        # ย้ายโมเดลไปยัง device ที่เหมาะสม (ถ้าไม่ได้ใช้ device_map)
+        if not hasattr(model, 'hf_device_map'):
+            model.to(self.device)
+            
+        return model, processor
+        
+    def _attach_onnx_backend(self, model, options: Dict[str, Any]):
+        """ให้ decoder และ EnCodec ของโมเดลรันผ่าน ONNX Runtime
+        คืนค่า OnnxBackend หรือ None ถ้าใช้ไม่ได้ (ใช้ PyTorch ตามเดิม)"""
+        if self.device != "cpu" or model.dtype != torch.float32 or self.quantization in ("8bit", "4bit"):
+            logger.warning("ONNX backend รองรับเฉพาะโมเดล fp32 บน CPU ใช้ PyTorch แทน")
+            return None
+        
+        from app.core.onnx_backend import OnnxBackend
+        backend = OnnxBackend(model, self.model_name, options, intra_op_threads=self.num_threads)
+        return backend if backend.attach() else None
+        
+    def _apply_dynamic_quantization(self, model):
+        """แปลง nn.Linear ของ decoder และ text encoder เป็น int8 แบบ dynamic สำหรับ CPU
+        (น้ำหนักเป็น int8, activation ถูก quantize ระหว่างคำนวณ) EnCodec ยังเป็น fp32"""
+        if self.device != "cpu":
+            logger.warning("dynamic int8 quantization รองรับเฉพาะ CPU ข้ามการ quantize")
+            return
+            
+        try:
+            from torch.ao.quantization import quantize_dynamic
+            # decoder ที่รันผ่าน ONNX Runtime ไม่ได้ใช้น้ำหนักของ PyTorch แล้ว
+            names = ("text_encoder",) if self.onnx_backend is not None else ("decoder", "text_encoder")
+            for name in names:
+                quantize_dynamic(
+                    getattr(model, name),
+                    {torch.nn.Linear},
+                    dtype=torch.qint8,
+                    inplace=True
+                )
+            logger.info(f"ใช้ dynamic int8 quantization (CPU) กับ {', '.join(names)}")
+            
+        except Exception as e:
+            logger.warning(f"ไม่สามารถทำ dynamic int8 quantization ได้: {e}")
+        
+    @staticmethod
+    def _apply_pruning(model):
+        """ตัดน้ำหนักที่มีค่าน้อยของทุก nn.Linear ออกตาม MODEL_PRUNING แล้วทำให้มีผลถาวร
+        (ลบ mask และ forward hook ออก น้ำหนักจึงบันทึกเป็น artifact ได้ตรงๆ)"""
+        if MODEL_PRUNING <= 0:
+            return
+            
+        try:
+            from torch.nn.utils import prune
+            parameters_to_prune = []
+            for module in model.modules():
+                if isinstance(module, torch.nn.Linear):
+                    parameters_to_prune.append((module, 'weight'))
+            
+            if parameters_to_prune:
+                prune.global_unstructured(
+                    parameters_to_prune,
+                    pruning_method=prune.L1Unstructured,
+                    amount=MODEL_PRUNING,
+                )
+                for module, name in parameters_to_prune:
+                    prune.remove(module, name)
+                logger.info(f"ทำการ Pruning โมเดล {MODEL_PRUNING*100}%")
+            else:
+                logger.warning("ไม่พบ layers ที่จะทำการ pruning")
+                
+        except Exception as e:
+            logger.warning(f"ไม่สามารถทำการ pruning ได้: {e}")
+            
     def _start_processing_thread(self):
         """เริ่ม thread สำหรับประมวลผลคำขอในคิว"""
         def _process_queue():
             while True:
-                if not self._generation_queue.empty():
-                    # ดึงข้อมูลจากคิว
-                    params, result_callback = self._generation_queue.get()
-                    use_cache = params.pop('use_cache', True)
-                    
-                    # ตรวจสอบ cache ก่อน
-                    if use_cache:
-                        cached_result = cache_manager.get(params)
-                        if cached_result:
-                            logger.info("ใช้ผลลัพธ์จาก cache")
-                            if result_callback:
-                                result_callback(True, cached_result)
-                            self._generation_queue.task_done()
-                            continue
-                    
-                    # สร้างเพลง
-                    try:
-                        result = self._generate_music(**params)
-                        
-                        # เก็บลง cache
-                        if use_cache:
-                            cache_manager.set(params, result)
-                            
-                        if result_callback:
-                            result_callback(True, result)
-                    except Exception as e:
-                        logger.error(f"เกิดข้อผิดพลาดในการสร้างเพลง: {e}")
-                        if result_callback:
-                            result_callback(False, str(e))
-                    
-                    # ทำความสะอาดหน่วยความจำ
-                    gc.collect()
-                    if self.device == "cuda":
-                        torch.cuda.empty_cache()
-                    
-                    # เสร็จสิ้นงานในคิว
-                    self._generation_queue.task_done()
-                else:
-                    # ถ้าไม่มีงานให้นอนรอสักครู่
-                    time.sleep(0.5)
+                # รอคำขอและรวบรวมคำขอที่เข้ากันได้เป็น batch
+                batch = []
+                try:
+                    batch = self._generation_queue.next_batch()
+                    self._process_batch(batch)
+                except Exception as e:
+                    # ข้อผิดพลาดของ batch หนึ่งต้องไม่หยุด thread (คำขอที่เหลือในคิวจะค้างตลอดไป)
+                    logger.error(f"เกิดข้อผิดพลาดในการประมวลผลคิว: {e}")
+                    for request in batch:
+                        if request.result_callback and not request.answered:
+                            try:
+                                request.result_callback(False, str(e))
+                            except Exception as callback_error:
+                                logger.error(f"เกิดข้อผิดพลาดใน callback ของคำขอ: {callback_error}")
+                
+                # ทำความสะอาดหน่วยความจำ
+                gc.collect()
+                if self.device == "cuda":
+                    torch.cuda.empty_cache()
         
         self._processing_thread = Thread(target=_process_queue, daemon=True)
         self._processing_thread.start()
     
+    def _process_batch(self, batch: List[GenerationRequest]):
+        """สร้างเพลงของคำขอหนึ่ง batch (ใช้ cache ถ้ามี) แล้วส่งผลลัพธ์ให้ callback"""
+        # ทิ้งคำขอที่ถูกยกเลิกระหว่างรอในคิว และตรวจสอบ cache ก่อน
+        pending = []
+        for request in batch:
+            if request.is_cancelled:
+                logger.info(f"ข้ามคำขอที่ถูกยกเลิก: {request.params['prompt']}")
+                if request.result_callback:
+                    request.result_callback(False, "การสร้างเพลงถูกยกเลิก")
+                continue
+            if request.use_cache:
+                cached_result = cache_manager.get(self._cache_params(request.params), decode=self._cache_decoder())
+                self._count_cache_lookup(request.params, cached_result)
+                if cached_result:
+                    logger.info("ใช้ผลลัพธ์จาก cache")
+                    if request.result_callback:
+                        request.result_callback(True, self._with_queue_wait(cached_result, request))
+                    continue
+                if CACHE_PREFIX_REUSE:
+                    prefix_result = self._cached_prefix(request)
+                    if prefix_result:
+                        logger.info(f"ใช้ส่วนต้นของเพลงที่ยาวกว่าใน cache ({prefix_result['metadata']['prefix_of']} วินาที)")
+                        if request.result_callback:
+                            request.result_callback(True, self._with_queue_wait(prefix_result, request))
+                        continue
+            pending.append(request)
+        
+        if not pending:
+            return
+            
+        # คำขอที่สร้างต่อจากเพลงที่สั้นกว่าใน cache สร้างเดี่ยว (แถวใน batch เริ่มจากจุดเดียวกันทั้งหมด)
+        if len(pending) > 1 and any(request.prefix is not None for request in pending):
+            for request in pending:
+                self._generate_requests([request])
+            return
+        self._generate_requests(pending)
+    
+    def _generate_requests(self, pending: List[GenerationRequest]):
+        """สร้างเพลงของคำขอที่ไม่มีใน cache (ใน worker pool หรือ process นี้) แล้วส่งผลลัพธ์ให้ _finish_batch"""
+        if self._worker_pool is not None:
+            self._submit_to_pool(pending)
+            return
+            
+        # ตรวจสอบหน่วยความจำก่อนเริ่ม (อาจสร้างทีละคำขอ แบ่งช่วงสั้นลง หรือรอให้หน่วยความจำว่าง)
+        decision = self._admit(pending)
+        if decision is None:
+            return
+        if decision.unbatched and len(pending) > 1:
+            for request in pending:
+                self._process_batch([request])
+            return
+            
+        # ตรวจสอบการยกเลิกทุก token และให้ตัวอย่างเพลงแทรกเพลงยาวที่สร้างทีละช่วงได้
+        # (สร้างต่อจากตำแหน่งที่พักไว้ได้เฉพาะการสร้างทีละช่วง)
+        preempt_check = None
+        segmented = SEGMENTED_GENERATION or decision.segment_duration is not None
+        if (PREEMPTION_ENABLED and len(pending) == 1 and pending[0].priority > PRIORITY_PREVIEW
+                and segmented and pending[0].params['duration'] > (decision.segment_duration or SEGMENT_DURATION)):
+            preempt_check = lambda: self._generation_queue.has_pending(PRIORITY_PREVIEW)
+        interrupt = GenerationInterrupt([request.cancel_token for request in pending], preempt_check)
+            
+        # สร้างเพลงทั้ง batch ด้วย model.generate ครั้งเดียว
+        try:
+            with self._measure_memory(decision, interrupt), self._generation_threads():
+                results = self._generate_music_batch(
+                    [self._generation_params(request) for request in pending],
+                    progress_callback=self._progress_fanout(pending),
+                    interrupt=interrupt,
+                    segment_duration=decision.segment_duration
+                )
+        except Exception as e:
+            self._finish_batch(pending, None, str(e))
+        else:
+            self._finish_batch(pending, results)
+    
+    def _submit_to_pool(self, pending: List[GenerationRequest]):
+        """ส่งคำขอให้ worker ที่ว่างที่สุด ผลลัพธ์ของแต่ละคำขอกลับมาทาง thread ของ pool
+        worker ตรวจสอบหน่วยความจำ ให้ตัวอย่างเพลงแทรกเพลงยาว และรับการยกเลิกผ่าน cancel token เอง
+        ระหว่างรอ worker ว่าง ตัวอย่างเพลงที่เข้าคิวมาใหม่ถูกส่งไปก่อน (ตัวอย่างเพลงส่งได้เสมอ)"""
+        priority = min(request.priority for request in pending)
+        try:
+            if priority > PRIORITY_PREVIEW:
+                while not self._worker_pool.has_capacity(timeout=0.5):
+                    for batch in iter(lambda: self._generation_queue.next_batch(max_priority=PRIORITY_PREVIEW), []):
+                        self._process_batch(batch)
+            self._worker_pool.submit(
+                [self._generation_params(request) for request in pending],
+                result_callback=lambda index, result, error: self._finish_pool_request(pending[index], result, error),
+                progress_callback=self._progress_fanout(pending),
+                priority=priority,
+                cancel_tokens=[request.cancel_token for request in pending]
+            )
+        except Exception as e:
+            self._finish_batch(pending, None, str(e))
+    
+    def _finish_pool_request(self,
+                             request: GenerationRequest,
+                             result: Optional[Dict[str, Any]],
+                             error: Optional[str]):
+        """ผลลัพธ์ของคำขอหนึ่งรายการจาก worker pool"""
+        if error is not None and request.is_cancelled:
+            # worker หยุดตามที่ถูกยกเลิก ไม่ใช่ข้อผิดพลาด
+            if request.result_callback:
+                request.result_callback(False, error)
+            return
+        self._finish_batch([request], None if error is not None else [result], error)
+    
+    def _admit(self, requests: List[GenerationRequest]) -> Optional[AdmissionDecision]:
+        """ตรวจสอบหน่วยความจำก่อนสร้างคำขอชุดนี้ (ดู MemoryAdmission)
+        คืนค่า None ถ้าคำขอถูกปฏิเสธหรือรอหน่วยความจำไม่สำเร็จ (แจ้งผู้ขอทาง callback แล้ว)"""
+        if self._admission is None:
+            return AdmissionDecision(AdmissionDecision.ADMIT, MemoryEstimate())
+        try:
+            self._use_model(requests[0].params.get('quality'))
+        except Exception as e:
+            self._finish_batch(requests, None, str(e))
+            return None
+            
+        durations = [min(request.params['duration'], MAX_DURATION) for request in requests]
+        decision = self._admission_decision(durations)
+        if decision.action == AdmissionDecision.DEFER and self._registry.release_idle(keep=[self.model_size]):
+            # ปลดโมเดลขนาดอื่นที่โหลดค้างไว้แล้วลองใหม่
+            decision = self._admission_decision(durations)
+            
+        if decision.action == AdmissionDecision.DEFER:
+            logger.warning(f"เลื่อนการสร้างเพลงไว้จนกว่าหน่วยความจำจะว่าง: {decision.reason}")
+            if self._admission.wait_for(
+                decision.estimate.transient, ADMISSION_MAX_DEFER,
+                cancelled=lambda: all(request.is_cancelled for request in requests)
+            ):
+                decision.action = AdmissionDecision.ADMIT
+            else:
+                decision = AdmissionDecision(
+                    AdmissionDecision.REJECT, decision.estimate,
+                    reason=f"รอหน่วยความจำว่างนานเกิน {ADMISSION_MAX_DEFER} วินาที ({decision.reason})"
+                )
+                
+        if decision.action == AdmissionDecision.REJECT:
+            self._finish_batch(requests, None, decision.reason)
+            return None
+            
+        if decision.low_memory:
+            mode = "สร้างทีละคำขอ" if decision.unbatched else ""
+            if decision.segment_duration is not None:
+                mode = f"{mode} แบ่งช่วงละ {decision.segment_duration} วินาที".strip()
+            logger.info(f"หน่วยความจำไม่พอสำหรับโหมดปกติ ใช้โหมดประหยัดหน่วยความจำ: {mode}")
+        return decision
+        
+    def _admission_decision(self, durations: List[float]) -> AdmissionDecision:
+        return self._admission.decide(
+            self.model, self.model_name, durations,
+            GENERATION_CONFIG.get("max_new_tokens_per_sec", 50),
+            GENERATION_CONFIG.get("guidance_scale", 1.0),
+            weights=model_memory_bytes(self.model)
+        )
+        
+    def _measure_memory(self, decision: AdmissionDecision, interrupt: GenerationInterrupt):
+        """วัดหน่วยความจำสูงสุดระหว่างสร้างเพื่อปรับค่าประมาณของ admission (ไม่นับการสร้างที่ถูกยกเลิก)"""
+        if self._admission is None:
+            return nullcontext()
+        return self._admission.measure(self.model_name, decision.estimate, skip=lambda: interrupt.cancelled)
+        
+    @contextmanager
+    def _generation_threads(self):
+        """ขอส่วนแบ่ง thread ของการสร้างเพลงจาก thread_budget (ปรับทุก token ใน _run_generate)
+        ตัวอย่างเพลงที่แทรกระหว่างพักงานยาวใช้ส่วนแบ่งเดิม"""
+        if self._thread_lease is not None:
+            yield self._thread_lease
+            return
+        with thread_budget.lease("generation", max_threads=self.num_threads, torch_threads=True) as lease:
+            self._thread_lease = lease
+            try:
+                yield lease
+            finally:
+                self._thread_lease = None
+        
+    def get_memory_stats(self) -> Dict[str, Any]:
+        """สถิติของ admission control (จำนวนคำขอที่รับ/เลื่อน/ปฏิเสธ และตัวคูณ calibration)"""
+        return self._admission.get_stats() if self._admission is not None else {}
+        
+    def _serve_preemption(self):
+        """สร้างตัวอย่างเพลงที่รออยู่ทั้งหมด ระหว่างที่งานยาวถูกพักไว้
+        โมเดลของงานที่พักไว้ถูก pin ไว้ไม่ให้ถูกปลด แล้วกลับมาใช้โมเดลนั้นก่อนสร้างต่อ"""
+        paused_size = self.model_size
+        self._registry.pin(paused_size)
+        try:
+            while True:
+                batch = self._generation_queue.next_batch(max_priority=PRIORITY_PREVIEW)
+                if not batch:
+                    break
+                self._process_batch(batch)
+            self._activate_size(paused_size)
+        finally:
+            self._registry.unpin(paused_size)
+    
+    def _finish_batch(self,
+                      requests: List[GenerationRequest],
+                      results: Optional[List[Dict[str, Any]]],
+                      error: Optional[str] = None):
+        """เก็บผลลัพธ์ของ batch ลง cache แล้วเรียก callback ของแต่ละคำขอ"""
+        if error is not None:
+            logger.error(f"เกิดข้อผิดพลาดในการสร้างเพลง: {error}")
+            for request in requests:
+                if request.result_callback:
+                    request.result_callback(False, error)
+            return
+            
+        for request, result in zip(requests, results):
+            # ยกเลิกโดยไม่ต้องการเสียงส่วนที่สร้างแล้ว
+            if request.is_cancelled and not request.cancel_token.return_partial:
+                if request.result_callback:
+                    request.result_callback(False, "การสร้างเพลงถูกยกเลิก")
+                continue
+                
+            # เก็บลง cache (ไม่เก็บเสียงที่สร้างไม่ครบ) พร้อม family ให้คำขอที่ต่างแค่ความยาวใช้ร่วมกันได้
+            if request.use_cache and not result['metadata'].get('cancelled'):
+                fingerprint = self._cache_params(request.params)
+                if self._cache_decoder() is None:
+                    # ถอดรหัส codes ใน process นี้ไม่ได้ เก็บข้อมูลเสียงแทน
+                    result = {key: value for key, value in result.items() if key != 'codes'}
+                cache_manager.set(fingerprint, result, family=prefix_family(fingerprint), duration=fingerprint['duration'])
+                
+            if request.result_callback:
+                request.result_callback(True, self._with_queue_wait(result, request))
+    
+    def _progress_fanout(self, requests: List[GenerationRequest]):
+        """รวม progress callback ของทุกคำขอใน batch (และของ engine) เป็น callback เดียว"""
+        callbacks = []
+        for callback in [request.progress_callback for request in requests] + [self.progress_callback]:
+            # คำขอจาก generate_batch เดียวกันใช้ callback ร่วมกัน ไม่ต้องรายงานซ้ำ
+            if callback and callback not in callbacks:
+                callbacks.append(callback)
+        if not callbacks:
+            return None
+            
+        def _on_progress(info: Dict[str, Any]):
+            for callback in callbacks:
+                callback(info)
+        return _on_progress
+    
+    @staticmethod
+    def _generation_params(request: GenerationRequest) -> Dict[str, Any]:
+        """พารามิเตอร์ของ _generate_music สำหรับคำขอ (รวมส่วนต้นจาก cache ถ้ามี)"""
+        if request.prefix is None:
+            return request.params
+        return {**request.params, "prefix": request.prefix}
+    
+    @staticmethod
+    def _with_queue_wait(result: Dict[str, Any], request: GenerationRequest) -> Dict[str, Any]:
+        """คัดลอกผลลัพธ์พร้อมเพิ่มเวลารอในคิวของคำขอนี้ลงใน metadata
+        (ไม่แก้ metadata เดิมที่อาจถูกเก็บใน cache)"""
+        return {
+            "audio_data": result['audio_data'],
+            "metadata": {**result['metadata'], "queue_wait": request.queue_wait}
+        }
+    
+    def _batch_key(self, params: Dict[str, Any]) -> Optional[Tuple]:
+        """คีย์ของกลุ่มคำขอที่รวมเป็น batch เดียวกันได้
+        ต้องใช้โมเดล (ตามระดับคุณภาพ) และ generation config เดียวกัน และความยาวอยู่ใน bucket เดียวกัน
+        คืนค่า None สำหรับเพลงยาวที่ต้องสร้างแบบแบ่งช่วง (สร้างเดี่ยว)"""
+        duration = min(params['duration'], MAX_DURATION)
+        if SEGMENTED_GENERATION and duration > SEGMENT_DURATION:
+            return None
+            
+        bucket = int(math.ceil(duration / BATCH_DURATION_BUCKET))
+        return (self._model_size_for(params.get('quality')), bucket)
+    
     def queue_music_generation(self, 
                              prompt: str, 
                              duration: int,
                              instruments: List[str],
                              mood: str,
                              result_callback=None,
-                             use_cache: bool = True) -> bool:
-        """เพิ่มคำขอการสร้างเพลงเข้าคิว"""
+                             use_cache: bool = True,
+                             priority: int = PRIORITY_NORMAL,
+                             progress_callback=None,
+                             cancel_token: Optional[CancellationToken] = None,
+                             quality: str = DEFAULT_QUALITY) -> bool:
+        """เพิ่มคำขอการสร้างเพลงเข้าคิว
+        priority ค่าน้อยได้ทำก่อน (เช่น PRIORITY_PREVIEW สำหรับตัวอย่างเพลง)
+        progress_callback รับ dict ความคืบหน้า (ดู GenerationProgress) ระหว่างสร้าง
+        cancel_token ใช้ยกเลิกคำขอได้ทั้งขณะรอในคิวและระหว่างสร้าง (ดู CancellationToken)
+        quality เลือกขนาดโมเดล (ดู QUALITY_TIERS)
+        คืนค่า False ถ้าโมเดลยังไม่พร้อมหรือคิวเต็ม"""
         if not self.is_ready:
             if result_callback:
                 result_callback(False, "โมเดลยังไม่พร้อม กรุณารอให้โหลดเสร็จก่อน")
             return False
+        if quality not in QUALITY_TIERS:
+            if result_callback:
+                result_callback(False, f"ไม่รู้จักระดับคุณภาพ {quality}")
+            return False
+        # ปฏิเสธทันทีถ้าคำขอนี้ใช้หน่วยความจำเกิน MAX_RAM_USAGE แม้ในโหมดประหยัดหน่วยความจำ
+        rejection = self._check_feasible(duration, quality)
+        if rejection is not None:
+            logger.warning(rejection.reason)
+            if result_callback:
+                result_callback(False, rejection.reason)
+            return False
         
         # เตรียมพารามิเตอร์
         params = {
             "prompt": prompt,
             "duration": duration,
             "instruments": instruments,
-            "mood": mood,
-            "use_cache": use_cache
+            "mood": mood
         }
+        if quality != DEFAULT_QUALITY:
+            # ใส่เฉพาะเมื่อไม่ใช่ค่าเริ่มต้น เพื่อให้คีย์ cache ของเพลงเดิมยังใช้ได้
+            params["quality"] = quality
         
-        # เพิ่มเข้าคิว
-        self._generation_queue.put((params, result_callback))
+        # เพิ่มเข้าคิว (ไม่รอถ้าคิวเต็ม ให้ผู้เรียกตัดสินใจเอง)
+        try:
+            self._generation_queue.put(
+                GenerationRequest(params, result_callback, use_cache, priority, progress_callback, cancel_token)
+            )
+        except Full:
+            logger.warning(f"คิวการสร้างเพลงเต็ม ({self._generation_queue.max_size} รายการ)")
+            if result_callback:
+                result_callback(False, "คิวการสร้างเพลงเต็ม กรุณารอให้งานก่อนหน้าเสร็จก่อน")
+            return False
+            
         logger.info(f"เพิ่มคำขอการสร้างเพลงเข้าคิว: {prompt}")
         return True
         
+    def _check_feasible(self, duration: int, quality: str) -> Optional[AdmissionDecision]:
+        """ประมาณหน่วยความจำของคำขอตอนรับเข้าคิว (ใช้โครงสร้างของโมเดลที่โหลดอยู่)"""
+        # อ่านครั้งเดียว: thread ของคิวอาจสลับขนาดโมเดล (ตั้ง self.model เป็น None) ระหว่างที่ UI thread ตรวจสอบ
+        model, model_name = self.model, self.model_name
+        if self._admission is None or model is None:
+            return None
+        return self._admission.check_feasible(
+            model, model_name, min(duration, MAX_DURATION),
+            GENERATION_CONFIG.get("max_new_tokens_per_sec", 50),
+            GENERATION_CONFIG.get("guidance_scale", 1.0),
+            weights=self._registry.expected_bytes(self._model_size_for(quality))
+        )
+        
+    def get_queue_stats(self) -> Dict[str, Any]:
+        """ดึงสถิติของคิวการสร้างเพลง (จำนวนที่รอ, เวลารอเฉลี่ย/สูงสุด)"""
+        stats = self._generation_queue.get_stats()
+        if self._worker_pool is not None:
+            stats["workers"] = self._worker_pool.get_stats()
+        stats["threads"] = thread_budget.get_stats()
+        return stats
+        
     def generate_batch(self,
                       tasks: List[Dict[str, Any]],
                       status_callback=None,
-                      use_cache: bool = True) -> List[Dict[str, Any]]:
-        """สร้างเพลงหลายเพลงพร้อมกันโดยใช้ ThreadPool"""
-        results = []
-        futures = []
-        
-        # สร้าง future สำหรับแต่ละงาน
-        for task in tasks:
-            task_params = task.copy() # สร้าง copy เพื่อไม่ให้กระทบ task เดิม
-            task_params['use_cache'] = use_cache
-            
-            # ตรวจสอบ cache ก่อนส่งงาน
-            if use_cache:
-                cached_result = cache_manager.get(task_params)
-                if cached_result:
-                    logger.info(f"ใช้ผลลัพธ์จาก cache สำหรับงาน batch: {task_params['prompt']}")
-                    results.append({
-                        'task': task,
-                        'success': True,
-                        'result': cached_result,
-                    })
-                    if status_callback:
-                        status_callback(len(results), 0, len(tasks)) # อัพเดตสถานะทันที
-                    continue # ไปงานถัดไป
-
-            # ถ้าไม่มี cache ให้ส่งงานไปสร้าง
-            future = self.thread_pool.submit(
-                self._generate_music,
-                **task_params
-            )
-            futures.append((future, task))
-        
-        # รอผลลัพธ์และอัพเดตสถานะ
-        completed = len(results) # นับจาก cache
-        failed = 0
+                      use_cache: bool = True,
+                      priority: int = PRIORITY_BATCH,
+                      progress_callback=None,
+                      cancel_token: Optional[CancellationToken] = None) -> List[Dict[str, Any]]:
+        """สร้างเพลงหลายเพลงพร้อมกัน
+        งานทั้งหมดถูกส่งเข้าคิวเดียวกับ queue_music_generation เพื่อให้ scheduler
+        รวมเป็น batch แล้วรอจนทุกงานเสร็จ คืนค่าผลลัพธ์ตามลำดับของ tasks
+        ถ้าคิวเต็มจะรอจนมีที่ว่าง (backpressure)
+        cancel_token ยกเลิกทุกงานในชุดนี้ที่ยังไม่เสร็จ"""
         total = len(tasks)
+        results: List[Optional[Dict[str, Any]]] = [None] * total
+        if total == 0:
+            return []
+            
+        if not self.is_ready:
+            return [
+                {'task': task, 'success': False, 'error': "โมเดลยังไม่พร้อม กรุณารอให้โหลดเสร็จก่อน"}
+                for task in tasks
+            ]
+            
+        all_done = Event()
+        lock = Lock()
+        counts = {'completed': 0, 'failed': 0}
         
-        for future, task in futures:
-            try:
-                result = future.result()
-                results.append({
-                    'task': task,
-                    'success': True,
-                    'result': result,
-                })
-                completed += 1
-                
-                # เก็บลง cache
-                if use_cache:
-                    cache_manager.set(task, result)
+        def _make_callback(index: int, task: Dict[str, Any]):
+            def _on_result(success, result):
+                with lock:
+                    if success:
+                        results[index] = {'task': task, 'success': True, 'result': result}
+                        counts['completed'] += 1
+                    else:
+                        logger.error(f"เกิดข้อผิดพลาดในการสร้างเพลง {task['prompt']}: {result}")
+                        results[index] = {'task': task, 'success': False, 'error': result}
+                        counts['failed'] += 1
+                    completed, failed = counts['completed'], counts['failed']
                     
-            except Exception as e:
-                logger.error(f"เกิดข้อผิดพลาดในการสร้างเพลง {task['prompt']}: {e}")
-                results.append({
-                    'task': task,
-                    'success': False,
-                    'error': str(e)
-                })
-                failed += 1
-                
-            # เรียก callback
-            if status_callback:
-                status_callback(completed, failed, total)
-                
+                # เรียก callback
+                if status_callback:
+                    status_callback(completed, failed, total)
+                    
+                if completed + failed == total:
+                    all_done.set()
+            return _on_result
+        
+        # ส่งทุกงานเข้าคิว เพื่อให้ถูกรวมเป็น batch (รอถ้าคิวเต็ม)
+        for index, task in enumerate(tasks):
+            params = {
+                "prompt": task['prompt'],
+                "duration": task['duration'],
+                "instruments": task['instruments'],
+                "mood": task['mood']
+            }
+            quality = task.get('quality', DEFAULT_QUALITY)
+            if quality not in QUALITY_TIERS:
+                _make_callback(index, task)(False, f"ไม่รู้จักระดับคุณภาพ {quality}")
+                continue
+            if quality != DEFAULT_QUALITY:
+                params["quality"] = quality
+            self._generation_queue.put(
+                GenerationRequest(
+                    params, _make_callback(index, task), use_cache, priority, progress_callback, cancel_token
+                ),
+                block=True
+            )
+            
+        # รอผลลัพธ์ทั้งหมด
+        all_done.wait()
         return results
     
     def _generate_music(self, 
@@ -294,13 +807,23 @@ class MusicGenerator:
                        duration: int,
                        instruments: List[str],
                        mood: str,
-                       use_cache: bool = True # เพิ่ม parameter นี้แต่ไม่ได้ใช้โดยตรงในฟังก์ชันนี้
+                       use_cache: bool = True, # เพิ่ม parameter นี้แต่ไม่ได้ใช้โดยตรงในฟังก์ชันนี้
+                       progress_callback=None,
+                       interrupt: Optional[GenerationInterrupt] = None,
+                       quality: Optional[str] = None,
+                       segment_duration: Optional[int] = None,
+                       prefix: Optional[Dict[str, Any]] = None
                        ) -> Dict[str, Any]:
         """สร้างเพลงตามพารามิเตอร์ที่กำหนด
+        interrupt ใช้หยุดระหว่างสร้าง (ยกเลิก) หรือพักเพลงยาวเพื่อสร้างตัวอย่างเพลงก่อน
+        quality เลือกขนาดโมเดล (ดู QUALITY_TIERS) None = DEFAULT_QUALITY
+        segment_duration บังคับสร้างแบบแบ่งช่วงด้วยความยาวนี้ (โหมดประหยัดหน่วยความจำของ admission control)
+        prefix คือเพลงเดียวกันที่สั้นกว่าจาก cache (ดู _cached_prefix) สร้างต่อจากเพลงนั้นเฉพาะส่วนที่ขาด
         คืนค่า dictionary ที่มีข้อมูลเพลงและ metadata"""
         
         logger.info(f"เริ่มสร้างเพลง: {prompt}")
         start_time = time.time()
+        self._use_model(quality)
         
         # ปรับแต่ง prompt
         enhanced_prompt = self._enhance_prompt(prompt, instruments, mood)
@@ -309,43 +832,147 @@ class MusicGenerator:
         # ตรวจสอบและปรับความยาว
         max_seconds = min(duration, MAX_DURATION)
         
-        # สร้าง inputs จาก prompt
-        inputs = self.processor(
-            text=[enhanced_prompt],
-            padding=True,
-            return_tensors="pt",
-        )
-        
         # กำหนด generation parameters จาก settings
         generation_kwargs = GENERATION_CONFIG.copy()
-        generation_kwargs["max_new_tokens"] = max_seconds * generation_kwargs.pop("max_new_tokens_per_sec", 50)
-        
-        # สร้างเพลง
-        context = torch.autocast(device_type=self.device, dtype=torch.float16) if MIXED_PRECISION and self.device == "cuda" else torch.no_grad()
-        with context:
-            audio_values = self.model.generate(
-                **inputs.to(self.device),
-                **generation_kwargs
-            )
+        tokens_per_sec = generation_kwargs.pop("max_new_tokens_per_sec", 50)
         
-        # แปลงเป็น numpy array
-        audio_data = audio_values[0, 0].cpu().numpy()
+        segmented = SEGMENTED_GENERATION or segment_duration is not None
+        segment_duration = segment_duration or SEGMENT_DURATION
+        if prefix is not None or (segmented and max_seconds > segment_duration):
+            # เพลงยาว: สร้างทีละช่วงเพื่อให้หน่วยความจำคงที่ (การสร้างต่อจาก prefix ใช้วิธีเดียวกับช่วงถัดไป)
+            start_seconds = 0
+            if prefix is not None:
+                start_seconds = len(prefix['audio_data']) / self.model.config.audio_encoder.sampling_rate
+            progress = GenerationProgress(
+                self._planned_segment_tokens(max_seconds, tokens_per_sec, segment_duration, start_seconds),
+                progress_callback
+            )
+            audio_data, segment_count, codes = self._generate_segmented(
+                enhanced_prompt, max_seconds, generation_kwargs, tokens_per_sec, progress, interrupt,
+                segment_duration, prefix
+            )
+            generation_kwargs["segment_duration"] = segment_duration
+            generation_kwargs["segment_context"] = SEGMENT_CONTEXT
+            generation_kwargs["segments"] = segment_count
+            if prefix is not None:
+                generation_kwargs["prefix_duration"] = prefix['duration']
+        else:
+            generation_kwargs["max_new_tokens"] = max_seconds * tokens_per_sec
+            progress = GenerationProgress(generation_kwargs["max_new_tokens"], progress_callback)
+            
+            # สร้าง inputs จาก prompt (ใช้ผลลัพธ์ text encoder จาก cache ถ้ามี)
+            inputs = self._encode_text([enhanced_prompt], generation_kwargs)
+            
+            # สร้างเพลง (เก็บ EnCodec codes ไว้ให้ cache ด้วย)
+            captured_codes = []
+            audio_values = self._run_generate(inputs, generation_kwargs, progress, interrupt, captured_codes)
+            
+            # แปลงเป็น numpy array
+            audio_data = audio_values[0, 0].cpu().numpy()
+            codes = self._build_codes(
+                [self._segment_codes(captured_codes, 0, end=len(audio_data))], len(audio_data), len(audio_data)
+            )
         
         # คำนวณเวลาที่ใช้
+        progress.finish()
         generation_time = time.time() - start_time
-        logger.info(f"สร้างเพลงเสร็จแล้ว ใช้เวลา {generation_time:.2f} วินาที")
+        logger.info(
+            f"สร้างเพลงเสร็จแล้ว ใช้เวลา {generation_time:.2f} วินาที "
+            f"({progress.tokens / generation_time:.1f} tokens/วินาที)"
+        )
         
         # เรียกให้ทำความสะอาดพื้นที่ถ้าจำเป็น
         clean_old_files()
         
-        # สร้าง metadata
+        result = self._build_result(
+            prompt, instruments, mood, enhanced_prompt,
+            audio_data, generation_time, generation_kwargs, codes
+        )
+        if interrupt is not None and interrupt.cancelled:
+            result['metadata']['cancelled'] = True
+            partial_seconds = len(audio_data) / self.model.config.audio_encoder.sampling_rate
+            logger.info(f"การสร้างเพลงถูกยกเลิก ได้เสียง {partial_seconds:.1f} วินาที")
+        return result
+    
+    def _generate_music_batch(self,
+                              params_list: List[Dict[str, Any]],
+                              progress_callback=None,
+                              interrupt: Optional[GenerationInterrupt] = None,
+                              segment_duration: Optional[int] = None) -> List[Dict[str, Any]]:
+        """สร้างเพลงหลายคำขอด้วย model.generate ครั้งเดียว
+        คำขอใน batch ต้องมี _batch_key เดียวกัน (ดู GenerationQueue)
+        segment_duration ใช้กับคำขอเดี่ยวเท่านั้น (ดู _generate_music)
+        คืนค่าผลลัพธ์ตามลำดับของ params_list"""
+        if len(params_list) == 1:
+            return [self._generate_music(
+                **params_list[0], progress_callback=progress_callback, interrupt=interrupt,
+                segment_duration=segment_duration
+            )]
+            
+        logger.info(f"เริ่มสร้างเพลงแบบ batch จำนวน {len(params_list)} เพลง")
+        start_time = time.time()
+        # ทุกคำขอใน batch ใช้โมเดลเดียวกัน (ระดับคุณภาพเป็นส่วนหนึ่งของ _batch_key)
+        self._use_model(params_list[0].get('quality'))
+        
+        # ปรับแต่ง prompt ของแต่ละคำขอ
+        enhanced_prompts = [
+            self._enhance_prompt(params['prompt'], params['instruments'], params['mood'])
+            for params in params_list
+        ]
+        durations = [min(params['duration'], MAX_DURATION) for params in params_list]
+        
+        # สร้างตามความยาวของคำขอที่ยาวที่สุด แล้วตัดแต่ละแถวตามความยาวที่ขอ
+        generation_kwargs = GENERATION_CONFIG.copy()
+        tokens_per_sec = generation_kwargs.pop("max_new_tokens_per_sec", 50)
+        generation_kwargs["max_new_tokens"] = max(durations) * tokens_per_sec
+        progress = GenerationProgress(generation_kwargs["max_new_tokens"], progress_callback)
+        
+        inputs = self._encode_text(enhanced_prompts, generation_kwargs)
+        captured_codes = []
+        audio_values = self._run_generate(inputs, generation_kwargs, progress, interrupt, captured_codes)
+        progress.finish()
+        
+        generation_time = time.time() - start_time
+        logger.info(f"สร้างเพลงแบบ batch เสร็จแล้ว ใช้เวลา {generation_time:.2f} วินาที")
+        
+        clean_old_files()
+        
+        generation_kwargs["batch_size"] = len(params_list)
+        model_rate = self.model.config.audio_encoder.sampling_rate
+        results = []
+        for i, params in enumerate(params_list):
+            audio_data = audio_values[i, 0, :int(durations[i] * model_rate)].cpu().numpy()
+            codes = self._build_codes(
+                [self._segment_codes(captured_codes, i, end=len(audio_data))], len(audio_data), len(audio_data)
+            )
+            results.append(self._build_result(
+                params['prompt'], params['instruments'], params['mood'], enhanced_prompts[i],
+                audio_data, generation_time, generation_kwargs.copy(), codes
+            ))
+            if interrupt is not None and interrupt.cancelled:
+                results[-1]['metadata']['cancelled'] = True
+        return results
+    
+    def _build_result(self,
+                      prompt: str,
+                      instruments: List[str],
+                      mood: str,
+                      enhanced_prompt: str,
+                      audio_data: np.ndarray,
+                      generation_time: float,
+                      generation_kwargs: Dict[str, Any],
+                      codes: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """รวมข้อมูลเสียงกับ metadata เป็นผลลัพธ์ของการสร้างเพลง
+        codes คือ EnCodec codes ที่ถอดรหัสเป็นเสียงนี้ได้ (ดู _build_codes) ใช้เก็บใน cache แทนเสียง"""
+        # สร้าง metadata (เสียงมี sample rate ของ EnCodec ไม่ใช่ SAMPLE_RATE)
+        model_rate = self._output_rate()
         metadata = {
             "prompt": prompt,
             "enhanced_prompt": enhanced_prompt,
-            "duration": len(audio_data) / SAMPLE_RATE,
+            "duration": len(audio_data) / model_rate,
             "instruments": instruments,
             "mood": mood,
-            "sample_rate": SAMPLE_RATE,
+            "sample_rate": model_rate,
             "generation_time": generation_time,
             "model": self.model_name,
             "timestamp": time.time(),
@@ -353,11 +980,462 @@ class MusicGenerator:
         }
         
         # คืนค่าทั้งข้อมูลเสียงและ metadata
+        result = {
+            "audio_data": audio_data,
+            "metadata": metadata
+        }
+        if codes is not None:
+            result["codes"] = codes
+        return result
+    
+    def _output_rate(self) -> int:
+        """sample rate ของเสียงที่โมเดลสร้าง (EnCodec 32 kHz ในทุกขนาดของ MusicGen)
+        process หลักของ worker pool ไม่ได้โหลดโมเดล จึงใช้ค่าที่ worker รายงานตอนเริ่ม (self.sample_rate)"""
+        model = self.model
+        if model is not None:
+            return model.config.audio_encoder.sampling_rate
+        return self.sample_rate
+    
+    @staticmethod
+    def _segment_codes(captured: List[Dict[str, Any]],
+                       row: int,
+                       position: int = 0,
+                       prompt_samples: int = 0,
+                       end: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """codes ของแถว row จากการถอดรหัสครั้งล่าสุดที่ _run_generate เก็บไว้ พร้อมตำแหน่งที่ต่อเข้ากับเพลง
+        (end = ตำแหน่งสิ้นสุดของช่วงนี้ในเพลง เสียงที่ถอดรหัสได้เกินจากนี้ถูกตัดทิ้ง)
+        คืนค่า None ถ้าไม่มี codes หรือ EnCodec ใช้ audio scale (ไม่ได้เก็บไว้ จึงถอดรหัสซ้ำไม่ได้)"""
+        if not captured:
+            return None
+        decoded = captured[-1]
+        if any(scale is not None for scale in decoded["scales"] or []):
+            return None
+        return {
+            # ขนาด codebook ของ EnCodec (2048) อยู่ในช่วง int16
+            "codes": decoded["codes"][row].cpu().numpy().astype(np.int16),
+            "position": position,
+            "prompt_samples": prompt_samples,
+            "end": end
+        }
+    
+    @staticmethod
+    def _build_codes(segments: List[Optional[Dict[str, Any]]],
+                     total_samples: int,
+                     length: int,
+                     crossfade_samples: int = 0) -> Optional[Dict[str, Any]]:
+        """รวม codes ของทุกช่วงกับวิธีต่อช่วง (ดู _decode_codes) คืนค่า None ถ้าช่วงใดไม่มี codes"""
+        if not segments or any(segment is None for segment in segments):
+            return None
+        return {
+            "segments": segments,
+            "total_samples": total_samples,
+            "length": length,
+            "crossfade_samples": crossfade_samples
+        }
+    
+    def _cache_decoder(self):
+        """ฟังก์ชันถอดรหัส codes สำหรับ cache หรือ None เมื่อใช้ worker pool
+        (process หลักไม่ได้โหลดโมเดล จึงไม่มี EnCodec: เก็บข้อมูลเสียงใน cache และข้ามรายการที่มีแต่ codes)"""
+        return self._decode_codes if self._worker_pool is None else None
+    
+    def _decode_codes(self, codes: Dict[str, Any]) -> np.ndarray:
+        """ถอดรหัส EnCodec codes (จาก cache) เป็นเสียง แล้วต่อช่วงด้วย _stitch_segment เหมือนตอนสร้าง
+        ทุกขนาดของ MusicGen ใช้ EnCodec 32 kHz ตัวเดียวกัน จึงใช้โมเดลที่โหลดอยู่ได้เสมอ"""
+        audio_data = np.zeros(codes["total_samples"], dtype=np.float32)
+        with self._inference_context():
+            for segment in codes["segments"]:
+                audio_codes = torch.as_tensor(np.asarray(segment["codes"]), dtype=torch.long, device=self.device)
+                audio_values = self.model.audio_encoder.decode(audio_codes[None, None], audio_scales=[None]).audio_values
+                segment_audio = audio_values[0, 0].float().cpu().numpy()
+                if segment.get("end") is not None:
+                    segment_audio = segment_audio[:segment["end"] - segment["position"] + segment["prompt_samples"]]
+                self._stitch_segment(
+                    audio_data, segment["position"], segment_audio,
+                    segment["prompt_samples"], codes["crossfade_samples"]
+                )
+        return audio_data[:codes["length"]]
+    
+    def _run_generate(self,
+                      inputs,
+                      generation_kwargs: Dict[str, Any],
+                      progress: Optional[GenerationProgress] = None,
+                      interrupt: Optional[GenerationInterrupt] = None,
+                      codes_out: Optional[List[Dict[str, Any]]] = None) -> torch.Tensor:
+        """สร้างเสียงหนึ่งครั้งด้วย MusicGenSampler (หรือ model.generate ถ้าปิด FUSED_SAMPLER)
+        พร้อม context ที่เหมาะกับ device
+        progress และ interrupt ถูกเรียกทุก token ผ่าน stopping_criteria
+        (รายงานความคืบหน้า / หยุดเมื่อถูกยกเลิกหรือแทรกงาน โดยคืนเสียงเท่าที่สร้างได้)
+        codes_out (ถ้าส่งมา) ได้รับ codes (batch, codebook, frame) และ scales ที่ส่งให้ EnCodec ถอดรหัส"""
+        extra_kwargs = {}
+        criteria = [criterion for criterion in (progress, interrupt, self._thread_lease) if criterion is not None]
+        if criteria and not self.fused_sampler:
+            from transformers import StoppingCriteriaList
+            extra_kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+        if not self.fused_sampler and generation_kwargs.get("repetition_penalty", 1.0) != 1.0:
+            # repetition penalty ของ transformers ใช้ padding ของ delay pattern (id เท่ากับขนาด vocab)
+            # เป็น index จึงใช้กับ MusicGen ไม่ได้ (รองรับเฉพาะ MusicGenSampler)
+            generation_kwargs = {k: v for k, v in generation_kwargs.items() if k != "repetition_penalty"}
+            
+        inputs = {
+            key: value.to(self.device) if isinstance(value, torch.Tensor) else value
+            for key, value in inputs.items()
+        }
+        if self.kv_cache is not None:
+            self.kv_cache.reserve(generation_kwargs["max_new_tokens"])
+        if interrupt is not None:
+            # ปิด delay pattern ที่ตำแหน่งที่หยุด ก่อน generate ถอดรหัสผลลัพธ์เป็นเสียง
+            decoder = self.model.decoder
+            apply_delay_pattern_mask = decoder.apply_delay_pattern_mask
+            interrupt.start(decoder.num_codebooks, self.model.generation_config.pad_token_id)
+            
+            def _apply_and_close(input_ids, pattern_mask):
+                return interrupt.close_pattern(apply_delay_pattern_mask(input_ids, pattern_mask))
+            decoder.apply_delay_pattern_mask = _apply_and_close
+        if codes_out is not None:
+            # เก็บ codes ที่ถูกส่งให้ EnCodec (ตัด padding ของ delay pattern แล้ว) สำหรับ cache
+            audio_encoder = self.model.audio_encoder
+            decode = audio_encoder.decode
+            
+            def _keep_and_decode(audio_codes, *args, **kwargs):
+                scales = kwargs.get("audio_scales", args[0] if args else None)
+                codes_out.append({"codes": audio_codes[0], "scales": scales})
+                return decode(audio_codes, *args, **kwargs)
+            audio_encoder.decode = _keep_and_decode
+            
+        try:
+            with self._inference_context():
+                if self.fused_sampler:
+                    return MusicGenSampler(self.model).generate(inputs, generation_kwargs, criteria)
+                return self.model.generate(
+                    **inputs,
+                    **generation_kwargs,
+                    **extra_kwargs
+                )
+        finally:
+            if self.kv_cache is not None:
+                self.kv_cache.release()
+            if interrupt is not None:
+                del decoder.apply_delay_pattern_mask
+            if codes_out is not None:
+                del audio_encoder.decode
+    
+    def _inference_context(self):
+        """context สำหรับรันโมเดล: autocast fp16 บน CUDA เมื่อเปิด mixed precision ไม่เช่นนั้น no_grad"""
+        if MIXED_PRECISION and self.device == "cuda":
+            return torch.autocast(device_type=self.device, dtype=torch.float16)
+        return torch.no_grad()
+    
+    def _encode_text(self,
+                     enhanced_prompts: List[str],
+                     generation_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """เข้ารหัส prompt ด้วย text encoder โดยใช้ผลลัพธ์จาก cache ถ้ามี
+        คืนค่า input_ids, attention_mask และ encoder_outputs สำหรับ model.generate
+        (generate จะข้าม text encoder เมื่อได้รับ encoder_outputs)
+        
+        เมื่อใช้ classifier-free guidance (guidance_scale > 1) จะต่อ branch ที่ไม่มีเงื่อนไข
+        (hidden states และ mask เป็นศูนย์ เหมือนที่ MusicGen ทำใน generate) ไว้ท้าย batch"""
+        from transformers.modeling_outputs import BaseModelOutput
+        
+        entries = [self._text_cache.get((self.model_name, prompt)) for prompt in enhanced_prompts]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            text_inputs = self.processor(
+                text=[enhanced_prompts[i] for i in missing],
+                padding=True,
+                return_tensors="pt",
+            )
+            input_ids = text_inputs["input_ids"].to(self.device)
+            attention_mask = text_inputs["attention_mask"].to(self.device)
+            with self._inference_context():
+                hidden_states = self.model.text_encoder(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    return_dict=True
+                ).last_hidden_state
+            
+            # เก็บแต่ละ prompt แยกกันโดยตัด padding ด้านขวาออก
+            for row, i in enumerate(missing):
+                length = int(attention_mask[row].sum())
+                entries[i] = {
+                    "input_ids": input_ids[row, :length],
+                    "attention_mask": attention_mask[row, :length],
+                    "hidden_states": hidden_states[row, :length]
+                }
+                self._text_cache.put((self.model_name, enhanced_prompts[i]), entries[i])
+        
+        # รวมเป็น batch โดยเติม padding ด้านขวาให้ยาวเท่ากัน
+        max_length = max(entry["input_ids"].shape[0] for entry in entries)
+        pad_token_id = self.model.config.text_encoder.pad_token_id or 0
+        
+        def _stack(name: str, value) -> torch.Tensor:
+            padded = []
+            for entry in entries:
+                tensor = entry[name]
+                padding = [0, 0] * (tensor.dim() - 1) + [0, max_length - tensor.shape[0]]
+                padded.append(torch.nn.functional.pad(tensor, padding, value=value))
+            return torch.stack(padded)
+        
+        input_ids = _stack("input_ids", pad_token_id)
+        attention_mask = _stack("attention_mask", 0)
+        hidden_states = _stack("hidden_states", 0.0)
+        
+        guidance_scale = generation_kwargs.get("guidance_scale", self.model.generation_config.guidance_scale)
+        if guidance_scale is not None and guidance_scale > 1:
+            hidden_states = torch.cat([hidden_states, torch.zeros_like(hidden_states)], dim=0)
+            attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=0)
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "encoder_outputs": BaseModelOutput(last_hidden_state=hidden_states)
+        }
+    
+    def _cache_params(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """คีย์ cache ของคำขอ (ดู request_fingerprint) ใช้ทั้งตอนค้นหาและตอนบันทึก"""
+        model_name = f"facebook/musicgen-{self._model_size_for(params.get('quality'))}"
+        return request_fingerprint(params, model_name, self.quantization)
+    
+    def _count_cache_lookup(self, params: Dict[str, Any], cached_result: Optional[Dict[str, Any]]):
+        """นับ hit/miss ของ cache ผลลัพธ์ hit ที่คำขอเดิมที่บันทึกไว้เขียนต่างจากคำขอนี้
+        (ตัวพิมพ์, ช่องว่าง, ลำดับเครื่องดนตรี) จะไม่เจอถ้าใช้พารามิเตอร์ดิบเป็นคีย์"""
+        self._cache_lookups["lookups"] += 1
+        if not cached_result:
+            return
+        self._cache_lookups["hits"] += 1
+        metadata = cached_result['metadata']
+        stored = (metadata.get('prompt'), list(metadata.get('instruments', [])), metadata.get('mood'))
+        if stored != (params['prompt'], list(params['instruments']), params['mood']):
+            self._cache_lookups["normalized_hits"] += 1
+    
+    def _cached_prefix(self, request: GenerationRequest) -> Optional[Dict[str, Any]]:
+        """ค้นหาเพลงใน cache ที่ต่างจากคำขอแค่ความยาว (ดู prefix_family)
+        ถ้ามีเพลงที่ยาวกว่า คืนค่าส่วนต้นของเพลงนั้นเป็นผลลัพธ์ของคำขอ
+        ถ้ามีแต่เพลงที่สั้นกว่า เก็บไว้ใน request.prefix ให้สร้างต่อเฉพาะส่วนที่ขาด แล้วคืนค่า None"""
+        request.prefix = None
+        fingerprint = self._cache_params(request.params)
+        cached = cache_manager.get_prefix(
+            prefix_family(fingerprint), fingerprint['duration'], decode=self._cache_decoder()
+        )
+        if cached is None:
+            return None
+        if cached['duration'] > fingerprint['duration']:
+            self._cache_lookups["prefix_hits"] += 1
+            return self._slice_prefix(cached, fingerprint['duration'])
+            
+        self._cache_lookups["resumed"] += 1
+        logger.info(f"พบเพลงเดียวกันยาว {cached['duration']} วินาทีใน cache จะสร้างต่อเฉพาะส่วนที่ขาด")
+        request.prefix = {
+            "audio_data": np.asarray(cached['audio_data'], dtype=np.float32),
+            "codes": cached.get('codes'),
+            "duration": cached['duration']
+        }
+        return None
+    
+    def _slice_prefix(self, cached: Dict[str, Any], duration: float) -> Dict[str, Any]:
+        """ส่วนต้นยาว duration วินาทีของเพลงที่ยาวกว่าใน cache พร้อม fade out ตรงรอยตัด"""
+        model_rate = self._output_rate()
+        audio_data = np.array(cached['audio_data'][:int(duration * model_rate)], dtype=np.float32)
+        fade = min(int(CACHE_PREFIX_FADE * model_rate), len(audio_data))
+        if fade > 0:
+            audio_data[-fade:] *= np.linspace(1.0, 0.0, fade, dtype=np.float32)
+        metadata = {
+            **cached['metadata'],
+            "duration": len(audio_data) / model_rate,
+            "sample_rate": model_rate,
+            "prefix_of": cached['duration']
+        }
         return {
             "audio_data": audio_data,
             "metadata": metadata
         }
     
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """สถิติของ cache ผลลัพธ์ พร้อมอัตรา hit เทียบกับการใช้พารามิเตอร์ดิบเป็นคีย์"""
+        stats = cache_manager.get_stats()
+        lookups = dict(self._cache_lookups)
+        total = lookups["lookups"]
+        stats.update(lookups)
+        stats["hit_rate"] = lookups["hits"] / total if total else 0.0
+        stats["raw_key_hit_rate"] = (lookups["hits"] - lookups["normalized_hits"]) / total if total else 0.0
+        return stats
+    
+    def get_text_cache_stats(self) -> Dict[str, Any]:
+        """สถิติของ cache ผลลัพธ์ text encoder (entries, size_mb, hits, misses, hit_rate)"""
+        return self._text_cache.get_stats()
+    
+    def _generate_segmented(self,
+                            enhanced_prompt: str,
+                            total_seconds: int,
+                            generation_kwargs: Dict[str, Any],
+                            tokens_per_sec: int,
+                            progress: Optional[GenerationProgress] = None,
+                            interrupt: Optional[GenerationInterrupt] = None,
+                            segment_duration: int = SEGMENT_DURATION,
+                            prefix: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, int, Optional[Dict[str, Any]]]:
+        """สร้างเพลงยาวทีละช่วง (segment) ยาวช่วงละ segment_duration วินาที
+        แต่ละช่วงใช้เสียงท้ายของช่วงก่อนหน้าเป็น audio prompt แล้วต่อกันด้วย crossfade
+        
+        ถ้าถูกแทรกงานระหว่างช่วง (interrupt.preempted) จะเก็บเสียงส่วนที่สร้างแล้ว
+        สร้างตัวอย่างเพลงที่รออยู่ แล้วสร้างต่อจากตำแหน่งเดิมโดยใช้เสียงท้ายเป็น audio prompt
+        ถ้าถูกยกเลิกจะคืนเสียงเท่าที่สร้างได้
+        prefix (เพลงที่สั้นกว่าจาก cache) ถูกใช้เป็นเสียงส่วนต้น แล้วสร้างต่อจากท้ายเพลงนั้น
+        โดยช่วงแรกใช้ codes ท้ายเพลงเป็น audio prompt โดยตรงถ้ามี (ไม่ต้องเข้ารหัสเสียงใหม่)
+        คืนค่า (ข้อมูลเสียง, จำนวนช่วงที่สร้าง, codes ของทุกช่วงสำหรับ cache หรือ None)"""
+        audio_config = self.model.config.audio_encoder
+        model_rate = audio_config.sampling_rate
+        hop_length = model_rate // audio_config.frame_rate
+        num_codebooks = self.model.decoder.num_codebooks
+        
+        # ปัดความยาว context ให้ลงตัวกับ frame ของ EnCodec เพื่อให้ตำแหน่งเสียงใหม่ใน output แม่นยำ
+        context_samples = int(SEGMENT_CONTEXT * model_rate) // hop_length * hop_length
+        crossfade_samples = min(int(SEGMENT_CROSSFADE * model_rate), context_samples)
+        
+        # จอง buffer สำหรับเสียงทั้งเพลงไว้ล่วงหน้า ไม่ต้องต่อ array ใหม่ทุกช่วง
+        total_samples = int(total_seconds * model_rate)
+        audio_data = np.zeros(total_samples, dtype=np.float32)
+        written = 0
+        segment_count = 0
+        segment_codes = []
+        prompt_codes = None
+        if prefix is not None:
+            written = min(len(prefix['audio_data']), total_samples)
+            audio_data[:written] = prefix['audio_data'][:written]
+            segment_codes = list(prefix['codes']['segments']) if prefix.get('codes') else [None]
+            prompt_codes = self._tail_codes(
+                prefix.get('codes'), written, min(context_samples, written // hop_length * hop_length), hop_length
+            )
+        
+        # ทุกช่วงใช้ text prompt เดียวกัน จึงเข้ารหัสครั้งเดียว
+        text_inputs = self._encode_text([enhanced_prompt], generation_kwargs)
+        
+        while written < total_samples:
+            if written == 0:
+                # ช่วงแรก: สร้างจาก text prompt อย่างเดียว
+                prompt_samples = 0
+                segment_seconds = segment_duration
+                inputs = dict(text_inputs)
+            else:
+                # ช่วงถัดไป: ใช้เสียงท้ายของช่วงก่อนหน้าเป็น audio prompt
+                prompt_samples = min(context_samples, written // hop_length * hop_length)
+                segment_seconds = segment_duration - SEGMENT_CONTEXT
+                inputs = dict(text_inputs)
+                if prompt_codes is not None:
+                    inputs["decoder_input_ids"] = torch.as_tensor(prompt_codes, dtype=torch.long)
+                    prompt_codes = None
+                else:
+                    inputs.update(self.processor(
+                        audio=audio_data[written - prompt_samples:written],
+                        sampling_rate=model_rate,
+                        return_tensors="pt",
+                    ))
+                
+            remaining_seconds = (total_samples - written) / model_rate
+            new_seconds = min(segment_seconds, remaining_seconds)
+            
+            # ชดเชย token ที่เสียไปกับ delay pattern ของ codebook
+            segment_kwargs = generation_kwargs.copy()
+            segment_kwargs["max_new_tokens"] = int(math.ceil(new_seconds * tokens_per_sec)) + num_codebooks - 1
+            
+            logger.info(
+                f"กำลังสร้างช่วงที่ {segment_count + 1} "
+                f"({written / model_rate:.1f}/{total_seconds} วินาที)"
+            )
+            captured_codes = []
+            audio_values = self._run_generate(inputs, segment_kwargs, progress, interrupt, captured_codes)
+            segment_audio = audio_values[0, 0].float().cpu().numpy()
+            segment_codes.append(self._segment_codes(captured_codes, 0, written, prompt_samples))
+            del audio_values, inputs, captured_codes
+            
+            new_written = self._stitch_segment(
+                audio_data, written, segment_audio, prompt_samples, crossfade_samples
+            )
+            stopped = interrupt is not None and (interrupt.cancelled or interrupt.preempted)
+            if new_written <= written and not stopped:
+                raise RuntimeError("โมเดลไม่ได้สร้างเสียงใหม่ในช่วงนี้ หยุดการสร้างเพื่อป้องกันการวนซ้ำไม่สิ้นสุด")
+            written = max(written, new_written)
+            segment_count += 1
+            if segment_codes[-1] is not None:
+                segment_codes[-1]["end"] = written
+            
+            if interrupt is not None and interrupt.cancelled:
+                break
+                
+            if interrupt is not None and interrupt.preempted:
+                logger.info(f"พักการสร้างเพลงยาวที่ {written / model_rate:.1f} วินาที เพื่อสร้างตัวอย่างเพลงที่รออยู่")
+                self._serve_preemption()
+                interrupt.resume()
+                logger.info("สร้างเพลงยาวต่อจากตำแหน่งเดิม")
+            
+            # คืนหน่วยความจำของช่วงที่เสร็จแล้ว
+            if self.device == "cuda":
+                torch.cuda.empty_cache()
+                
+        codes = self._build_codes(segment_codes, total_samples, written, crossfade_samples)
+        return audio_data[:written], segment_count, codes
+    
+    def _planned_segment_tokens(self, total_seconds: int, tokens_per_sec: int,
+                                segment_duration: int = SEGMENT_DURATION,
+                                start_seconds: float = 0) -> int:
+        """ประมาณจำนวน token ทั้งหมดที่ _generate_segmented จะสร้าง (ใช้คำนวณความคืบหน้า)
+        start_seconds = ความยาวของ prefix ที่สร้างต่อ (ทุกช่วงเป็นช่วงถัดไป)"""
+        delay_tokens = self.model.decoder.num_codebooks - 1
+        if start_seconds > 0:
+            planned = 0
+            remaining_seconds = total_seconds - start_seconds
+        else:
+            first_seconds = min(segment_duration, total_seconds)
+            planned = int(math.ceil(first_seconds * tokens_per_sec)) + delay_tokens
+            remaining_seconds = total_seconds - first_seconds
+        
+        step_seconds = segment_duration - SEGMENT_CONTEXT
+        while remaining_seconds > 0:
+            new_seconds = min(step_seconds, remaining_seconds)
+            planned += int(math.ceil(new_seconds * tokens_per_sec)) + delay_tokens
+            remaining_seconds -= new_seconds
+        return planned
+    
+    @staticmethod
+    def _tail_codes(codes: Optional[Dict[str, Any]],
+                    end: int,
+                    prompt_samples: int,
+                    hop_length: int) -> Optional[np.ndarray]:
+        """codes (codebook, frame) ของเสียงช่วง [end - prompt_samples, end) จากช่วงสุดท้ายของ codes
+        คืนค่า None ถ้าไม่มี codes หรือช่วงนั้นไม่ตรงกับ frame ของ EnCodec"""
+        if not codes or prompt_samples <= 0:
+            return None
+        segment = codes['segments'][-1]
+        stop = end - segment['position'] + segment['prompt_samples']
+        start = stop - prompt_samples
+        if start < 0 or start % hop_length or stop % hop_length or stop // hop_length > segment['codes'].shape[-1]:
+            return None
+        return np.asarray(segment['codes'][:, start // hop_length:stop // hop_length])
+    
+    @staticmethod
+    def _stitch_segment(buffer: np.ndarray,
+                        position: int,
+                        segment_audio: np.ndarray,
+                        prompt_samples: int,
+                        crossfade_samples: int) -> int:
+        """ต่อเสียงของช่วงใหม่เข้ากับ buffer ที่ตำแหน่ง position
+        ส่วน prompt ที่โมเดลสร้างซ้ำจะถูกข้ามไป ยกเว้นช่วง crossfade ท้าย prompt
+        คืนค่าตำแหน่งสิ้นสุดใหม่ของเสียงใน buffer"""
+        fade = min(crossfade_samples, prompt_samples, position)
+        chunk = segment_audio[prompt_samples - fade:]
+        
+        # ไม่เขียนเกินขนาด buffer
+        chunk = chunk[:len(buffer) - (position - fade)]
+        if len(chunk) <= fade:
+            return position
+            
+        if fade > 0:
+            ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)
+            overlap = buffer[position - fade:position]
+            buffer[position - fade:position] = overlap * (1.0 - ramp) + chunk[:fade] * ramp
+            
+        end = position - fade + len(chunk)
+        buffer[position:end] = chunk[fade:]
+        return end
+    
     def _enhance_prompt(self, prompt: str, instruments: List[str], mood: str) -> str:
         """ปรับแต่ง prompt โดยเพิ่มเครื่องดนตรีและอารมณ์
         เพื่อให้ได้ผลลัพธ์ที่ดีขึ้น"""
@@ -387,11 +1465,21 @@ class MusicGenerator:
     
     def unload_model(self):
         """ปลดโหลดโมเดลเพื่อประหยัด RAM"""
-        if self.model is not None:
+        if self._worker_pool is not None:
+            logger.info("กำลังปิด worker process...")
+            self._worker_pool.shutdown()
+            self._worker_pool = None
+            self.is_ready = False
+            
+        if self.model is not None or self._registry.resident_sizes():
             logger.info("กำลังปลดโหลดโมเดล...")
+            self.onnx_backend = None
+            self.kv_cache = None
             self.model = None
+            self._registry.clear()
             self.processor = None
             self.is_ready = False
+            self._text_cache.clear()
             
             # บังคับ garbage collection
             gc.collect()
@@ -408,7 +1496,9 @@ def load_ai_model(callback=None):
     """ฟังก์ชันสะดวกสำหรับโหลดโมเดล AI"""
     music_generator.load_model(callback)
     
-def generate_music(prompt, duration, instruments, mood, callback=None, use_cache=True):
+def generate_music(prompt, duration, instruments, mood, callback=None, use_cache=True,
+                   priority=PRIORITY_NORMAL, progress_callback=None, cancel_token=None,
+                   quality=DEFAULT_QUALITY):
     """ฟังก์ชันสะดวกสำหรับสร้างเพลง"""
     return music_generator.queue_music_generation(
         prompt=prompt,
@@ -416,5 +1506,9 @@ def generate_music(prompt, duration, instruments, mood, callback=None, use_cache
         instruments=instruments,
         mood=mood,
         result_callback=callback,
-        use_cache=use_cache
+        use_cache=use_cache,
+        priority=priority,
+        progress_callback=progress_callback,
+        cancel_token=cancel_token,
+        quality=quality
     )
@@ -4,7 +4,6 @@ import numpy as np
 import soundfile as sf
 from pathlib import Path
 from typing import Optional, Dict, Any, Tuple, Union, Literal
-import librosa
 import soundfile as sf
 
 # ดึงการตั้งค่าจาก settings
@@ -13,7 +12,8 @@ from app.config.settings import (
 )
 
 # ใช้ utilities
-from app.core.utilities import logger, generate_filename
+from app.core.utilities import logger, generate_filename, LazySingleton
+from app.core.thread_budget import thread_budget
 
 class AudioManager:
     """คลาสสำหรับจัดการไฟล์เสียงที่สร้างขึ้น"""
@@ -40,12 +40,12 @@ class AudioManager:
         full_filename = f"{filename}.{self.audio_format}"
         file_path = self.output_dir / full_filename
         
-        # บันทึกไฟล์
+        # บันทึกไฟล์ตาม sample rate ของเสียงที่สร้าง (ไม่เช่นนั้นเสียงจะเร็ว/ช้ากว่าจริง)
         logger.info(f"กำลังบันทึกไฟล์เสียงที่ {file_path}")
         sf.write(
             file=file_path,
             data=audio_data,
-            samplerate=self.sample_rate
+            samplerate=metadata.get('sample_rate', self.sample_rate)
         )
         
         # เก็บไฟล์ล่าสุด
@@ -155,16 +155,18 @@ class AudioManager:
             logger.error(f"เกิดข้อผิดพลาดในการลบไฟล์ {file_path}: {e}")
             return False
 
-# สร้าง singleton instance
-audio_manager = AudioManager()
+# สร้าง singleton instance (สร้างจริงเมื่อใช้งานครั้งแรก)
+audio_manager = LazySingleton(AudioManager)
 
 # ฟังก์ชันสะดวกสำหรับการเรียกใช้งานนอกไฟล์นี้
 def save_generated_audio(audio_data: np.ndarray, metadata: Dict[str, Any]) -> Path:
     """บันทึกเสียงที่สร้างขึ้นและคืนค่า Path ของไฟล์"""
-    # ประมวลผลข้อมูลเสียงก่อนบันทึก
-    processed_audio = audio_manager.process_audio(audio_data)
-    # บันทึกไฟล์
-    return audio_manager.save_audio(processed_audio, metadata)
+    # จอง thread ระหว่างประมวลผล เพื่อให้การสร้างเพลงที่ทำอยู่ลด thread ลงแทนการแย่ง core กัน
+    with thread_budget.lease("post_processing", native_threads=True):
+        # ประมวลผลข้อมูลเสียงก่อนบันทึก
+        processed_audio = audio_manager.process_audio(audio_data)
+        # บันทึกไฟล์
+        return audio_manager.save_audio(processed_audio, metadata)
     
 def get_recent_audio_files(count: int = 5) -> list:
     """คืนค่าไฟล์เสียงล่าสุด"""
@@ -204,16 +206,20 @@ def export_audio(input_path: Union[str, Path],
     else:
         output_path = Path(output_path)
         
-    # โหลดไฟล์เสียง
-    logger.info(f"กำลังโหลดไฟล์ {input_path}")
-    audio_data, sr = librosa.load(input_path, sr=sample_rate)
+    # librosa ใช้เวลา import นาน จึงโหลดเมื่อต้องแปลงไฟล์เท่านั้น
+    import librosa
     
-    # บันทึกในฟอร์แมตที่ต้องการ
-    logger.info(f"กำลังบันทึกไฟล์ {output_path}")
-    sf.write(
-        file=output_path,
-        data=audio_data,
-        samplerate=sr if sample_rate is None else sample_rate
-    )
+    with thread_budget.lease("export", native_threads=True):
+        # โหลดไฟล์เสียง
+        logger.info(f"กำลังโหลดไฟล์ {input_path}")
+        audio_data, sr = librosa.load(input_path, sr=sample_rate)
+        
+        # บันทึกในฟอร์แมตที่ต้องการ
+        logger.info(f"กำลังบันทึกไฟล์ {output_path}")
+        sf.write(
+            file=output_path,
+            data=audio_data,
+            samplerate=sr if sample_rate is None else sample_rate
+        )
     
     return output_path
@@ -6,9 +6,10 @@ from queue import Queue
 from threading import Thread, Event
 from datetime import datetime
 
-from app.config.settings import BASE_DIR, OUTPUT_DIR
-from app.core.utilities import logger
-from app.core.ai_engine import generate_music
+from app.config.settings import BASE_DIR, OUTPUT_DIR, MAX_BATCH_SIZE, QUALITY_TIERS
+from app.core.utilities import logger, LazySingleton
+from app.core.ai_engine import music_generator
+from app.core.cancellation import CancellationToken
 from app.core.audio_utils import save_generated_audio
 
 class BatchJob:
@@ -24,10 +25,26 @@ class BatchJob:
         self.failed_tasks = 0
         self.start_time = None
         self.end_time = None
-        self.status = "pending"  # pending, running, completed, failed
+        self.status = "pending"  # pending, running, completed, failed, cancelled
         self.status_callback = status_callback
         self.results = []
         
+        # ใช้ยกเลิกกลุ่มงานที่กำลังสร้าง (ดู BatchGenerator.cancel_current_job)
+        self.cancel_token = CancellationToken()
+        
+        # ความคืบหน้าระดับ token ของกลุ่มงานที่กำลังสร้าง (ดู GenerationProgress)
+        self.progress: Optional[Dict[str, Any]] = None
+        self.current_chunk_size = 0
+        
+    def get_progress_percent(self) -> float:
+        """ความคืบหน้ารวมของงาน (รวมความคืบหน้าของกลุ่มที่กำลังสร้าง)"""
+        if self.total_tasks == 0:
+            return 0.0
+        done = self.completed_tasks + self.failed_tasks
+        if self.status == "running" and self.progress:
+            done += self.current_chunk_size * self.progress['percent'] / 100
+        return min(100.0, done * 100 / self.total_tasks)
+        
     def to_dict(self) -> Dict[str, Any]:
         """แปลงข้อมูลเป็น dict สำหรับบันทึก"""
         return {
@@ -90,12 +107,21 @@ class BatchGenerator:
     def add_job(self, 
                 name: str,
                 tasks: List[Dict[str, Any]],
-                status_callback: Optional[Callable] = None) -> bool:
-        """เพิ่มงานใหม่เข้าคิว"""
+                status_callback: Optional[Callable] = None,
+                quality: Optional[str] = None) -> bool:
+        """เพิ่มงานใหม่เข้าคิว
+        quality เป็นระดับคุณภาพของงานที่ไม่ได้ระบุ 'quality' เอง (เช่น "final" สำหรับงานที่ใช้จริง)
+        None = DEFAULT_QUALITY"""
         # ตรวจสอบรูปแบบข้อมูล
         for task in tasks:
             if not all(k in task for k in ['prompt', 'instruments', 'mood', 'duration']):
                 return False
+            if task.get('quality', quality) not in (None, *QUALITY_TIERS):
+                logger.error(f"ไม่รู้จักระดับคุณภาพ {task.get('quality', quality)} (มี {', '.join(QUALITY_TIERS)})")
+                return False
+                
+        if quality is not None:
+            tasks = [{'quality': quality, **task} for task in tasks]
                 
         # สร้าง BatchJob
         job = BatchJob(name, tasks, status_callback)
@@ -135,40 +161,58 @@ class BatchGenerator:
                 if job.status_callback:
                     job.status_callback(job)
                     
-                # ประมวลผลแต่ละ task
-                for task in job.tasks:
-                    if self.stop_event.is_set():
+                # ประมวลผลทีละกลุ่ม เพื่อให้ engine รวมเป็น batch เดียวกันได้
+                for start in range(0, len(job.tasks), MAX_BATCH_SIZE):
+                    if self.stop_event.is_set() or job.cancel_token.is_cancelled:
                         break
                         
-                    try:
-                        # สร้างเพลง
-                        result = self._generate_music(task)
-                        
-                        # เพิ่มผลลัพธ์
-                        job.results.append({
-                            "task": task,
-                            "success": True,
-                            "output_file": str(result['file_path'])
-                        })
-                        
-                        job.completed_tasks += 1
-                        
-                    except Exception as e:
-                        logger.error(f"เกิดข้อผิดพลาดในการสร้างเพลง: {e}")
-                        job.results.append({
-                            "task": task,
-                            "success": False,
-                            "error": str(e)
-                        })
-                        job.failed_tasks += 1
-                        
+                    chunk = job.tasks[start:start + MAX_BATCH_SIZE]
+                    job.progress = None
+                    job.current_chunk_size = len(chunk)
+                    outcomes = music_generator.generate_batch(
+                        chunk,
+                        progress_callback=lambda info, job=job: setattr(job, 'progress', info),
+                        cancel_token=job.cancel_token
+                    )
+                    job.progress = None
+                    
+                    for outcome in outcomes:
+                        task = outcome['task']
+                        try:
+                            if not outcome['success']:
+                                raise RuntimeError(outcome['error'])
+                                
+                            # บันทึกไฟล์
+                            result = self._save_result(outcome['result'])
+                            
+                            # เพิ่มผลลัพธ์
+                            job.results.append({
+                                "task": task,
+                                "success": True,
+                                "output_file": str(result['file_path'])
+                            })
+                            
+                            job.completed_tasks += 1
+                            
+                        except Exception as e:
+                            logger.error(f"เกิดข้อผิดพลาดในการสร้างเพลง: {e}")
+                            job.results.append({
+                                "task": task,
+                                "success": False,
+                                "error": str(e)
+                            })
+                            job.failed_tasks += 1
+                            
                     # แจ้ง callback
                     if job.status_callback:
                         job.status_callback(job)
                         
                 # จบงาน
                 job.end_time = datetime.now()
-                job.status = "completed" if job.failed_tasks == 0 else "failed"
+                if job.cancel_token.is_cancelled:
+                    job.status = "cancelled"
+                else:
+                    job.status = "completed" if job.failed_tasks == 0 else "failed"
                 
                 # บันทึกข้อมูลงาน
                 self._save_job(job)
@@ -184,16 +228,8 @@ class BatchGenerator:
                 
         self.current_job = None
                 
-    def _generate_music(self, task: Dict[str, Any]) -> Dict[str, Any]:
-        """สร้างเพลงจาก task ที่กำหนด"""
-        # สร้างเพลง
-        music_result = generate_music(
-            prompt=task['prompt'],
-            duration=task['duration'],
-            instruments=task['instruments'],
-            mood=task['mood']
-        )
-        
+    def _save_result(self, music_result: Dict[str, Any]) -> Dict[str, Any]:
+        """บันทึกเพลงที่สร้างเสร็จลงไฟล์"""
         # บันทึกไฟล์
         file_path = save_generated_audio(
             audio_data=music_result['audio_data'],
@@ -205,9 +241,21 @@ class BatchGenerator:
             "metadata": music_result['metadata']
         }
         
+    def cancel_current_job(self, return_partial: bool = False) -> bool:
+        """ยกเลิกงานที่กำลังทำ (กลุ่มที่กำลังสร้างหยุดที่ token ถัดไป และไม่เริ่มกลุ่มถัดไป)
+        return_partial=True จะบันทึกเสียงส่วนที่สร้างไปแล้วของกลุ่มที่กำลังสร้าง"""
+        job = self.current_job
+        if job is None or job.status != "running":
+            return False
+        job.cancel_token.cancel(return_partial)
+        logger.info(f"ยกเลิกงาน batch {job.name}")
+        return True
+        
     def stop(self):
-        """หยุดการทำงาน"""
+        """หยุดการทำงาน (ยกเลิกกลุ่มที่กำลังสร้างเพื่อไม่ต้องรอจนเสร็จ)"""
         self.stop_event.set()
+        if self.current_job:
+            self.current_job.cancel_token.cancel()
         if self.worker_thread:
             self.worker_thread.join()
             self.worker_thread = None
@@ -220,5 +268,5 @@ class BatchGenerator:
         """ดึงจำนวนงานในคิว"""
         return self.job_queue.qsize()
         
-# สร้าง singleton instance
-batch_generator = BatchGenerator()
+# สร้าง singleton instance (สร้างจริงเมื่อใช้งานครั้งแรก)
+batch_generator = LazySingleton(BatchGenerator)
@@ -0,0 +1,251 @@
+import time
+import argparse
+import multiprocessing
+from threading import Thread, Event
+from typing import List, Dict, Any, Optional
+
+import psutil
+
+from app.core.utilities import logger
+
+BENCHMARK_PROMPT = "Piano, calm melody, Calm, high quality, instrumental music"
+
+def _rss_mb() -> float:
+    """หน่วยความจำ RSS ของ process ปัจจุบัน (MB)"""
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+class PeakRSSMonitor:
+    """เก็บค่า RSS สูงสุดระหว่างทำงาน (ตรวจสอบทุก interval วินาทีใน thread แยก)"""
+    
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = _rss_mb()
+        self._stop_event = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+    
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _rss_mb())
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop_event.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_mb())
+
+def _config_label(config: Dict[str, Any]) -> str:
+    """ชื่อสั้น ๆ ของการตั้งค่า เช่น fp32, dynamic_int8, onnx+dynamic_int8, fp32+static_kv"""
+    label = config.get("quantization") or "fp32"
+    if config.get("backend", "torch") != "torch":
+        label = f"{config['backend']}+{label}" if config.get("quantization") else config["backend"]
+    if "static_kv_cache" in config:
+        label += "+static_kv" if config["static_kv_cache"] else "+concat_kv"
+    if "fused_sampler" in config:
+        label += "+fused" if config["fused_sampler"] else "+generate"
+    return label
+
+def _measure(config: Dict[str, Any], seconds: int, prompt: str, results):
+    """โหลดโมเดลตามการตั้งค่า (quantization, backend) แล้ววัดความเร็วและหน่วยความจำ (รันใน process แยก)"""
+    label = _config_label(config)
+    try:
+        from app.core.ai_engine import MusicGenerator
+        
+        generator = MusicGenerator(**config)
+        rss_start = _rss_mb()
+        
+        load_start = time.time()
+        generator._use_model()
+        load_time = time.time() - load_start
+        rss_loaded = _rss_mb()
+        generator.is_ready = True
+        
+        progress = []
+        with PeakRSSMonitor() as monitor:
+            generator._generate_music(prompt, seconds, ["Piano"], "Calm", progress_callback=progress.append)
+        
+        results.put({
+            "quantization": label,
+            "load_time": load_time,
+            "tokens": progress[-1]['tokens'] if progress else 0,
+            "tokens_per_sec": progress[-1]['tokens_per_sec'] if progress else 0.0,
+            "model_rss_mb": rss_loaded - rss_start,
+            "peak_rss_mb": monitor.peak
+        })
+    
+    except Exception as e:
+        results.put({"quantization": label, "error": str(e)})
+
+def _measure_lengths(config: Dict[str, Any], lengths: List[int], prompt: str, results):
+    """โหลดโมเดลครั้งเดียวแล้ววัด tokens/วินาที ของเพลงแต่ละความยาว (รันใน process แยก)"""
+    label = _config_label(config)
+    try:
+        from app.core.ai_engine import MusicGenerator
+        
+        generator = MusicGenerator(**config)
+        generator._use_model()
+        generator.is_ready = True
+        
+        rows = []
+        for seconds in lengths:
+            progress = []
+            generator._generate_music(prompt, seconds, ["Piano"], "Calm", progress_callback=progress.append)
+            rows.append({
+                "seconds": seconds,
+                "tokens": progress[-1]['tokens'] if progress else 0,
+                "tokens_per_sec": progress[-1]['tokens_per_sec'] if progress else 0.0
+            })
+        results.put({"quantization": label, "lengths": rows})
+    
+    except Exception as e:
+        results.put({"quantization": label, "error": str(e)})
+
+def compare_configs(configs: List[Dict[str, Any]],
+                    seconds: int = 5,
+                    prompt: str = BENCHMARK_PROMPT) -> List[Dict[str, Any]]:
+    """เปรียบเทียบ tokens/วินาที และ RSS ของแต่ละการตั้งค่า (อาร์กิวเมนต์ของ MusicGenerator)
+    แต่ละการตั้งค่ารันใน process ใหม่ เพื่อให้ค่า RSS ไม่ปนกับโมเดลของการตั้งค่าอื่น"""
+    context = multiprocessing.get_context("spawn")
+    report = []
+    for config in configs:
+        results = context.Queue()
+        process = context.Process(target=_measure, args=(config, seconds, prompt, results))
+        process.start()
+        result = results.get()
+        process.join()
+        
+        if "error" in result:
+            logger.error(f"วัดผล {result['quantization']} ไม่สำเร็จ: {result['error']}")
+        else:
+            logger.info(
+                f"{result['quantization']}: {result['tokens_per_sec']:.1f} tokens/วินาที, "
+                f"โมเดล {result['model_rss_mb']:.0f} MB, RSS สูงสุด {result['peak_rss_mb']:.0f} MB"
+            )
+        report.append(result)
+    return report
+
+def compare_quantization(modes: List[Optional[str]] = (None, "dynamic_int8"),
+                         seconds: int = 5,
+                         prompt: str = BENCHMARK_PROMPT) -> List[Dict[str, Any]]:
+    """เปรียบเทียบโหมด quantization บน PyTorch backend"""
+    return compare_configs([{"quantization": mode} for mode in modes], seconds, prompt)
+
+def compare_backends(backends: List[str] = ("torch", "onnx"),
+                     seconds: int = 5,
+                     prompt: str = BENCHMARK_PROMPT) -> List[Dict[str, Any]]:
+    """เปรียบเทียบ PyTorch กับ ONNX Runtime (fp32 ทั้งคู่)
+    รันครั้งแรกของ onnx จะรวมเวลา export ไว้ใน load_time"""
+    return compare_configs([{"quantization": None, "backend": backend} for backend in backends], seconds, prompt)
+
+def compare_samplers(seconds: int = 5,
+                     prompt: str = BENCHMARK_PROMPT) -> List[Dict[str, Any]]:
+    """เปรียบเทียบ model.generate ของ transformers กับ MusicGenSampler
+    (model.generate ข้าม repetition penalty เพราะใช้กับ MusicGen ไม่ได้)"""
+    return compare_configs(
+        [{"quantization": None, "fused_sampler": fused} for fused in (False, True)], seconds, prompt
+    )
+
+def compare_kv_cache(lengths: List[int] = (5, 10, 20, 30),
+                     prompt: str = BENCHMARK_PROMPT) -> List[Dict[str, Any]]:
+    """เปรียบเทียบ tokens/วินาที ตามความยาวเพลง ระหว่าง KV cache แบบต่อ tensor (ของ transformers)
+    กับ static KV cache ที่จองไว้ล่วงหน้า (เพลงที่ยาวกว่า SEGMENT_DURATION จะถูกสร้างทีละช่วง)"""
+    context = multiprocessing.get_context("spawn")
+    report = []
+    for static_kv_cache in (False, True):
+        config = {"quantization": None, "static_kv_cache": static_kv_cache}
+        results = context.Queue()
+        process = context.Process(target=_measure_lengths, args=(config, list(lengths), prompt, results))
+        process.start()
+        result = results.get()
+        process.join()
+        
+        if "error" in result:
+            logger.error(f"วัดผล {result['quantization']} ไม่สำเร็จ: {result['error']}")
+        report.append(result)
+    return report
+
+def compare_cache_codecs() -> str:
+    """เปรียบเทียบขนาดไฟล์และเวลา encode/decode ของรูปแบบการเก็บ cache (CACHE_CODEC)
+    กับเพลงล่าสุดใน cache (ต้องสร้างเพลงอย่างน้อยหนึ่งเพลงก่อน)"""
+    import json
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    from app.config.settings import SAMPLE_RATE
+    from app.core.cache_manager import cache_manager
+    from app.core.cache_codec import measure_codecs, format_codec_report
+    
+    entries = sorted(cache_manager.cache_dir.glob("*.meta.json"), key=lambda path: path.stat().st_mtime)
+    # ใช้เพลงล่าสุดที่มีข้อมูลเสียง (รายการที่เก็บแต่ EnCodec codes ต้องถอดรหัสด้วยโมเดลก่อน)
+    for entry in reversed(entries):
+        cache_key = entry.name[:-len(".meta.json")]
+        metadata = json.loads(entry.read_text(encoding='utf-8'))
+        audio_data = cache_manager._read_audio(cache_key, metadata)
+        if audio_data is not None:
+            break
+    else:
+        return "ยังไม่มีเพลงที่เก็บข้อมูลเสียงไว้ใน cache กรุณาสร้างเพลงก่อน"
+    audio_data = np.asarray(audio_data, dtype=np.float32)
+    sample_rate = metadata.get('sample_rate', SAMPLE_RATE)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        report = measure_codecs(audio_data, sample_rate, Path(directory))
+    return format_codec_report(report, len(audio_data) / sample_rate)
+
+def format_length_report(report: List[Dict[str, Any]]) -> str:
+    """แปลงผลการวัดตามความยาวเพลงเป็นตาราง (tokens/วินาที ของแต่ละการตั้งค่า และอัตราเร็วขึ้นเทียบกับคอลัมน์แรก)"""
+    errors = [f"{r['quantization']}: ผิดพลาด: {r['error']}" for r in report if "error" in r]
+    report = [r for r in report if "error" not in r]
+    if not report:
+        return "\n".join(errors)
+    
+    lines = [f"{'วินาที':>8}{'tokens':>10}" + "".join(f"{r['quantization']:>20}" for r in report) + f"{'เร็วขึ้น':>10}"]
+    for i, row in enumerate(report[0]['lengths']):
+        speeds = [r['lengths'][i]['tokens_per_sec'] for r in report]
+        speedup = speeds[-1] / speeds[0] if speeds[0] else 0.0
+        lines.append(
+            f"{row['seconds']:>8}{row['tokens']:>10}" + "".join(f"{speed:>20.1f}" for speed in speeds)
+            + f"{speedup:>9.2f}x"
+        )
+    return "\n".join(lines + errors)
+
+def format_report(report: List[Dict[str, Any]]) -> str:
+    """แปลงผลการเปรียบเทียบเป็นตาราง เทียบกับแถวแรก (ปกติคือ fp32)"""
+    lines = [f"{'โหมด':<14}{'tokens/วินาที':>16}{'โมเดล (MB)':>14}{'RSS สูงสุด (MB)':>18}{'เร็วขึ้น':>10}"]
+    baseline = next((r for r in report if "error" not in r), None)
+    for result in report:
+        if "error" in result:
+            lines.append(f"{result['quantization']:<14}ผิดพลาด: {result['error']}")
+            continue
+        speedup = result['tokens_per_sec'] / baseline['tokens_per_sec'] if baseline['tokens_per_sec'] else 0.0
+        lines.append(
+            f"{result['quantization']:<14}{result['tokens_per_sec']:>16.1f}"
+            f"{result['model_rss_mb']:>14.0f}{result['peak_rss_mb']:>18.0f}{speedup:>9.2f}x"
+        )
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="เปรียบเทียบความเร็วและหน่วยความจำของโหมด quantization, backend, sampler, KV cache หรือรูปแบบการเก็บ cache"
+    )
+    parser.add_argument("--compare", choices=("quantization", "backend", "sampler", "kv_cache", "cache_codec"),
+                        default="quantization")
+    parser.add_argument("--seconds", type=int, default=5, help="ความยาวเพลงที่ใช้ทดสอบ (วินาที)")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[5, 10, 20, 30],
+                        help="ความยาวเพลงที่ใช้ทดสอบ KV cache (วินาที)")
+    parser.add_argument("--prompt", default=BENCHMARK_PROMPT)
+    args = parser.parse_args()
+    
+    if args.compare == "kv_cache":
+        print(format_length_report(compare_kv_cache(args.lengths, args.prompt)))
+    elif args.compare == "cache_codec":
+        print(compare_cache_codecs())
+    else:
+        compare = {
+            "quantization": compare_quantization,
+            "backend": compare_backends,
+            "sampler": compare_samplers
+        }[args.compare]
+        print(format_report(compare(seconds=args.seconds, prompt=args.prompt)))
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Any, Optional, Hashable, Callable
+
+class ByteLRUCache:
+    """LRU cache ที่จำกัดขนาดรวมเป็นจำนวน byte (ใช้ร่วมกันโดย cache ในหน่วยความจำทุกตัว)
+    
+    size_of(value) คืนจำนวน byte ของแต่ละรายการ เมื่อขนาดรวมเกิน max_bytes จะลบรายการที่ใช้ล่าสุดนานที่สุดออกก่อน
+    รายการที่ใหญ่กว่า max_entry_mb (ค่าเริ่มต้นคือขนาดทั้งหมด) จะไม่ถูกเก็บ
+    """
+    
+    def __init__(self, max_mb: float, size_of: Callable[[Any], int], max_entry_mb: Optional[float] = None):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_entry_bytes = self.max_bytes if max_entry_mb is None else min(self.max_bytes, int(max_entry_mb * 1024 * 1024))
+        self._size_of = size_of
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """คืนค่ารายการที่ตรงกับ key (และย้ายไปเป็นรายการล่าสุด) หรือ None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def accepts(self, size: int) -> bool:
+        """รายการขนาด size byte ถูกเก็บได้หรือไม่"""
+        return size <= self.max_entry_bytes
+    
+    def put(self, key: Hashable, value: Any) -> bool:
+        """เพิ่มรายการ แล้วลบรายการเก่าจนขนาดรวมไม่เกิน max_bytes คืนค่า False ถ้าใหญ่เกินจะเก็บ"""
+        size = self._size_of(value)
+        if not self.accepts(size):
+            return False
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= self._size_of(old)
+            self._entries[key] = value
+            self.size_bytes += size
+            
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= self._size_of(evicted)
+                self.evictions += 1
+        return True
+    
+    def discard(self, key: Hashable):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self.size_bytes -= self._size_of(value)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """สถิติของ cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_mb": self.size_bytes / (1024 * 1024),
+                "max_mb": self.max_bytes / (1024 * 1024),
+                "max_entry_mb": self.max_entry_bytes / (1024 * 1024),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,303 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Any, List, Optional, Iterable
+
+from app.config.settings import (
+    CACHE_INDEX_FLUSH_INTERVAL, CACHE_INDEX_FLUSH_COUNT, CACHE_EVICTION_SIZE_WEIGHT
+)
+from app.core.utilities import logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    params TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    size_bytes INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    priority REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# คอลัมน์ที่เพิ่มหลังจากสร้างตารางครั้งแรก (เพิ่มให้ฐานข้อมูลเดิมตอนเปิด)
+_ADDED_COLUMNS = {
+    "cost": "REAL NOT NULL DEFAULT 0",
+    "priority": "REAL NOT NULL DEFAULT 0",
+    "family": "TEXT NOT NULL DEFAULT ''",
+    "duration": "REAL NOT NULL DEFAULT 0",
+}
+
+MB = 1024 * 1024
+
+def eviction_value(cost: float, size_bytes: int) -> float:
+    """ความคุ้มค่าของการเก็บรายการไว้: เวลาที่ต้องใช้สร้างใหม่ต่อขนาด (ดู CACHE_EVICTION_SIZE_WEIGHT)"""
+    return cost / max(size_bytes / MB, 1e-3) ** CACHE_EVICTION_SIZE_WEIGHT
+
+class CacheIndex:
+    """index ของไฟล์ cache ในฐานข้อมูล SQLite (WAL mode)
+    
+    แทน cache_index.json ที่ต้องเขียนใหม่ทั้งไฟล์ทุกครั้งที่อ่านหรือเขียน cache:
+    - ค้นหาด้วย primary key (ไม่ต้องโหลด index ทั้งหมดเข้าหน่วยความจำ)
+    - เวลาเข้าถึงล่าสุด (last_access) ถูกเก็บไว้ในหน่วยความจำแล้วเขียนรวมกันเป็น transaction เดียว
+      เมื่อครบ CACHE_INDEX_FLUSH_COUNT รายการหรือทุก CACHE_INDEX_FLUSH_INTERVAL วินาที
+    - WAL ให้หลาย thread/process อ่านได้พร้อมกับการเขียน แต่ละ thread ใช้ connection ของตัวเอง
+    - ลำดับการลบแบบ GreedyDual-Size: priority = L + eviction_value(cost, size) ตอนเพิ่มหรือเข้าถึง
+      ลบรายการที่ priority ต่ำสุดก่อน แล้วตั้ง L เป็น priority ของรายการที่ลบ
+      (รายการที่ไม่ได้ใช้นานจะค่อยๆ ต่ำกว่ารายการใหม่ แม้จะเคยมีค่ามาก)
+    
+    ถ้ามี cache_index.json เดิมอยู่ จะย้ายข้อมูลเข้าฐานข้อมูลครั้งแรกที่เปิด
+    แล้วเปลี่ยนชื่อไฟล์เดิมเป็น cache_index.json.migrated
+    """
+    
+    def __init__(self, db_path: Path, legacy_json: Optional[Path] = None):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._pending: Dict[str, float] = {}
+        self._pending_lock = Lock()
+        self._last_flush = time.time()
+        
+        self._connection().executescript(_SCHEMA)
+        self._upgrade_schema()
+        if legacy_json is not None and legacy_json.exists():
+            self._migrate_json(legacy_json)
+    
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL ไม่ fsync ทุก transaction แต่ฐานข้อมูลไม่เสียหายเมื่อโปรแกรมปิดกะทันหัน
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT (rollback ถ้าเกิด exception) บน connection ของ thread นี้"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def _upgrade_schema(self):
+        # ทำใน transaction เดียวเพื่อไม่ให้หลาย process เพิ่มคอลัมน์เดียวกันซ้ำ
+        with self._transaction() as conn:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            for name, definition in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE entries ADD COLUMN {name} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_priority ON entries (priority)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_family ON entries (family, duration)")
+    
+    def _inflation(self, conn: sqlite3.Connection) -> float:
+        """ค่า L ของ GreedyDual-Size (priority ของรายการล่าสุดที่ถูกลบ)"""
+        row = conn.execute("SELECT value FROM meta WHERE name = 'inflation'").fetchone()
+        return row[0] if row is not None else 0.0
+    
+    def _migrate_json(self, legacy_json: Path):
+        """ย้ายข้อมูลจาก cache_index.json เดิม"""
+        try:
+            with open(legacy_json, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.error(f"ไม่สามารถโหลด cache index เดิมได้: {e}")
+            return
+        
+        def _timestamp(value: Optional[str]) -> float:
+            try:
+                return datetime.fromisoformat(value).timestamp()
+            except (TypeError, ValueError):
+                return time.time()
+        
+        rows = []
+        for key, meta in legacy.items():
+            created_at = _timestamp(meta.get('timestamp'))
+            rows.append((
+                key,
+                json.dumps(meta.get('params', {}), ensure_ascii=False),
+                created_at,
+                _timestamp(meta.get('last_access', meta.get('timestamp'))),
+                0
+            ))
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO entries (key, params, created_at, last_access, size_bytes) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        try:
+            legacy_json.rename(legacy_json.with_name(legacy_json.name + ".migrated"))
+        except Exception as e:
+            logger.warning(f"ไม่สามารถเปลี่ยนชื่อ cache index เดิมได้: {e}")
+        logger.info(f"ย้าย cache index เดิมเข้า SQLite แล้ว {len(rows)} รายการ")
+    
+    def contains(self, key: str) -> bool:
+        row = self._connection().execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+        return row is not None
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """ข้อมูลของรายการ key หรือ None"""
+        row = self._connection().execute(
+            "SELECT params, created_at, last_access, size_bytes, cost, priority FROM entries WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._pending_lock:
+            last_access = max(row[2], self._pending.get(key, 0))
+        return {
+            'params': json.loads(row[0]),
+            'created_at': row[1],
+            'last_access': last_access,
+            'size_bytes': row[3],
+            'cost': row[4],
+            'priority': row[5]
+        }
+    
+    def put(self, key: str, params: Dict[str, Any], size_bytes: int = 0, cost: float = 0.0,
+            family: str = "", duration: float = 0.0):
+        """เพิ่มหรือแทนที่รายการ (เขียนลงฐานข้อมูลทันที)
+        cost = เวลาที่ใช้สร้างผลลัพธ์นี้ (วินาที) ใช้จัดลำดับการลบ
+        family/duration = กลุ่มของรายการที่ต่างกันแค่ความยาวเพลง และความยาวของรายการนี้ (ดู find_prefix)"""
+        now = time.time()
+        with self._transaction() as conn:
+            priority = self._inflation(conn) + eviction_value(cost, size_bytes)
+            conn.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(key, params, created_at, last_access, size_bytes, cost, priority, family, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(params, ensure_ascii=False), now, now, size_bytes, cost, priority, family, duration)
+            )
+        with self._pending_lock:
+            self._pending.pop(key, None)
+    
+    def touch(self, key: str):
+        """บันทึกเวลาเข้าถึงล่าสุด (เขียนลงฐานข้อมูลแบบรวมกลุ่มใน flush)"""
+        with self._pending_lock:
+            self._pending[key] = time.time()
+            due = (len(self._pending) >= CACHE_INDEX_FLUSH_COUNT
+                   or time.time() - self._last_flush >= CACHE_INDEX_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+    
+    def flush(self):
+        """เขียน last_access ที่ค้างอยู่ทั้งหมดใน transaction เดียว"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return
+        try:
+            with self._transaction() as conn:
+                # ไม่ย้อนเวลาของรายการที่ process อื่นเข้าถึงทีหลัง และคำนวณ priority ใหม่จาก L ปัจจุบัน
+                inflation = self._inflation(conn)
+                rows = conn.execute(
+                    f"SELECT key, cost, size_bytes FROM entries WHERE key IN ({','.join('?' * len(pending))})",
+                    list(pending)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE entries SET last_access = MAX(last_access, ?), priority = MAX(priority, ?) WHERE key = ?",
+                    [(pending[key], inflation + eviction_value(cost, size), key) for key, cost, size in rows]
+                )
+        except sqlite3.Error as e:
+            logger.error(f"ไม่สามารถบันทึกเวลาเข้าถึง cache ได้: {e}")
+    
+    def remove(self, keys: Iterable[str]):
+        keys = list(keys)
+        if not keys:
+            return
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+        with self._pending_lock:
+            for key in keys:
+                self._pending.pop(key, None)
+    
+    def total_bytes(self) -> int:
+        return self._connection().execute("SELECT COALESCE(SUM(size_bytes), 0) FROM entries").fetchone()[0]
+    
+    def evict_to_fit(self, max_bytes: int) -> List[Dict[str, Any]]:
+        """ลบรายการที่ priority ต่ำสุดออกจาก index จนขนาดรวมไม่เกิน max_bytes
+        คืนค่ารายการที่ถูกลบ (key, size_bytes, cost) ให้ผู้เรียกลบไฟล์"""
+        self.flush()
+        evicted = []
+        with self._transaction() as conn:
+            excess = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM entries").fetchone()[0] - max_bytes
+            if excess <= 0:
+                return evicted
+            inflation = self._inflation(conn)
+            for key, size_bytes, cost, priority in conn.execute(
+                "SELECT key, size_bytes, cost, priority FROM entries ORDER BY priority"
+            ).fetchall():
+                if excess <= 0:
+                    break
+                evicted.append({'key': key, 'size_bytes': size_bytes, 'cost': cost})
+                excess -= size_bytes
+                inflation = max(inflation, priority)
+            conn.executemany("DELETE FROM entries WHERE key = ?", [(entry['key'],) for entry in evicted])
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('inflation', ?)", (inflation,))
+        return evicted
+    
+    def find_prefix(self, family: str, duration: float) -> List[Dict[str, Any]]:
+        """รายการใน family ที่ความยาวไม่เท่ากับ duration (key, duration) เรียงตามความเหมาะสม:
+        รายการที่ยาวกว่าจากสั้นไปยาว (ตัดให้สั้นลงได้ทันที) แล้วจึงรายการที่สั้นกว่าจากยาวไปสั้น (สร้างต่อ)"""
+        if not family:
+            return []
+        rows = self._connection().execute(
+            "SELECT key, duration FROM entries WHERE family = ? AND duration != ? "
+            "ORDER BY duration < ?, ABS(duration - ?)",
+            (family, duration, duration, duration)
+        ).fetchall()
+        return [{'key': key, 'duration': entry_duration} for key, entry_duration in rows]
+    
+    def keys_without_size(self) -> List[str]:
+        rows = self._connection().execute("SELECT key FROM entries WHERE size_bytes = 0").fetchall()
+        return [row[0] for row in rows]
+    
+    def set_size(self, key: str, size_bytes: int):
+        with self._transaction() as conn:
+            inflation = self._inflation(conn)
+            row = conn.execute("SELECT cost FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE entries SET size_bytes = ?, priority = ? WHERE key = ?",
+                    (size_bytes, inflation + eviction_value(row[0], size_bytes), key)
+                )
+    
+    def keys_created_before(self, timestamp: float) -> List[str]:
+        rows = self._connection().execute(
+            "SELECT key FROM entries WHERE created_at < ?", (timestamp,)
+        ).fetchall()
+        return [row[0] for row in rows]
+    
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM entries")
+        with self._pending_lock:
+            self._pending.clear()
+    
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    
+    def close(self):
+        """เขียนข้อมูลที่ค้างอยู่และปิด connection ของ thread นี้"""
+        self.flush()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -1,49 +1,87 @@
 import os
 import json
+import atexit
 import hashlib
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from threading import Lock, get_ident
+from typing import Dict, Any, Optional, List, Callable
 from datetime import datetime, timedelta
 import numpy as np
 
-from app.config.settings import BASE_DIR
-from app.core.utilities import logger
+from app.config.settings import (
+    BASE_DIR, CACHE_MAX_SIZE_MB, CACHE_MAX_AGE_DAYS, CACHE_CODEC, CACHE_STORE_CODES, CACHE_WAVEFORM_HOT_HITS,
+    SAMPLE_RATE
+)
+from app.core.utilities import logger, LazySingleton
+from app.core.cache_index import CacheIndex, MB
+from app.core.cache_codec import CacheCodec, CODECS, get_codec
+from app.core.file_lock import FileLock
+from app.core.memory_cache import MemoryResultCache
+from app.core.thread_budget import thread_budget
 
 class CacheManager:
-    """จัดการ cache สำหรับผลลัพธ์การสร้างเพลง"""
+    """จัดการ cache สำหรับผลลัพธ์การสร้างเพลง
+    
+    ใช้ได้จากหลาย thread และหลาย process ที่ใช้ cache_dir เดียวกัน:
+    - ไฟล์ทุกไฟล์ถูกเขียนเป็นไฟล์ชั่วคราว (ชื่อไม่ซ้ำต่อ process/thread) แล้วแทนที่ด้วย os.replace
+      metadata ถูกเขียนทีหลังสุด ผู้อ่านจึงไม่เห็นรายการที่เขียนไม่ครบ และไม่ต้องถือ lock
+    - การเขียน/เข้ารหัส/ลบไฟล์ของรายการเดียวกันถูกกันด้วย FileLock ต่อรายการ (ผู้เขียนทีละราย)
+    - index (SQLite WAL) จัดการการเขียนพร้อมกันเอง
+    
+    ผลลัพธ์ที่มี EnCodec codes (CACHE_STORE_CODES) ถูกเก็บเป็น codes อย่างเดียว (.codes.npz)
+    และถอดรหัสเป็นเสียงใหม่ด้วย decode ที่ผู้เรียกส่งให้ get รายการที่ถูกใช้บ่อย
+    (CACHE_WAVEFORM_HOT_HITS) จะถูกเก็บข้อมูลเสียงไว้ด้วยเพื่อไม่ต้องถอดรหัสซ้ำ
+    """
     
     def __init__(self):
         self.cache_dir = BASE_DIR / "cache"
         self.cache_dir.mkdir(exist_ok=True)
         
-        self.index_file = self.cache_dir / "cache_index.json"
-        self.cache_index: Dict[str, Dict[str, Any]] = {}
+        # index ของไฟล์ cache (SQLite) ย้ายข้อมูลจาก cache_index.json เดิมถ้ามี
+        self.index = CacheIndex(
+            self.cache_dir / "cache_index.sqlite3",
+            legacy_json=self.cache_dir / "cache_index.json"
+        )
+        # เขียนเวลาเข้าถึงที่ค้างอยู่ก่อนปิดโปรแกรม
+        atexit.register(self.index.flush)
         
-        # โหลด cache index
-        self._load_index()
+        # L1: ผลลัพธ์ล่าสุดในหน่วยความจำ (L2 คือไฟล์บนดิสก์)
+        self.memory = MemoryResultCache()
+        self.disk_hits = 0
+        self.misses = 0
         
-        # ทำความสะอาด cache เก่า
-        self._cleanup_old_cache()
+        # รูปแบบการเก็บเสียงบนดิสก์ (CACHE_CODEC) รายการใหม่ถูกบันทึกแบบ raw ก่อน
+        # แล้วเข้ารหัสใน thread แยกเพื่อไม่ให้คำขอต้องรอ
+        self.codec = get_codec(CACHE_CODEC)
+        self._encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-codec")
+        self._encoding = set()
+        self._lock = Lock()
+        self.codec_stats = {
+            'encoded': 0,
+            'raw_bytes': 0,
+            'stored_bytes': 0,
+            'encode_seconds': 0.0,
+            'decodes': 0,
+            'decode_seconds': 0.0,
+            'code_decodes': 0,
+            'code_decode_seconds': 0.0,
+            'waveforms_kept': 0
+        }
+        # จำนวนครั้งที่รายการแบบ codes อย่างเดียวถูกถอดรหัส (ใช้เลือกรายการที่ควรเก็บเสียงไว้)
+        self._code_hits: Dict[str, int] = {}
         
-    def _load_index(self):
-        """โหลด cache index จากไฟล์"""
-        if self.index_file.exists():
-            try:
-                with open(self.index_file, 'r', encoding='utf-8') as f:
-                    self.cache_index = json.load(f)
-            except Exception as e:
-                logger.error(f"ไม่สามารถโหลด cache index ได้: {e}")
-                self.cache_index = {}
+        # จำนวนและขนาดรวมของรายการที่ถูกลบเพราะ cache เต็ม
+        self.evictions = 0
+        self.evicted_bytes = 0
+        
+        # ทำความสะอาด cache: ปกติลบตามขนาดอย่างเดียว (GreedyDual-Size) ลบตามอายุเมื่อเปิด CACHE_MAX_AGE_DAYS
+        if CACHE_MAX_AGE_DAYS:
+            self._cleanup_old_cache(CACHE_MAX_AGE_DAYS)
+        self._backfill_sizes()
+        self._enforce_budget()
         
-    def _save_index(self):
-        """บันทึก cache index ลงไฟล์"""
-        try:
-            with open(self.index_file, 'w', encoding='utf-8') as f:
-                json.dump(self.cache_index, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"ไม่สามารถบันทึก cache index ได้: {e}")
-            
     def _generate_cache_key(self, params: Dict[str, Any]) -> str:
         """สร้าง cache key จากพารามิเตอร์"""
         # เรียงลำดับคีย์เพื่อให้ได้ค่าเดียวกันเสมอ
@@ -56,60 +94,380 @@ class CacheManager:
         return hashlib.sha256(param_str.encode()).hexdigest()
         
     def _get_cache_file(self, cache_key: str) -> Path:
-        """สร้าง path สำหรับไฟล์ cache"""
+        """สร้าง path สำหรับไฟล์ cache (ข้อมูลเสียงแบบ .npy little-endian เปิดด้วย mmap ได้)"""
+        return self.cache_dir / f"{cache_key}.npy"
+        
+    def _get_metadata_file(self, cache_key: str) -> Path:
+        """path ของ metadata (JSON) ที่คู่กับไฟล์เสียง"""
+        return self.cache_dir / f"{cache_key}.meta.json"
+        
+    def _get_legacy_file(self, cache_key: str) -> Path:
+        """path ของ cache แบบเดิม (np.savez รวมเสียงกับ metadata ที่ pickle ไว้)"""
         return self.cache_dir / f"{cache_key}.npz"
         
-    def _cleanup_old_cache(self, max_age_days: int = 7):
-        """ลบ cache ที่เก่าเกินกำหนด"""
-        now = datetime.now()
-        cutoff = now - timedelta(days=max_age_days)
+    def _get_encoded_file(self, cache_key: str, codec: CacheCodec) -> Path:
+        """path ของข้อมูลเสียงที่เข้ารหัสด้วย codec"""
+        return self.cache_dir / f"{cache_key}{codec.suffix}"
+        
+    def _get_codes_file(self, cache_key: str) -> Path:
+        """path ของ EnCodec codes ของรายการ (np.savez_compressed ไม่มี pickle)"""
+        return self.cache_dir / f"{cache_key}.codes.npz"
+        
+    def _entry_files(self, cache_key: str) -> List[Path]:
+        return [
+            self._get_cache_file(cache_key),
+            self._get_metadata_file(cache_key),
+            self._get_legacy_file(cache_key),
+            self._get_codes_file(cache_key)
+        ] + [self._get_encoded_file(cache_key, codec) for codec in CODECS.values() if not codec.mmap]
+        
+    def _entry_size(self, cache_key: str) -> int:
+        return sum(_file_size(path) for path in self._entry_files(cache_key))
+        
+    def _remove_files(self, cache_key: str):
+        """ลบไฟล์ของรายการ (ผู้เรียกต้องถือ lock ของรายการอยู่)"""
+        for path in self._entry_files(cache_key):
+            path.unlink(missing_ok=True)
+            
+    def _remove_entry(self, cache_key: str):
+        with self._entry_lock(cache_key):
+            self._remove_files(cache_key)
+            
+    def _entry_lock(self, cache_key: str, timeout: Optional[float] = None) -> FileLock:
+        """lock ของรายการ ใช้ร่วมกันระหว่าง thread และ process"""
+        lock_file = self.cache_dir / f"{cache_key}.lock"
+        return FileLock(lock_file) if timeout is None else FileLock(lock_file, timeout=timeout)
+        
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        """ไฟล์ชั่วคราวที่ไม่ชนกับ process/thread อื่นที่เขียนไฟล์เดียวกัน"""
+        return path.with_name(f"{path.name}.{os.getpid()}-{get_ident()}.tmp")
+        
+
+    def _write_entry(self, cache_key: str, audio_data: np.ndarray, metadata: Dict[str, Any]):
+        """เขียนข้อมูลเสียงและ metadata ผ่านไฟล์ชั่วคราวแล้วค่อยแทนที่
+        metadata ถูกเขียนทีหลังสุด การมี metadata จึงหมายความว่าไฟล์เสียงครบแล้ว"""
+        audio_file = self._get_cache_file(cache_key)
+        audio_tmp = self._tmp_path(audio_file)
+        
+        CODECS["raw"].encode(np.asarray(audio_data), audio_tmp, SAMPLE_RATE)
+        os.replace(audio_tmp, audio_file)
+        self._write_metadata(cache_key, metadata)
+        
+    def _write_codes(self, cache_key: str, codes: Dict[str, Any], metadata: Dict[str, Any]):
+        """เขียน EnCodec codes ของทุกช่วง (int16) และ metadata ที่มีวิธีต่อช่วงไว้ใน '_codes'
+        (ลำดับการเขียนเหมือน _write_entry: metadata ทีหลังสุด)"""
+        codes_file = self._get_codes_file(cache_key)
+        codes_tmp = self._tmp_path(codes_file)
+        with open(codes_tmp, 'wb') as f:
+            np.savez_compressed(f, **{
+                f"segment_{i}": np.asarray(segment['codes'], dtype=np.int16)
+                for i, segment in enumerate(codes['segments'])
+            })
+        os.replace(codes_tmp, codes_file)
+        
+        layout = {key: value for key, value in codes.items() if key != 'segments'}
+        layout['segments'] = [
+            {key: value for key, value in segment.items() if key != 'codes'} for segment in codes['segments']
+        ]
+        self._write_metadata(cache_key, {**metadata, '_codes': layout})
+        
+    def _read_codes(self, cache_key: str, layout: Dict[str, Any]) -> Dict[str, Any]:
+        """อ่าน codes ที่ _write_codes บันทึกไว้กลับเป็นรูปแบบเดียวกับ result['codes']"""
+        with np.load(self._get_codes_file(cache_key)) as data:
+            segments = [
+                {**segment, 'codes': data[f"segment_{i}"]} for i, segment in enumerate(layout['segments'])
+            ]
+        return {**layout, 'segments': segments}
+        
+    def _decode_codes(self,
+                      cache_key: str,
+                      layout: Dict[str, Any],
+                      decode: Callable[[Dict[str, Any]], np.ndarray],
+                      metadata: Dict[str, Any]) -> np.ndarray:
+        """ถอดรหัส codes ของรายการเป็นเสียง และเก็บเสียงไว้ถ้ารายการถูกใช้ครบ CACHE_WAVEFORM_HOT_HITS ครั้ง"""
+        codes = self._read_codes(cache_key, layout)
+        start = time.perf_counter()
+        audio_data = np.asarray(decode(codes), dtype=np.float32)
+        with self._lock:
+            self.codec_stats['code_decodes'] += 1
+            self.codec_stats['code_decode_seconds'] += time.perf_counter() - start
+            hits = self._code_hits.get(cache_key, 0) + 1
+            self._code_hits[cache_key] = hits
+            
+        if CACHE_WAVEFORM_HOT_HITS and hits >= CACHE_WAVEFORM_HOT_HITS:
+            self._keep_waveform(cache_key, audio_data, {**metadata, '_codes': layout})
+        return audio_data
+        
+    def _keep_waveform(self, cache_key: str, audio_data: np.ndarray, metadata: Dict[str, Any]):
+        """เก็บข้อมูลเสียงของรายการที่ถูกใช้บ่อยไว้คู่กับ codes (แล้วเข้ารหัสตาม CACHE_CODEC)"""
+        try:
+            with self._entry_lock(cache_key):
+                # รายการอาจถูกลบหรือถูกเก็บเสียงโดย process อื่นแล้วระหว่างรอ lock
+                if not self.index.contains(cache_key) or self._get_cache_file(cache_key).exists():
+                    return
+                self._write_entry(cache_key, audio_data, metadata)
+            self.index.set_size(cache_key, self._entry_size(cache_key))
+            with self._lock:
+                self._code_hits.pop(cache_key, None)
+                self.codec_stats['waveforms_kept'] += 1
+            self._schedule_encode(cache_key)
+            self._enforce_budget()
+        except Exception as e:
+            logger.error(f"ไม่สามารถเก็บข้อมูลเสียงของ cache {cache_key[:12]} ได้: {e}")
+            
+    def _write_metadata(self, cache_key: str, metadata: Dict[str, Any]):
+        metadata_file = self._get_metadata_file(cache_key)
+        metadata_tmp = self._tmp_path(metadata_file)
+        metadata_tmp.write_text(
+            json.dumps(metadata, ensure_ascii=False, default=_json_default),
+            encoding='utf-8'
+        )
+        os.replace(metadata_tmp, metadata_file)
+        
+    def _schedule_encode(self, cache_key: str):
+        """ส่งรายการที่ยังเป็น raw ให้ thread ของ encoder (ถ้า CACHE_CODEC ไม่ใช่ raw)"""
+        if self.codec.mmap:
+            return
+        with self._lock:
+            if cache_key in self._encoding:
+                return
+            self._encoding.add(cache_key)
+        self._encoder.submit(self._encode_entry, cache_key)
+        
+    def _encode_entry(self, cache_key: str):
+        """เข้ารหัสข้อมูลเสียงแบบ raw ของรายการด้วย self.codec แล้วลบไฟล์ raw
+        metadata ถูกแทนที่ก่อนลบไฟล์ raw ผู้อ่านจึงเห็นไฟล์ใดไฟล์หนึ่งที่ครบเสมอ"""
+        raw_file = self._get_cache_file(cache_key)
+        metadata_file = self._get_metadata_file(cache_key)
+        # ไม่รอ lock: ถ้า thread/process อื่นกำลังเขียนหรือเข้ารหัสรายการนี้อยู่ ให้เขาทำต่อ
+        # (รายการที่ยังเป็น raw จะถูกส่งมาเข้ารหัสใหม่ครั้งถัดไปที่ถูกใช้)
+        lock = self._entry_lock(cache_key, timeout=0)
+        try:
+            if not lock.acquire() or not raw_file.exists() or not metadata_file.exists():
+                return
+            metadata = json.loads(metadata_file.read_text(encoding='utf-8'))
+            if '_codec' in metadata:
+                return
+                
+            encoded_file = self._get_encoded_file(cache_key, self.codec)
+            encoded_tmp = self._tmp_path(encoded_file)
+            audio_data = np.load(raw_file, mmap_mode='r')
+            start = time.perf_counter()
+            with thread_budget.lease("export", native_threads=True):
+                params = self.codec.encode(audio_data, encoded_tmp, metadata.get('sample_rate', SAMPLE_RATE))
+            encode_seconds = time.perf_counter() - start
+            del audio_data
+            os.replace(encoded_tmp, encoded_file)
+            
+            metadata['_codec'] = {'name': self.codec.name, **params}
+            self._write_metadata(cache_key, metadata)
+            raw_bytes = raw_file.stat().st_size
+            raw_file.unlink()
+            
+            # รายการอาจถูกลบ (เต็มหรือล้าง cache) ระหว่างเข้ารหัส
+            if not self.index.contains(cache_key):
+                self._remove_files(cache_key)
+                return
+            stored_bytes = encoded_file.stat().st_size
+            self.index.set_size(cache_key, self._entry_size(cache_key))
+            with self._lock:
+                self.codec_stats['encoded'] += 1
+                self.codec_stats['raw_bytes'] += raw_bytes
+                self.codec_stats['stored_bytes'] += stored_bytes
+                self.codec_stats['encode_seconds'] += encode_seconds
+        except FileNotFoundError:
+            # รายการถูกลบหรือล้าง cache ระหว่างเข้ารหัส เก็บไฟล์ที่เพิ่งเขียนทิ้ง
+            if not self.index.contains(cache_key):
+                self._remove_files(cache_key)
+        except Exception as e:
+            logger.error(f"ไม่สามารถเข้ารหัส cache {cache_key[:12]} เป็น {self.codec.name} ได้: {e}")
+        finally:
+            lock.release()
+            with self._lock:
+                self._encoding.discard(cache_key)
+                
+    def _read_audio(self, cache_key: str, metadata: Dict[str, Any]) -> Optional[np.ndarray]:
+        """เปิดข้อมูลเสียงของรายการ: raw แบบ memory-mapped หรือ decode ตาม codec ที่บันทึกไว้ใน metadata
+        คืนค่า None ถ้ารายการมีแต่ codes (metadata ถูกลบพารามิเตอร์ของ codec และ codes ออก)"""
+        codec_params = metadata.pop('_codec', None)
+        codes_layout = metadata.pop('_codes', None)
+        if codec_params is None:
+            if codes_layout is not None and not self._get_cache_file(cache_key).exists():
+                return None
+            audio_data = np.load(self._get_cache_file(cache_key), mmap_mode='r')
+            # รายการที่ยังไม่ถูกเข้ารหัส (เช่น ปิดโปรแกรมก่อนเข้ารหัสเสร็จ)
+            self._schedule_encode(cache_key)
+            return audio_data
+            
+        codec = get_codec(codec_params['name'])
+        start = time.perf_counter()
+        audio_data = codec.decode(self._get_encoded_file(cache_key, codec), codec_params)
+        with self._lock:
+            self.codec_stats['decodes'] += 1
+            self.codec_stats['decode_seconds'] += time.perf_counter() - start
+        return audio_data
+        
+    def _upgrade_legacy(self, cache_key: str) -> bool:
+        """แปลง cache แบบ .npz เดิมเป็น .npy + JSON (ไฟล์เดิมเขียนโดยโปรแกรมนี้เอง จึงเปิด allow_pickle ได้)"""
+        legacy_file = self._get_legacy_file(cache_key)
+        if not legacy_file.exists():
+            return False
+        try:
+            with self._entry_lock(cache_key):
+                # process อื่นอาจแปลงไปแล้วระหว่างรอ lock
+                if self._get_metadata_file(cache_key).exists():
+                    return True
+                with np.load(legacy_file, allow_pickle=True) as data:
+                    audio_data = data['audio_data']
+                    metadata = data['metadata'].item()
+                self._write_entry(cache_key, audio_data, metadata)
+                legacy_file.unlink()
+            self.index.set_size(cache_key, self._entry_size(cache_key))
+            self._schedule_encode(cache_key)
+            logger.info(f"แปลง cache {cache_key[:12]} เป็นรูปแบบ .npy แล้ว")
+            return True
+        except Exception as e:
+            logger.error(f"ไม่สามารถแปลง cache แบบเดิม {legacy_file} ได้: {e}")
+            return False
+        
+    def _cleanup_old_cache(self, max_age_days: float):
+        """ลบ cache ที่สร้างมานานเกิน max_age_days วัน ไม่ว่าจะมีค่าแค่ไหน (ดู CACHE_MAX_AGE_DAYS)"""
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).timestamp()
         
         # ลบ cache ที่เก่าเกิน max_age_days
         removed = []
-        for key, meta in list(self.cache_index.items()):
-            cache_time = datetime.fromisoformat(meta['timestamp'])
-            if cache_time < cutoff:
-                cache_file = self._get_cache_file(key)
-                if cache_file.exists():
-                    try:
-                        cache_file.unlink()
-                        removed.append(key)
-                    except Exception as e:
-                        logger.error(f"ไม่สามารถลบไฟล์ cache {cache_file} ได้: {e}")
-                        
+        for key in self.index.keys_created_before(cutoff):
+            try:
+                self._remove_entry(key)
+                removed.append(key)
+            except Exception as e:
+                logger.error(f"ไม่สามารถลบไฟล์ cache {key} ได้: {e}")
+                
         # อัพเดต index
-        for key in removed:
-            del self.cache_index[key]
-            
         if removed:
+            self.index.remove(removed)
             logger.info(f"ลบ cache ที่เก่าแล้ว {len(removed)} รายการ")
-            self._save_index()
             
+    def _backfill_sizes(self):
+        """ใส่ขนาดไฟล์ให้รายการที่ย้ายมาจาก index แบบ JSON (ยังไม่มีขนาด)"""
+        for key in self.index.keys_without_size():
+            size_bytes = self._entry_size(key)
+            if size_bytes:
+                self.index.set_size(key, size_bytes)
+            else:
+                self.index.remove([key])
+                
+    def _enforce_budget(self):
+        """ลบรายการที่คุ้มค่าน้อยที่สุด (GreedyDual-Size) จนขนาดรวมไม่เกิน CACHE_MAX_SIZE_MB"""
+        try:
+            evicted = self.index.evict_to_fit(int(CACHE_MAX_SIZE_MB * MB))
+        except Exception as e:
+            logger.error(f"ไม่สามารถลบ cache ที่เกินขนาดได้: {e}")
+            return
+        if not evicted:
+            return
+            
+        for entry in evicted:
+            self.memory.discard(entry['key'])
+            with self._lock:
+                self._code_hits.pop(entry['key'], None)
+            try:
+                self._remove_entry(entry['key'])
+            except Exception as e:
+                logger.error(f"ไม่สามารถลบไฟล์ cache {entry['key']} ได้: {e}")
+                
+        freed = sum(entry['size_bytes'] for entry in evicted)
+        with self._lock:
+            self.evictions += len(evicted)
+            self.evicted_bytes += freed
+        logger.info(
+            f"cache เกิน {CACHE_MAX_SIZE_MB} MB ลบ {len(evicted)} รายการ ({freed / MB:.1f} MB, "
+            f"เวลาสร้างรวม {sum(entry['cost'] for entry in evicted):.1f} วินาที)"
+        )
+        
     def get(self, 
-           params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """ดึงผลลัพธ์จาก cache ถ้ามี"""
-        cache_key = self._generate_cache_key(params)
+           params: Dict[str, Any],
+           decode: Optional[Callable[[Dict[str, Any]], np.ndarray]] = None) -> Optional[Dict[str, Any]]:
+        """ดึงผลลัพธ์จาก cache ถ้ามี
+        decode แปลง codes (รูปแบบเดียวกับ result['codes']) เป็นเสียง ใช้กับรายการที่เก็บแต่ codes
+        (ไม่ส่ง decode = รายการแบบนั้นนับเป็น miss)"""
+        return self._get_entry(self._generate_cache_key(params), decode)
         
+    def get_prefix(self,
+                   family: Dict[str, Any],
+                   duration: float,
+                   decode: Optional[Callable[[Dict[str, Any]], np.ndarray]] = None) -> Optional[Dict[str, Any]]:
+        """ผลลัพธ์ใน cache ที่ต่างจากคำขอแค่ความยาว (family เดียวกัน ดู set) สำหรับใช้เป็นส่วนต้นของเพลง
+        เลือกรายการที่สั้นที่สุดที่ยาวกว่า duration ก่อน ถ้าไม่มีจึงเลือกรายการที่ยาวที่สุดที่สั้นกว่า
+        คืนค่าผลลัพธ์พร้อม 'duration' (ความยาวของรายการนั้นตอนบันทึก) หรือ None
+        รายการที่สั้นกว่ามี 'codes' (EnCodec codes ถ้าเก็บไว้ หรือ None) สำหรับสร้างต่อด้วย"""
+        for entry in self.index.find_prefix(self._generate_cache_key(family), duration):
+            cached = self._get_entry(entry['key'], decode)
+            if cached is None:
+                continue
+            cached = {**cached, 'duration': entry['duration']}
+            if entry['duration'] < duration:
+                cached['codes'] = self._load_codes(entry['key'])
+            return cached
+        return None
+        
+    def _load_codes(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """EnCodec codes ของรายการในรูปแบบเดียวกับ result['codes'] (None ถ้าไม่ได้เก็บไว้หรือถูกลบไปแล้ว)"""
+        try:
+            metadata = json.loads(self._get_metadata_file(cache_key).read_text(encoding='utf-8'))
+            if '_codes' not in metadata:
+                return None
+            return self._read_codes(cache_key, metadata['_codes'])
+        except FileNotFoundError:
+            return None
+        
+    def _get_entry(self,
+                   cache_key: str,
+                   decode: Optional[Callable[[Dict[str, Any]], np.ndarray]] = None) -> Optional[Dict[str, Any]]:
+        # L1 ในหน่วยความจำ (ยังบันทึกเวลาเข้าถึงใน index เพื่อให้รายการบนดิสก์ไม่ถูกลบก่อน)
+        cached = self.memory.get(cache_key)
+        if cached is not None:
+            self.index.touch(cache_key)
+            return cached
+            
         # ตรวจสอบว่ามี cache หรือไม่
-        if cache_key not in self.cache_index:
+        if not self.index.contains(cache_key):
+            self._count_miss()
             return None
             
-        # ตรวจสอบว่าไฟล์ยังมีอยู่หรือไม่
-        cache_file = self._get_cache_file(cache_key)
-        if not cache_file.exists():
-            del self.cache_index[cache_key]
-            self._save_index()
+        # ตรวจสอบว่าไฟล์ยังมีอยู่หรือไม่ (แปลง cache แบบ .npz เดิมครั้งแรกที่ถูกใช้)
+        metadata_file = self._get_metadata_file(cache_key)
+        if not metadata_file.exists() and not self._upgrade_legacy(cache_key):
+            self.index.remove([cache_key])
+            self._count_miss()
             return None
             
         try:
-            # โหลดข้อมูลจาก cache
-            data = np.load(cache_file)
-            audio_data = data['audio_data']
-            metadata = data['metadata'].item()  # แปลง numpy array เป็น dict
+            # รายการ raw เปิดแบบ memory-mapped (อ่านอย่างเดียว) ข้อมูลถูกอ่านจากดิสก์เมื่อใช้จริงเท่านั้น
+            # อ่านซ้ำหนึ่งครั้งถ้าไฟล์เสียงถูกแทนที่ (เข้ารหัสเสร็จ) ระหว่างอ่าน metadata กับไฟล์เสียง
+            for attempt in range(2):
+                try:
+                    metadata = json.loads(metadata_file.read_text(encoding='utf-8'))
+                    codes_layout = metadata.get('_codes')
+                    audio_data = self._read_audio(cache_key, metadata)
+                    if audio_data is None:
+                        if decode is None:
+                            self._count_miss()
+                            return None
+                        audio_data = self._decode_codes(cache_key, codes_layout, decode, metadata)
+                    break
+                except FileNotFoundError:
+                    if attempt:
+                        raise
+                        
+            # อัพเดตเวลาเข้าถึงล่าสุด (เขียนลง index แบบรวมกลุ่ม)
+            self.index.touch(cache_key)
+            with self._lock:
+                self.disk_hits += 1
             
-            # อัพเดตเวลาเข้าถึงล่าสุด
-            self.cache_index[cache_key]['last_access'] = datetime.now().isoformat()
-            self._save_index()
+            # เพลงสั้นถูกอ่านเข้าหน่วยความจำไว้สำหรับครั้งต่อไป (เพลงที่ใหญ่เกิน CACHE_MEMORY_MAX_ENTRY_MB ใช้ mmap ต่อ)
+            self.memory.put(cache_key, audio_data, metadata)
             
             return {
                 'audio_data': audio_data,
@@ -118,31 +476,57 @@ class CacheManager:
             
         except Exception as e:
             logger.error(f"ไม่สามารถโหลด cache ได้: {e}")
+            self._count_miss()
             return None
             
+    def _count_miss(self):
+        with self._lock:
+            self.misses += 1
+            
     def set(self,
             params: Dict[str, Any],
-            result: Dict[str, Any]):
-        """บันทึกผลลัพธ์ลง cache"""
+            result: Dict[str, Any],
+            family: Optional[Dict[str, Any]] = None,
+            duration: float = 0.0):
+        """บันทึกผลลัพธ์ลง cache
+        family คือพารามิเตอร์ของคำขอที่ไม่รวมความยาว รายการที่มี family เดียวกันใช้เป็นส่วนต้นของกันได้
+        (ดู get_prefix) duration คือความยาวที่ขอของรายการนี้"""
         cache_key = self._generate_cache_key(params)
-        cache_file = self._get_cache_file(cache_key)
+        family_key = self._generate_cache_key(family) if family is not None else ""
         
         try:
-            # บันทึกข้อมูล
-            np.savez(
-                cache_file,
-                audio_data=result['audio_data'],
-                metadata=result['metadata']
-            )
-            
-            # อัพเดต index
-            self.cache_index[cache_key] = {
-                'params': params,
-                'timestamp': datetime.now().isoformat(),
-                'last_access': datetime.now().isoformat()
-            }
+            # บันทึกข้อมูลและอัพเดต index ขณะถือ lock ของรายการ (ผู้เขียนทีละราย)
+            # ผลลัพธ์ที่มี codes เก็บแค่ codes ข้อมูลเสียงจะถูกเก็บเมื่อรายการถูกใช้บ่อย
+            store_codes = CACHE_STORE_CODES and result.get('codes') is not None
+            with self._entry_lock(cache_key):
+                if store_codes:
+                    self._write_codes(cache_key, result['codes'], result['metadata'])
+                    stale = [self._get_cache_file(cache_key)]
+                else:
+                    self._write_entry(cache_key, result['audio_data'], result['metadata'])
+                    stale = [self._get_codes_file(cache_key)]
+                # ไฟล์ของรายการเดิมในรูปแบบอื่นที่ metadata ใหม่ไม่ได้อ้างถึงแล้ว
+                stale += [self._get_encoded_file(cache_key, codec) for codec in CODECS.values() if not codec.mmap]
+                for path in stale:
+                    path.unlink(missing_ok=True)
+                self.index.put(
+                    cache_key,
+                    params,
+                    size_bytes=self._entry_size(cache_key),
+                    cost=result['metadata'].get('generation_time', 0),
+                    family=family_key,
+                    duration=duration
+                )
+            
+            # ลบรายการที่คุ้มค่าน้อยที่สุดถ้าขนาดรวมเกินกำหนด
+            self._enforce_budget()
+            
+            # ผลลัพธ์ที่เพิ่งสร้างมีโอกาสถูกขอซ้ำมากที่สุด (เช่น undo/redo)
+            self.memory.put(cache_key, result['audio_data'], result['metadata'])
             
-            self._save_index()
+            # เข้ารหัสตาม CACHE_CODEC ใน thread แยก
+            if not store_codes:
+                self._schedule_encode(cache_key)
             
         except Exception as e:
             logger.error(f"ไม่สามารถบันทึก cache ได้: {e}")
@@ -150,29 +534,95 @@ class CacheManager:
     def clear(self):
         """ล้าง cache ทั้งหมด"""
         # ลบไฟล์ทั้งหมด
-        for cache_file in self.cache_dir.glob("*.npz"):
+        for cache_file in self._data_files():
             try:
                 cache_file.unlink()
             except Exception as e:
                 logger.error(f"ไม่สามารถลบไฟล์ cache {cache_file} ได้: {e}")
                 
         # รีเซ็ต index
-        self.cache_index = {}
-        self._save_index()
+        self.index.clear()
+        self.memory.clear()
+        with self._lock:
+            self._code_hits.clear()
         
         logger.info("ล้าง cache เรียบร้อยแล้ว")
         
+    def _data_files(self) -> List[Path]:
+        """ไฟล์ข้อมูลของ cache ทุกรูปแบบ (ไม่รวม index)
+        รวมไฟล์ชั่วคราวที่ค้างจากการเขียนหรือการยึด lock ที่ถูกขัดจังหวะ (*.tmp, *.stale)"""
+        patterns = ["*.npy", "*.meta.json", "*.npz", "*.tmp", "*.stale"] + [
+            f"*{codec.suffix}" for codec in CODECS.values() if not codec.suffix.endswith(".npy")
+        ]
+        return [path for pattern in patterns for path in self.cache_dir.glob(pattern)]
+        
     def get_stats(self) -> Dict[str, Any]:
         """ดึงสถิติการใช้งาน cache"""
         total_size = 0
-        for cache_file in self.cache_dir.glob("*.npz"):
-            total_size += cache_file.stat().st_size
+        for cache_file in self._data_files():
+            total_size += _file_size(cache_file)
             
+        memory_stats = self.memory.get_stats()
+        with self._lock:
+            codec_stats = dict(self.codec_stats)
+            disk_hits, misses = self.disk_hits, self.misses
+            evictions, evicted_bytes = self.evictions, self.evicted_bytes
+        lookups = memory_stats['hits'] + disk_hits + misses
         return {
-            'total_entries': len(self.cache_index),
+            'total_entries': self.index.count(),
             'total_size_mb': total_size / (1024 * 1024),
-            'cache_dir': str(self.cache_dir)
+            'max_size_mb': CACHE_MAX_SIZE_MB,
+            'evictions': evictions,
+            'evicted_mb': evicted_bytes / MB,
+            'cache_dir': str(self.cache_dir),
+            'memory': memory_stats,
+            'disk_hits': disk_hits,
+            'misses': misses,
+            # อัตรา hit ของแต่ละชั้นเทียบกับจำนวนคำขอทั้งหมด
+            'memory_hit_rate': memory_stats['hits'] / lookups if lookups else 0.0,
+            'disk_hit_rate': disk_hits / lookups if lookups else 0.0,
+            # พื้นที่ที่ประหยัดได้จาก CACHE_CODEC เทียบกับเวลา decode ตอนใช้
+            'codec': {
+                'name': self.codec.name,
+                'encoded_entries': codec_stats['encoded'],
+                'saved_mb': (codec_stats['raw_bytes'] - codec_stats['stored_bytes']) / MB,
+                'compression_ratio': (
+                    codec_stats['raw_bytes'] / codec_stats['stored_bytes'] if codec_stats['stored_bytes'] else 1.0
+                ),
+                'avg_encode_ms': (
+                    codec_stats['encode_seconds'] * 1000 / codec_stats['encoded'] if codec_stats['encoded'] else 0.0
+                ),
+                'decodes': codec_stats['decodes'],
+                'avg_decode_ms': (
+                    codec_stats['decode_seconds'] * 1000 / codec_stats['decodes'] if codec_stats['decodes'] else 0.0
+                )
+            },
+            # รายการที่เก็บแต่ EnCodec codes: จำนวนครั้งและเวลาที่ใช้ถอดรหัสเป็นเสียงตอน hit
+            'codes': {
+                'enabled': CACHE_STORE_CODES,
+                'decodes': codec_stats['code_decodes'],
+                'avg_decode_ms': (
+                    codec_stats['code_decode_seconds'] * 1000 / codec_stats['code_decodes']
+                    if codec_stats['code_decodes'] else 0.0
+                ),
+                'waveforms_kept': codec_stats['waveforms_kept']
+            }
         }
         
-# สร้าง singleton instance
-cache_manager = CacheManager()
+def _file_size(path: Path) -> int:
+    """ขนาดไฟล์ (0 ถ้าไฟล์ถูกลบไปแล้ว เช่น โดย process อื่น)"""
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+        
+def _json_default(value):
+    """แปลงค่าที่ json ไม่รู้จัก (เช่น numpy scalar) ใน metadata"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+    
+# สร้าง singleton instance (สร้างจริงเมื่อใช้งานครั้งแรก)
+cache_manager = LazySingleton(CacheManager)
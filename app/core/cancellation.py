@@ -0,0 +1,108 @@
+from threading import Event, Lock
+from typing import List, Optional, Callable
+
+class CancellationToken:
+    """โทเค็นสำหรับยกเลิกคำขอสร้างเพลง (ส่งให้ queue_music_generation หรือ generate_batch)
+    
+    ถ้ายกเลิกขณะคำขอยังอยู่ในคิว คำขอจะถูกทิ้งโดยไม่สร้าง
+    ถ้ายกเลิกระหว่างสร้าง การสร้างจะหยุดที่ token ถัดไป
+    และถ้า return_partial=True จะได้เสียงส่วนที่สร้างไปแล้วเป็นผลลัพธ์ (metadata['cancelled'] = True)
+    
+    โทเค็นส่งข้าม process ไม่ได้ ผู้ที่สร้างเพลงใน process อื่น (worker pool) ลงทะเบียน callback
+    ด้วย add_callback เพื่อส่งการยกเลิกต่อไปยัง process นั้น
+    """
+    
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.return_partial = False
+    
+    def cancel(self, return_partial: bool = False):
+        """ยกเลิกคำขอ"""
+        self.return_partial = return_partial
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+    
+    def add_callback(self, callback: Callable[[], None]):
+        """เรียก callback ครั้งเดียวเมื่อถูกยกเลิก (เรียกทันทีถ้าถูกยกเลิกไปแล้ว)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+    
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+    
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+class GenerationInterrupt:
+    """stopping criteria ของ model.generate ที่หยุดการสร้างเมื่อถูกยกเลิกหรือถูกแทรกงาน
+    
+    ตรวจสอบทุก token: หยุดเมื่อทุกคำขอใน batch ถูกยกเลิก (คำขอที่ยังต้องการผลลัพธ์ทำให้ batch ต้องสร้างต่อ)
+    หรือเมื่อ preempt_check คืนค่า True (มีงานสำคัญกว่ารออยู่)
+    generate ที่ถูกหยุดจะคืนเสียงเท่าที่สร้างได้ ผู้เรียกตรวจสอบ cancelled/preempted เพื่อตัดสินใจต่อ
+    
+    MusicGen สร้าง codebook แต่ละชั้นเหลื่อมกันหนึ่ง token (delay pattern) ซึ่งปกติปิดท้ายที่ max_length
+    เมื่อหยุดกลางทางจึงต้องปิด pattern ที่ตำแหน่งที่หยุดแทน (close_pattern) ไม่เช่นนั้นแต่ละ codebook
+    จะมีจำนวน token ไม่เท่ากันและถอดรหัสเป็นเสียงไม่ได้
+    """
+    
+    def __init__(self,
+                 tokens: List[Optional[CancellationToken]],
+                 preempt_check: Optional[Callable[[], bool]] = None):
+        self.tokens = tokens
+        self.preempt_check = preempt_check
+        self.preempted = False
+        self.stopped = False
+        self.num_codebooks = 1
+        self.pad_token_id = None
+    
+    @property
+    def cancelled(self) -> bool:
+        """ทุกคำขอใน batch ถูกยกเลิกแล้ว"""
+        return bool(self.tokens) and all(token is not None and token.is_cancelled for token in self.tokens)
+    
+    def start(self, num_codebooks: int, pad_token_id: int):
+        """เตรียมสำหรับการ generate ครั้งใหม่"""
+        self.stopped = False
+        self.num_codebooks = num_codebooks
+        self.pad_token_id = pad_token_id
+    
+    def close_pattern(self, output_ids):
+        """ใส่ padding ท้ายแต่ละ codebook ของผลลัพธ์ที่ถูกหยุดกลางทาง ให้ทุก codebook มีจำนวน token เท่ากัน
+        output_ids มีรูป (batch * num_codebooks, ความยาว) หลังใช้ delay pattern mask แล้ว"""
+        if not self.stopped:
+            return output_ids
+        
+        output_ids = output_ids.clone()
+        length = output_ids.shape[-1]
+        for row in range(output_ids.shape[0]):
+            delay = self.num_codebooks - 1 - row % self.num_codebooks
+            if delay:
+                output_ids[row, length - delay:] = self.pad_token_id
+        return output_ids
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        """เรียกโดย model.generate หลังสร้างแต่ละ token คืนค่า True เพื่อหยุด"""
+        # ต้องสร้างให้ครบอย่างน้อยหนึ่ง frame ในทุก codebook ก่อนหยุด
+        if input_ids.shape[-1] < 2 * self.num_codebooks:
+            return False
+        if self.cancelled:
+            self.stopped = True
+        elif self.preempt_check is not None and self.preempt_check():
+            self.preempted = True
+            self.stopped = True
+        return self.stopped
+    
+    def resume(self):
+        """ล้างสถานะการถูกแทรกงาน ก่อนสร้างต่อ"""
+        self.preempted = False
@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+
+from app.config.settings import CACHE_LOCK_TIMEOUT, CACHE_LOCK_STALE
+from app.core.utilities import logger
+
+# guard ถูกถือเพียงช่วงตรวจแล้วลบไฟล์ lock ไฟล์ guard ที่เก่ากว่านี้จึงค้างจาก process ที่ตายกลางทางแน่นอน
+_GUARD_STALE = 10.0
+
+class FileLock:
+    """lock ระหว่าง process (และระหว่าง thread) ด้วยไฟล์ที่สร้างแบบ O_CREAT | O_EXCL
+    
+    ใช้ได้ทั้ง Windows และ POSIX โดยไม่ต้องพึ่ง fcntl/msvcrt การสร้างไฟล์แบบ exclusive สำเร็จได้ที่เดียวเท่านั้น
+    ไฟล์ lock เก็บ token ของเจ้าของ (pid + ค่าสุ่ม) release ลบเฉพาะไฟล์ที่ยังเป็นของตัวเอง
+    ไฟล์ lock ที่เก่ากว่า stale_after วินาทีถือว่าเจ้าของตายไปแล้ว (เช่น โปรแกรมปิดกะทันหัน) และถูกยึดต่อ
+    การยึดและการ release ตรวจแล้วลบไฟล์ lock ขณะถือ guard (ไฟล์ .guard แบบ O_EXCL อีกไฟล์)
+    ระหว่างนั้นไม่มีใครสร้าง lock ใหม่ได้เพราะไฟล์เดิมยังอยู่ และไม่มีใครลบได้เพราะต้องถือ guard ก่อน
+    ไฟล์ที่ลบจึงเป็นไฟล์ที่ตรวจแล้วเสมอ (ไม่ย้าย lock ที่ยังใช้อยู่ออกจากที่)
+    lock นี้ไม่ re-entrant: ถือ lock เดิมซ้ำใน thread เดียวกันจะรอจนหมดเวลา
+    """
+    
+    def __init__(self,
+                 path: Path,
+                 timeout: float = CACHE_LOCK_TIMEOUT,
+                 stale_after: float = CACHE_LOCK_STALE):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self._token = None
+        self._guard_path = self.path.with_name(f"{self.path.name}.guard")
+    
+    def acquire(self) -> bool:
+        """รอจนได้ lock คืนค่า False ถ้าเกิน timeout (timeout=0 = ลองครั้งเดียว)"""
+        deadline = time.monotonic() + self.timeout
+        delay = 0.005
+        token = f"{os.getpid()}-{uuid.uuid4().hex}"
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                self._break_if_stale()
+            else:
+                os.write(fd, token.encode())
+                os.close(fd)
+                self._token = token
+                return True
+            
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+    
+    def _break_if_stale(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return
+        age = time.time() - stat.st_mtime
+        if age <= self.stale_after:
+            return
+        
+        # ลบเฉพาะไฟล์เดียวกับที่ตรวจว่าค้าง (ไม่ใช่ lock ใหม่ที่ผู้รอรายอื่นสร้างหลังจากยึดไปแล้ว)
+        def _same_file() -> bool:
+            current = self.path.stat()
+            return (current.st_ino, current.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns)
+        if self._remove_if(_same_file, timeout=0):
+            logger.warning(f"ยึด lock ที่ค้างอยู่ {self.path.name} (ค้างมา {age:.0f} วินาที)")
+    
+    def _remove_if(self, predicate: Callable[[], bool], timeout: Optional[float] = None) -> bool:
+        """ลบไฟล์ lock ถ้า predicate() เป็นจริง โดยตรวจและลบขณะถือ guard
+        timeout = เวลารอ guard (None = self.timeout) คืนค่า True ถ้าลบไฟล์ lock แล้ว"""
+        if not self._acquire_guard(self.timeout if timeout is None else timeout):
+            return False
+        try:
+            if not predicate():
+                return False
+            self.path.unlink()
+            return True
+        except OSError:
+            return False
+        finally:
+            self._guard_path.unlink(missing_ok=True)
+    
+    def _acquire_guard(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                os.close(os.open(self._guard_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - self._guard_path.stat().st_mtime > _GUARD_STALE:
+                        self._guard_path.unlink(missing_ok=True)
+                        continue
+                except FileNotFoundError:
+                    continue
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+    
+    def release(self):
+        if self._token is None:
+            return
+        token, self._token = self._token, None
+        # lock ที่ถือนานเกิน stale_after อาจถูกยึดไปแล้ว ห้ามลบ lock ของเจ้าของใหม่
+        self._remove_if(lambda: self.path.read_text() == token)
+    
+    def __enter__(self):
+        if not self.acquire():
+            raise TimeoutError(f"รอ lock {self.path.name} เกิน {self.timeout} วินาที")
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,73 @@
+import time
+from typing import Dict, Any, Optional, Callable
+
+from app.config.settings import PROGRESS_UPDATE_INTERVAL
+from app.core.utilities import logger, seconds_to_time_format
+
+class GenerationProgress:
+    """ติดตามความคืบหน้าการสร้างเพลงระดับ token
+    
+    ใช้เป็น stopping criteria ของ model.generate ซึ่งถูกเรียกทุกครั้งที่สร้าง token ใหม่
+    (MusicGen ไม่รองรับ streamer) โดยไม่เคยสั่งให้หยุด แล้วรายงานผ่าน callback
+    ไม่ถี่กว่า interval วินาที เพื่อไม่ให้ส่ง event ไปยัง UI มากเกินไป
+    
+    ข้อมูลที่ส่งให้ callback: tokens, total_tokens, percent, tokens_per_sec, eta, elapsed
+    """
+    
+    def __init__(self,
+                 total_tokens: int,
+                 callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 interval: float = PROGRESS_UPDATE_INTERVAL):
+        self.total_tokens = max(1, int(total_tokens))
+        self.callback = callback
+        self.interval = interval
+        self.tokens = 0
+        self.start_time = time.time()
+        self._last_report = 0.0
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        """เรียกโดย model.generate หลังสร้างแต่ละ token"""
+        self.tokens += 1
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+        return False
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """สถานะความคืบหน้าปัจจุบัน"""
+        elapsed = time.time() - self.start_time
+        tokens_per_sec = self.tokens / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.total_tokens - self.tokens)
+        return {
+            "tokens": self.tokens,
+            "total_tokens": self.total_tokens,
+            "percent": min(100.0, self.tokens * 100.0 / self.total_tokens),
+            "tokens_per_sec": tokens_per_sec,
+            "eta": remaining / tokens_per_sec if tokens_per_sec > 0 else None,
+            "elapsed": elapsed
+        }
+    
+    def report(self):
+        """ส่งความคืบหน้าไปยัง callback (ข้อผิดพลาดจาก callback ไม่ทำให้การสร้างเพลงล้มเหลว)"""
+        if not self.callback:
+            return
+        try:
+            self.callback(self.snapshot())
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการรายงานความคืบหน้า: {e}")
+    
+    def finish(self):
+        """รายงานครั้งสุดท้ายเมื่อสร้างเสร็จ"""
+        self.total_tokens = max(self.tokens, 1)
+        self.report()
+
+def format_progress(info: Dict[str, Any]) -> str:
+    """แปลงข้อมูลความคืบหน้าเป็นข้อความสำหรับแสดงผล"""
+    text = (
+        f"{info['tokens']}/{info['total_tokens']} tokens "
+        f"({info['tokens_per_sec']:.1f} tokens/วินาที"
+    )
+    if info.get('eta') is not None:
+        text += f", เหลือประมาณ {seconds_to_time_format(int(info['eta']))}"
+    return text + ")"
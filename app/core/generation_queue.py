@@ -0,0 +1,177 @@
+import time
+import heapq
+import itertools
+from queue import Full
+from threading import Condition
+from typing import List, Dict, Any, Optional, Callable, Hashable
+
+from app.config.settings import BATCH_WINDOW_MS, MAX_BATCH_SIZE, GENERATION_QUEUE_MAX_SIZE
+from app.core.utilities import logger
+
+# ลำดับความสำคัญของคำขอ (ค่าน้อยได้ทำก่อน)
+PRIORITY_PREVIEW = 0  # ตัวอย่างเพลงสั้นๆ ที่ผู้ใช้รอฟังอยู่
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2  # งาน batch ที่ทำงานเบื้องหลัง
+
+class GenerationRequest:
+    """คำขอสร้างเพลงหนึ่งรายการในคิว"""
+    def __init__(self,
+                 params: Dict[str, Any],
+                 result_callback: Optional[Callable] = None,
+                 use_cache: bool = True,
+                 priority: int = PRIORITY_NORMAL,
+                 progress_callback: Optional[Callable] = None,
+                 cancel_token=None):
+        self.params = params
+        self.answered = False  # เรียก result_callback แล้ว
+        self.result_callback = self._answering(result_callback) if result_callback is not None else None
+        self.use_cache = use_cache
+        self.priority = priority
+        self.progress_callback = progress_callback
+        self.cancel_token = cancel_token  # CancellationToken หรือ None
+        self.prefix = None  # เพลงที่สั้นกว่าใน cache ที่ใช้เป็นส่วนต้น (ดู MusicGenerator._cached_prefix)
+        self.enqueued_at = time.time()
+        self.started_at = None
+    
+    def _answering(self, callback: Callable) -> Callable:
+        """callback ที่บันทึกว่าคำขอนี้ได้รับผลลัพธ์แล้ว"""
+        def _answer(success, result):
+            self.answered = True
+            return callback(success, result)
+        return _answer
+    
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancel_token is not None and self.cancel_token.is_cancelled
+    
+    @property
+    def queue_wait(self) -> float:
+        """เวลาที่รอในคิวก่อนเริ่มสร้าง (วินาที)"""
+        end = self.started_at if self.started_at is not None else time.time()
+        return end - self.enqueued_at
+
+class GenerationQueue:
+    """คิวคำขอสร้างเพลงแบบมีลำดับความสำคัญ ที่รวบรวมคำขอที่เข้ากันได้เป็น batch (dynamic batching)
+    
+    key_func คืนค่าคีย์ของกลุ่มที่รวม batch กันได้ หรือ None ถ้าคำขอนั้นต้องสร้างเดี่ยวๆ
+    คำขอที่ priority ต่ำกว่าได้ทำก่อน ถ้า priority เท่ากันทำตามลำดับที่เข้าคิว
+    """
+    
+    def __init__(self,
+                 key_func: Callable[[Dict[str, Any]], Optional[Hashable]],
+                 batch_window: float = BATCH_WINDOW_MS / 1000,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_size: int = GENERATION_QUEUE_MAX_SIZE):
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._key_func = key_func
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_size = max_size
+        
+        # สถิติเวลารอในคิว
+        self.processed_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def put(self, request: GenerationRequest, block: bool = False, timeout: Optional[float] = None):
+        """เพิ่มคำขอเข้าคิว
+        ถ้าคิวเต็ม: block=False จะ raise queue.Full ทันที, block=True จะรอจนมีที่ว่าง"""
+        with self._condition:
+            if self.max_size > 0 and len(self._heap) >= self.max_size:
+                if not block:
+                    raise Full
+                if not self._condition.wait_for(
+                    lambda: len(self._heap) < self.max_size, timeout
+                ):
+                    raise Full
+            
+            request.enqueued_at = time.time()
+            heapq.heappush(self._heap, (request.priority, next(self._counter), request))
+            self._condition.notify_all()
+    
+    def qsize(self) -> int:
+        """จำนวนคำขอที่รออยู่ทั้งหมด"""
+        with self._condition:
+            return len(self._heap)
+    
+    def is_full(self) -> bool:
+        """ตรวจสอบว่าคิวเต็มหรือไม่"""
+        return self.max_size > 0 and self.qsize() >= self.max_size
+    
+    def has_pending(self, max_priority: int) -> bool:
+        """มีคำขอที่ priority ไม่เกิน max_priority รออยู่หรือไม่ (ใช้ตัดสินใจแทรกงาน)"""
+        with self._condition:
+            return bool(self._heap) and self._heap[0][0] <= max_priority
+    
+    def next_batch(self, max_priority: Optional[int] = None) -> List[GenerationRequest]:
+        """รอจนมีคำขอ แล้วรวบรวมคำขอที่เข้ากันได้ภายใน batch_window
+        คืนค่ารายการคำขอที่จะสร้างพร้อมกันใน batch เดียว
+        ถ้าระบุ max_priority จะไม่รอ (ทั้งรอคำขอและรอรวม batch) คืนค่า [] ถ้าไม่มีคำขอที่ priority ไม่เกินค่านี้
+        และรวมเฉพาะคำขอที่ priority ไม่เกินค่านี้ (ใช้ตอนแทรกงาน ไม่ให้งานเบื้องหลังติดมากับตัวอย่างเพลง)
+        (เรียกจาก thread ประมวลผลเพียง thread เดียว)"""
+        with self._condition:
+            if max_priority is not None:
+                if not self._heap or self._heap[0][0] > max_priority:
+                    return []
+            else:
+                # รอจนมีคำขอ (ไม่ต้องวนตรวจสอบเป็นระยะ)
+                self._condition.wait_for(lambda: self._heap)
+            
+            # คำขอแรกของ batch คือคำขอที่สำคัญที่สุด
+            first = heapq.heappop(self._heap)[2]
+            batch = [first]
+            
+            key = self._key_func(first.params)
+            if key is not None and self.max_batch_size > 1:
+                # รวมคำขอที่เข้ากลุ่มเดียวกันได้ รวมถึงคำขอที่เข้ามาใหม่ภายในช่วงเวลาที่กำหนด
+                # (ตอนแทรกงานรวมเฉพาะคำขอที่รออยู่แล้ว งานที่ถูกพักไม่ต้องรอ batch_window)
+                window = 0 if max_priority is not None else self.batch_window
+                deadline = time.monotonic() + window
+                while True:
+                    self._take_matching(key, batch, max_priority)
+                    remaining = deadline - time.monotonic()
+                    if len(batch) >= self.max_batch_size or remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            
+            # มีที่ว่างในคิวแล้ว ปลุกผู้เรียกที่รออยู่
+            self._condition.notify_all()
+        
+        now = time.time()
+        for request in batch:
+            request.started_at = now
+            self.processed_count += 1
+            self.total_wait += request.queue_wait
+            self.max_wait = max(self.max_wait, request.queue_wait)
+        
+        if len(batch) > 1:
+            logger.info(f"รวมคำขอ {len(batch)} รายการเป็น batch เดียว")
+        logger.info(f"เวลารอในคิว {first.queue_wait:.2f} วินาที (เหลือในคิว {self.qsize()} รายการ)")
+        return batch
+    
+    def _take_matching(self, key: Hashable, batch: List[GenerationRequest], max_priority: Optional[int] = None):
+        """ย้ายคำขอในคิวที่มีคีย์ตรงกันเข้า batch ตามลำดับความสำคัญ (ต้องถือ lock อยู่)
+        max_priority ข้ามคำขอที่ priority เกินค่านี้"""
+        matching = [
+            entry for entry in sorted(self._heap)
+            if (max_priority is None or entry[0] <= max_priority) and self._key_func(entry[2].params) == key
+        ][:self.max_batch_size - len(batch)]
+        if not matching:
+            return
+        
+        for entry in matching:
+            self._heap.remove(entry)
+            batch.append(entry[2])
+        heapq.heapify(self._heap)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """ดึงสถิติของคิว"""
+        return {
+            "queued": self.qsize(),
+            "max_size": self.max_size,
+            "processed": self.processed_count,
+            "avg_wait": self.total_wait / self.processed_count if self.processed_count else 0.0,
+            "max_wait": self.max_wait
+        }
@@ -7,8 +7,9 @@ from app.config.settings import (
     OUTPUT_DIR, SAMPLE_RATE, INSTRUMENT_CATEGORIES,
     MOODS, MAX_DURATION
 )
-from app.core.utilities import logger, generate_filename
-from app.core.ai_engine import generate_music
+from app.core.utilities import logger, generate_filename, LazySingleton
+from app.core.ai_engine import music_generator
+from app.core.generation_queue import PRIORITY_NORMAL
 from app.core.audio_utils import (
     save_generated_audio, 
     audio_manager
@@ -27,6 +28,7 @@ class InteractiveMusicSession:
         self.base_prompt = ""
         self.current_audio = None
         self.current_metadata = None
+        self.progress_callback = None  # รับความคืบหน้าระหว่างสร้างเพลง (ดู GenerationProgress)
         
         # โหลดข้อมูล session ถ้ามี
         self._load_session()
@@ -59,6 +61,27 @@ class InteractiveMusicSession:
         except Exception as e:
             logger.error(f"ไม่สามารถบันทึก session ได้: {e}")
             
+    def _generate(self,
+                  prompt: str,
+                  duration: int,
+                  instruments: List[str],
+                  mood: str) -> Dict[str, Any]:
+        """สร้างเพลงและรอผลลัพธ์ (เรียกจาก thread แยกจาก UI)"""
+        outcome = music_generator.generate_batch(
+            [{
+                'prompt': prompt,
+                'duration': duration,
+                'instruments': instruments,
+                'mood': mood
+            }],
+            priority=PRIORITY_NORMAL,
+            progress_callback=self.progress_callback
+        )[0]
+        
+        if not outcome['success']:
+            raise RuntimeError(outcome['error'])
+        return outcome['result']
+        
     def start_new_track(self,
                        prompt: str,
                        instruments: List[str],
@@ -69,7 +92,7 @@ class InteractiveMusicSession:
         self.base_prompt = prompt
         
         # สร้างเพลง
-        result = generate_music(
+        result = self._generate(
             prompt=prompt,
             duration=duration,
             instruments=instruments,
@@ -114,7 +137,7 @@ class InteractiveMusicSession:
             prompt += f" Keep the {', '.join(keep_elements)}"
             
         # สร้างเพลงใหม่
-        result = generate_music(
+        result = self._generate(
             prompt=prompt,
             duration=self.current_metadata['duration'],
             instruments=instruments,
@@ -154,7 +177,7 @@ class InteractiveMusicSession:
         prompt = f"{self.base_prompt} but make it more {mood}"
         
         # สร้างเพลงใหม่
-        result = generate_music(
+        result = self._generate(
             prompt=prompt,
             duration=self.current_metadata['duration'],
             instruments=self.current_metadata['instruments'],
@@ -197,7 +220,7 @@ class InteractiveMusicSession:
         prompt = f"{self.base_prompt} extended version"
         
         # สร้างเพลงใหม่
-        result = generate_music(
+        result = self._generate(
             prompt=prompt,
             duration=new_duration,
             instruments=self.current_metadata['instruments'],
@@ -324,5 +347,5 @@ class InteractiveGenerator:
         """ดึงรายชื่อ session ทั้งหมด"""
         return list(self.active_sessions.keys())
         
-# สร้าง singleton instance
-interactive_generator = InteractiveGenerator()
+# สร้าง singleton instance (สร้างจริงเมื่อใช้งานครั้งแรก)
+interactive_generator = LazySingleton(InteractiveGenerator)
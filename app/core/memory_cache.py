@@ -0,0 +1,36 @@
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+from app.config.settings import CACHE_MEMORY_SIZE_MB, CACHE_MEMORY_MAX_ENTRY_MB
+from app.core.byte_lru import ByteLRUCache
+
+class MemoryResultCache(ByteLRUCache):
+    """LRU cache ของผลลัพธ์การสร้างเพลงในหน่วยความจำ (L1 ก่อน cache บนดิสก์)
+    
+    เก็บสำเนาของข้อมูลเสียงแบบอ่านอย่างเดียว เพื่อไม่ให้ผู้เรียกแก้ข้อมูลที่ถูกเก็บไว้
+    จำกัดขนาดรวมตามจำนวน byte ของเสียง เมื่อเกินจะลบรายการที่ใช้ล่าสุดนานที่สุดออกก่อน
+    ผลลัพธ์ที่ใหญ่กว่า max_entry_mb จะไม่ถูกเก็บ (ให้ cache บนดิสก์เปิดแบบ mmap แทนการคัดลอกทั้งไฟล์)
+    """
+    
+    def __init__(self, max_mb: float = CACHE_MEMORY_SIZE_MB, max_entry_mb: float = CACHE_MEMORY_MAX_ENTRY_MB):
+        super().__init__(max_mb, lambda entry: entry['audio_data'].nbytes, max_entry_mb)
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """คืนค่าผลลัพธ์ (metadata เป็นสำเนา) และย้ายไปเป็นรายการล่าสุด หรือ None"""
+        entry = super().get(key)
+        if entry is None:
+            return None
+        return {
+            'audio_data': entry['audio_data'],
+            'metadata': dict(entry['metadata'])
+        }
+    
+    def put(self, key: str, audio_data: np.ndarray, metadata: Dict[str, Any]) -> bool:
+        """เพิ่มผลลัพธ์ แล้วลบรายการเก่าจนขนาดรวมไม่เกิน max_bytes คืนค่า False ถ้าใหญ่เกินจะเก็บ"""
+        if not self.accepts(audio_data.nbytes):
+            return False
+        
+        audio_copy = np.array(audio_data, copy=True)
+        audio_copy.setflags(write=False)
+        return super().put(key, {'audio_data': audio_copy, 'metadata': dict(metadata)})
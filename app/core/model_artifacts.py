@@ -0,0 +1,122 @@
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+from app.config.settings import MODELS_DIR
+from app.core.utilities import logger
+
+# เพิ่มค่านี้เมื่อขั้นตอน optimization เปลี่ยนจนไฟล์เก่าใช้ไม่ได้
+ARTIFACT_FORMAT_VERSION = 1
+ARTIFACTS_DIR = MODELS_DIR / "optimized"
+MANIFEST_NAME = "artifact.json"
+
+def artifact_key(model_name: str, options: Dict[str, Any]) -> str:
+    """สร้างคีย์ของ artifact จากชื่อโมเดล, การตั้งค่า optimization และเวอร์ชันของไลบรารี"""
+    import torch
+    import transformers
+    
+    data = {
+        "format": ARTIFACT_FORMAT_VERSION,
+        "model": model_name,
+        "options": options,
+        "torch": torch.__version__.split("+")[0],
+        "transformers": transformers.__version__
+    }
+    raw = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+def _model_slug(model_name: str) -> str:
+    """แปลงชื่อโมเดล เช่น facebook/musicgen-small เป็นชื่อโฟลเดอร์"""
+    return model_name.replace("/", "--")
+
+def artifact_path(model_name: str, options: Dict[str, Any], root: Path = ARTIFACTS_DIR) -> Path:
+    """ตำแหน่งโฟลเดอร์ artifact ของโมเดลและการตั้งค่านี้ภายใต้ root"""
+    return root / f"{_model_slug(model_name)}-{artifact_key(model_name, options)}"
+
+def load_artifact(model_name: str,
+                  options: Dict[str, Any],
+                  **load_kwargs) -> Optional[Tuple[Any, Any]]:
+    """โหลดโมเดลและ processor ที่ผ่าน optimization แล้วจาก MODELS_DIR
+    น้ำหนักเก็บเป็น safetensors จึงถูก memory-map แทนการอ่านทั้งไฟล์
+    (ถ้ามี accelerate จะสร้างโมเดลโดยไม่จองน้ำหนักสุ่มก่อน)
+    คืนค่า (model, processor) หรือ None ถ้ายังไม่มี artifact ที่ตรงกับการตั้งค่า"""
+    path = artifact_path(model_name, options)
+    if not (path / MANIFEST_NAME).exists():
+        return None
+    
+    try:
+        import importlib.util
+        from transformers import AutoProcessor, MusicgenForConditionalGeneration
+        
+        processor = AutoProcessor.from_pretrained(path, local_files_only=True)
+        model = MusicgenForConditionalGeneration.from_pretrained(
+            path,
+            local_files_only=True,
+            use_safetensors=True,
+            low_cpu_mem_usage=importlib.util.find_spec("accelerate") is not None,
+            **load_kwargs
+        )
+        logger.info(f"โหลดโมเดลที่ optimize แล้วจาก {path}")
+        return model, processor
+    
+    except Exception as e:
+        logger.warning(f"ไม่สามารถโหลด artifact {path} ได้ จะสร้างใหม่: {e}")
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+def save_artifact(model, processor, model_name: str, options: Dict[str, Any]) -> Optional[Path]:
+    """บันทึกโมเดลที่ผ่าน optimization แล้ว (safetensors) พร้อม processor ลง MODELS_DIR
+    เขียนลงโฟลเดอร์ชั่วคราวแล้วค่อยเปลี่ยนชื่อ เพื่อไม่ให้เหลือ artifact ที่เขียนไม่ครบ"""
+    path = artifact_path(model_name, options)
+    tmp_path = path.with_name(path.name + ".tmp")
+    
+    try:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        processor.save_pretrained(tmp_path)
+        
+        # manifest เขียนเป็นไฟล์สุดท้าย ใช้เป็นเครื่องหมายว่า artifact สมบูรณ์
+        with open(tmp_path / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+            json.dump({
+                "model": model_name,
+                "options": options,
+                "format": ARTIFACT_FORMAT_VERSION
+            }, f, ensure_ascii=False, indent=2, default=str)
+        
+        shutil.rmtree(path, ignore_errors=True)
+        tmp_path.rename(path)
+        logger.info(f"บันทึกโมเดลที่ optimize แล้วไว้ที่ {path}")
+        
+        remove_stale_artifacts(model_name, keep=path)
+        return path
+    
+    except Exception as e:
+        logger.warning(f"ไม่สามารถบันทึก artifact ของโมเดลได้: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return None
+
+def remove_stale_artifacts(model_name: str,
+                           keep: Optional[Path] = None,
+                           root: Path = ARTIFACTS_DIR) -> int:
+    """ลบ artifact ของโมเดลเดียวกันที่สร้างจากการตั้งค่าเก่าภายใต้ root
+    คืนค่าจำนวนโฟลเดอร์ที่ลบ"""
+    if not root.exists():
+        return 0
+    
+    prefix = f"{_model_slug(model_name)}-"
+    removed = 0
+    for path in root.glob(f"{prefix}*"):
+        # ข้ามโมเดลอื่นที่ชื่อขึ้นต้นเหมือนกัน (ส่วนที่เหลือต้องเป็นคีย์เท่านั้น)
+        key = path.name[len(prefix):].split(".")[0]
+        if len(key) != 16 or (keep is not None and path == keep):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    
+    if removed:
+        logger.info(f"ลบ artifact เก่าของ {model_name} แล้ว {removed} รายการ")
+    return removed
@@ -0,0 +1,205 @@
+import gc
+import time
+from collections import OrderedDict
+from threading import RLock
+from typing import Dict, Any, List, Callable, Iterable
+
+import psutil
+
+from app.config.settings import MAX_RAM_USAGE, MODEL_MEMORY_ESTIMATE_GB
+from app.core.utilities import logger
+
+GB = 1024 * 1024 * 1024
+
+def _rss_bytes() -> int:
+    return psutil.Process().memory_info().rss
+
+def model_memory_bytes(model) -> int:
+    """ขนาดของน้ำหนักและ buffer ของโมเดล (byte)"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.nelement() * tensor.element_size() for tensor in tensors)
+
+class ResidentModel:
+    """โมเดลหนึ่งขนาดที่โหลดอยู่ในหน่วยความจำ พร้อมส่วนประกอบที่ผูกกับโมเดลนั้น"""
+    
+    def __init__(self,
+                 size: str,
+                 model_name: str,
+                 model,
+                 processor,
+                 kv_cache=None,
+                 onnx_backend=None,
+                 memory_bytes: int = 0):
+        self.size = size
+        self.model_name = model_name
+        self.model = model
+        self.processor = processor
+        self.kv_cache = kv_cache
+        self.onnx_backend = onnx_backend
+        self.memory_bytes = memory_bytes
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.uses = 0
+    
+    def release(self):
+        """คืน forward เดิมของโมเดลและปล่อย reference (หน่วยความจำถูกคืนเมื่อไม่มีผู้ใช้แล้ว)"""
+        if self.onnx_backend is not None:
+            self.onnx_backend.detach()
+        if self.kv_cache is not None:
+            self.kv_cache.detach()
+        self.model = None
+        self.processor = None
+        self.kv_cache = None
+        self.onnx_backend = None
+
+class ModelRegistry:
+    """เก็บโมเดล MusicGen หลายขนาดไว้ในหน่วยความจำพร้อมกัน
+    
+    โหลดโมเดลเมื่อถูกขอครั้งแรกผ่าน loader(size) แล้วเก็บไว้ใช้ซ้ำ
+    ก่อนโหลดโมเดลใหม่จะประมาณหน่วยความจำที่ต้องใช้ (RSS ปัจจุบัน + ขนาดโมเดล)
+    ถ้าเกิน max_gb จะปลดโมเดลที่ใช้ล่าสุดนานที่สุดออกก่อน (ยกเว้นโมเดลที่ถูก pin ไว้)
+    """
+    
+    def __init__(self,
+                 loader: Callable[[str], ResidentModel],
+                 max_gb: float = MAX_RAM_USAGE):
+        self.loader = loader
+        self.max_bytes = int(max_gb * GB)
+        self._models: "OrderedDict[str, ResidentModel]" = OrderedDict()
+        self._pinned: Dict[str, int] = {}
+        self._lock = RLock()
+        self.loads = 0
+        self.evictions = 0
+    
+    def get(self, size: str) -> ResidentModel:
+        """คืนโมเดลขนาด size (โหลดถ้ายังไม่มี) และย้ายไปเป็นรายการที่ใช้ล่าสุด"""
+        with self._lock:
+            entry = self._models.get(size)
+            if entry is None:
+                entry = self._load(size)
+            self._models.move_to_end(size)
+            entry.last_used = time.time()
+            entry.uses += 1
+            return entry
+    
+    def touch(self, size: str):
+        """บันทึกว่าโมเดลขนาด size เพิ่งถูกใช้ (ไม่โหลดถ้ายังไม่มี)"""
+        with self._lock:
+            entry = self._models.get(size)
+            if entry is not None:
+                self._models.move_to_end(size)
+                entry.last_used = time.time()
+                entry.uses += 1
+    
+    def _load(self, size: str) -> ResidentModel:
+        estimate = self._estimate_bytes(size)
+        self._make_room(estimate, keep=[size])
+        
+        rss_before = _rss_bytes()
+        entry = self.loader(size)
+        # ขนาดจริง: RSS ที่เพิ่มขึ้นระหว่างโหลด (รวม processor และ buffer อื่น) แต่ไม่น้อยกว่าน้ำหนักของโมเดล
+        entry.memory_bytes = max(entry.memory_bytes, _rss_bytes() - rss_before)
+        self._models[size] = entry
+        self.loads += 1
+        logger.info(
+            f"โหลดโมเดล {entry.model_name} เข้าหน่วยความจำแล้ว ({entry.memory_bytes / GB:.2f} GB, "
+            f"โหลดอยู่ {len(self._models)} โมเดล, RSS {_rss_bytes() / GB:.2f}/{self.max_bytes / GB:.2f} GB)"
+        )
+        return entry
+    
+    def _estimate_bytes(self, size: str) -> int:
+        """ขนาดโดยประมาณของโมเดลก่อนโหลด จาก MODEL_MEMORY_ESTIMATE_GB"""
+        return int(MODEL_MEMORY_ESTIMATE_GB.get(size, 0) * GB)
+    
+    def _make_room(self, needed_bytes: int, keep: Iterable[str] = ()):
+        """ปลดโมเดล LRU จนหน่วยความจำหลังโหลดโมเดลใหม่ไม่เกิน max_bytes
+        ถ้าปลดทุกโมเดลที่ปลดได้แล้วยังไม่พอ จะ raise MemoryError โดยไม่ปลดโมเดลใด"""
+        keep = set(keep) | {size for size, count in self._pinned.items() if count > 0}
+        projected = _rss_bytes() + needed_bytes
+        victims = []
+        for size in self._models:
+            if projected <= self.max_bytes:
+                break
+            if size in keep:
+                continue
+            projected -= self._models[size].memory_bytes
+            victims.append(size)
+        
+        if projected > self.max_bytes:
+            raise MemoryError(
+                f"หน่วยความจำไม่พอสำหรับโหลดโมเดลเพิ่ม (ต้องใช้ประมาณ {projected / GB:.1f} GB, "
+                f"จำกัดที่ MAX_RAM_USAGE {self.max_bytes / GB:.1f} GB)"
+            )
+        
+        for size in victims:
+            logger.info(f"หน่วยความจำจะเกิน MAX_RAM_USAGE ปลดโมเดล {size} ที่ใช้ล่าสุดนานที่สุดก่อน")
+            self.evict(size)
+        if victims:
+            gc.collect()
+    
+    def evict(self, size: str) -> bool:
+        """ปลดโมเดลขนาด size ออกจากหน่วยความจำ"""
+        with self._lock:
+            entry = self._models.pop(size, None)
+            if entry is None:
+                return False
+            entry.release()
+            self.evictions += 1
+            logger.info(f"ปลดโมเดล {entry.model_name} ออกจากหน่วยความจำแล้ว")
+            return True
+    
+    def expected_bytes(self, size: str) -> int:
+        """ขนาดของโมเดลขนาด size: ขนาดที่วัดได้ถ้าโหลดอยู่ มิฉะนั้นใช้ค่าประมาณ"""
+        with self._lock:
+            entry = self._models.get(size)
+            return entry.memory_bytes if entry is not None else self._estimate_bytes(size)
+    
+    def release_idle(self, keep: Iterable[str] = ()) -> int:
+        """ปลดทุกโมเดลยกเว้น keep และโมเดลที่ถูก pin คืนค่าจำนวนโมเดลที่ปลด"""
+        with self._lock:
+            keep = set(keep) | {size for size, count in self._pinned.items() if count > 0}
+            released = [size for size in list(self._models) if size not in keep and self.evict(size)]
+        if released:
+            gc.collect()
+        return len(released)
+    
+    def pin(self, size: str):
+        """ห้ามปลดโมเดลนี้จนกว่าจะเรียก unpin (เช่น โมเดลของงานยาวที่ถูกพักไว้)"""
+        with self._lock:
+            self._pinned[size] = self._pinned.get(size, 0) + 1
+    
+    def unpin(self, size: str):
+        with self._lock:
+            if self._pinned.get(size, 0) > 0:
+                self._pinned[size] -= 1
+    
+    def resident_sizes(self) -> List[str]:
+        """ขนาดของโมเดลที่โหลดอยู่ เรียงจากใช้ล่าสุดนานที่สุด"""
+        with self._lock:
+            return list(self._models)
+    
+    def clear(self):
+        """ปลดทุกโมเดล"""
+        with self._lock:
+            for size in list(self._models):
+                self.evict(size)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """สถานะของโมเดลที่โหลดอยู่และการใช้หน่วยความจำ"""
+        with self._lock:
+            return {
+                "models": [
+                    {
+                        "size": entry.size,
+                        "model": entry.model_name,
+                        "memory_gb": entry.memory_bytes / GB,
+                        "uses": entry.uses,
+                        "idle_seconds": time.time() - entry.last_used
+                    }
+                    for entry in self._models.values()
+                ],
+                "rss_gb": _rss_bytes() / GB,
+                "max_gb": self.max_bytes / GB,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,340 @@
+import json
+import shutil
+import inspect
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import torch
+
+from app.config.settings import (
+    MODELS_DIR, ONNX_OPSET,
+    ONNX_INTRA_OP_THREADS, ONNX_INTER_OP_THREADS
+)
+from app.core.utilities import logger
+from app.core.model_artifacts import artifact_path, remove_stale_artifacts, MANIFEST_NAME
+
+ONNX_DIR = MODELS_DIR / "onnx"
+KV_NAMES = ("self_key", "self_value", "cross_key", "cross_value")
+# จำนวน frame ของ EnCodec ที่ใช้ตอน trace (สั้นกว่านี้ reflect padding จะเข้าเงื่อนไขอื่น จึงใช้ PyTorch)
+AUDIO_EXPORT_FRAMES = 16
+
+class _DecoderExportWrapper(torch.nn.Module):
+    """ห่อ MusicgenForCausalLM ให้รับ/คืน KV cache เป็น tensor แบน ๆ สำหรับ export ONNX"""
+    
+    def __init__(self, decoder, with_past: bool):
+        super().__init__()
+        self.decoder = decoder
+        self.with_past = with_past
+        self.num_layers = decoder.config.num_hidden_layers
+    
+    def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask, *past_flat):
+        past_key_values = None
+        if self.with_past:
+            past_key_values = tuple(
+                tuple(past_flat[i * 4:(i + 1) * 4]) for i in range(self.num_layers)
+            )
+        
+        outputs = self.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True
+        )
+        present = [tensor for layer in outputs.past_key_values for tensor in layer]
+        return (outputs.logits, *present)
+
+class OnnxBackend:
+    """รัน decoder step ของ MusicGen (พร้อม KV cache) และ EnCodec decoder ด้วย ONNX Runtime บน CPU
+    
+    ส่วนอื่นของ model.generate (text encoder, delay pattern, sampling) ยังเป็นของ transformers
+    backend นี้แทนที่ forward ของ model.decoder และ model.audio_encoder.decoder ของโมเดลนั้นเท่านั้น
+    กรณีที่ graph ไม่รองรับ (เช่น decoder attention mask จาก audio prompt ที่มี padding)
+    จะใช้ forward เดิมของ PyTorch แทน
+    
+    graph ที่ export แล้วเก็บไว้ใน MODELS_DIR/onnx โดยใช้คีย์เดียวกับ artifact ของโมเดล
+    """
+    
+    def __init__(self,
+                 model,
+                 model_name: str,
+                 options: Dict[str, Any],
+                 intra_op_threads: Optional[int] = None):
+        self.model = model
+        self.model_name = model_name
+        self.options = {**options, "opset": ONNX_OPSET}
+        self.path = artifact_path(model_name, self.options, root=ONNX_DIR)
+        self.num_layers = model.decoder.config.num_hidden_layers
+        self.max_positions = model.decoder.config.max_position_embeddings
+        self.intra_op_threads = intra_op_threads or ONNX_INTRA_OP_THREADS
+        self._sessions = {}
+        self._input_names = {}
+        self._torch_decoder_forward = None
+        self._torch_audio_decoder_forward = None
+    
+    def attach(self) -> bool:
+        """export graph (ถ้ายังไม่มี) สร้าง session แล้วเปลี่ยนให้โมเดลรันผ่าน ONNX Runtime
+        คืนค่า False ถ้าใช้ ONNX ไม่ได้ (โมเดลยังใช้ PyTorch ตามเดิม)"""
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            logger.warning("ไม่พบ onnxruntime ใช้ PyTorch backend แทน")
+            return False
+        
+        try:
+            if not (self.path / MANIFEST_NAME).exists():
+                self._export()
+            
+            session_options = ort.SessionOptions()
+            session_options.intra_op_num_threads = self.intra_op_threads
+            session_options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+            session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            
+            for name in ("decoder_init", "decoder_with_past", "audio_decoder"):
+                self._sessions[name] = ort.InferenceSession(
+                    str(self.path / f"{name}.onnx"),
+                    sess_options=session_options,
+                    providers=["CPUExecutionProvider"]
+                )
+                self._input_names[self._sessions[name]] = [i.name for i in self._sessions[name].get_inputs()]
+        
+        except Exception as e:
+            logger.warning(f"ไม่สามารถเตรียม ONNX backend ได้ ใช้ PyTorch แทน: {e}")
+            self._sessions = {}
+            return False
+        
+        # แทนที่ forward ของโมเดลนี้ (instance attribute ไม่กระทบโมเดลอื่น)
+        self._torch_decoder_forward = self.model.decoder.forward
+        self._torch_audio_decoder_forward = self.model.audio_encoder.decoder.forward
+        self.model.decoder.forward = self._decoder_forward
+        self.model.audio_encoder.decoder.forward = self._audio_decoder_forward
+        
+        logger.info(
+            f"ใช้ ONNX Runtime backend ({self.intra_op_threads} intra-op, "
+            f"{ONNX_INTER_OP_THREADS} inter-op threads)"
+        )
+        return True
+    
+    def detach(self):
+        """กลับไปใช้ forward ของ PyTorch"""
+        if self._torch_decoder_forward is not None:
+            self.model.decoder.forward = self._torch_decoder_forward
+            self.model.audio_encoder.decoder.forward = self._torch_audio_decoder_forward
+            self._torch_decoder_forward = None
+            self._torch_audio_decoder_forward = None
+        self._sessions = {}
+    
+    def _export(self):
+        """export decoder (ครั้งแรกไม่มี KV cache / step ที่มี KV cache) และ EnCodec decoder เป็น ONNX"""
+        logger.info(f"กำลัง export โมเดลเป็น ONNX ไปที่ {self.path} (ทำครั้งเดียว)...")
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        
+        decoder = self.model.decoder
+        config = decoder.config
+        num_codebooks = decoder.num_codebooks
+        num_heads = config.num_attention_heads
+        head_dim = config.hidden_size // num_heads
+        
+        # ข้อมูลตัวอย่างสำหรับ trace (ขนาดจริงกำหนดเป็น dynamic axes)
+        batch_size, encoder_length, past_length = 2, 4, 3
+        encoder_hidden_states = torch.zeros(batch_size, encoder_length, config.hidden_size)
+        encoder_attention_mask = torch.ones(batch_size, encoder_length, dtype=torch.long)
+        past_flat = []
+        for _ in range(self.num_layers):
+            past_flat += [
+                torch.zeros(batch_size, num_heads, past_length, head_dim),
+                torch.zeros(batch_size, num_heads, past_length, head_dim),
+                torch.zeros(batch_size, num_heads, encoder_length, head_dim),
+                torch.zeros(batch_size, num_heads, encoder_length, head_dim)
+            ]
+        
+        common_axes = {
+            "input_ids": {0: "batch_codebooks", 1: "sequence"},
+            "encoder_hidden_states": {0: "batch", 1: "encoder_sequence"},
+            "encoder_attention_mask": {0: "batch", 1: "encoder_sequence"},
+            "logits": {0: "batch_codebooks", 1: "sequence"}
+        }
+        present_names = [f"present.{i}.{kv}" for i in range(self.num_layers) for kv in KV_NAMES]
+        past_names = [f"past.{i}.{kv}" for i in range(self.num_layers) for kv in KV_NAMES]
+        
+        def _kv_axes(names, self_length):
+            axes = {}
+            for name in names:
+                length = self_length if "self" in name else "encoder_sequence"
+                axes[name] = {0: "batch", 2: length}
+            return axes
+        
+        with torch.no_grad():
+            # ครั้งแรก: ประมวลผล prompt ทั้งหมด (ความยาว > 1 เพื่อให้ causal mask อยู่ใน graph)
+            self._export_module(
+                _DecoderExportWrapper(decoder, with_past=False),
+                (
+                    torch.zeros(batch_size * num_codebooks, 2, dtype=torch.long),
+                    encoder_hidden_states,
+                    encoder_attention_mask
+                ),
+                tmp_path / "decoder_init.onnx",
+                ["input_ids", "encoder_hidden_states", "encoder_attention_mask"],
+                ["logits"] + present_names,
+                {**common_axes, **_kv_axes(present_names, "sequence")}
+            )
+            
+            # step ถัดไป: token ละ 1 ตำแหน่งพร้อม KV cache
+            self._export_module(
+                _DecoderExportWrapper(decoder, with_past=True),
+                (
+                    torch.zeros(batch_size * num_codebooks, 1, dtype=torch.long),
+                    encoder_hidden_states,
+                    encoder_attention_mask,
+                    *past_flat
+                ),
+                tmp_path / "decoder_with_past.onnx",
+                ["input_ids", "encoder_hidden_states", "encoder_attention_mask"] + past_names,
+                ["logits"] + present_names,
+                {
+                    **common_axes,
+                    **_kv_axes(past_names, "past_sequence"),
+                    **_kv_axes(present_names, "total_sequence")
+                }
+            )
+            
+            # EnCodec decoder: embeddings ของ codebook -> waveform
+            self._export_audio_decoder(tmp_path / "audio_decoder.onnx")
+        
+        with open(tmp_path / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+            json.dump({"model": self.model_name, "options": self.options}, f, ensure_ascii=False, indent=2, default=str)
+        
+        shutil.rmtree(self.path, ignore_errors=True)
+        tmp_path.rename(self.path)
+        remove_stale_artifacts(self.model_name, keep=self.path, root=ONNX_DIR)
+        logger.info("export ONNX เสร็จแล้ว")
+    
+    def _export_audio_decoder(self, path: Path):
+        """export EnCodec decoder ให้รับจำนวน frame ได้ทุกความยาว
+        
+        EncodecConv1d คำนวณ extra padding ด้วย math.ceil ซึ่ง tracer บันทึกเป็นค่าคงที่ของความยาวตัวอย่าง
+        conv ใน decoder มี stride 1 ทั้งหมด (การขยายความยาวอยู่ใน ConvTranspose) ค่านี้จึงเป็น 0 เสมอ
+        ระหว่าง export จึงแทนที่ด้วยค่า 0 โดยตรงเพื่อให้ graph ไม่ผูกกับความยาวตัวอย่าง"""
+        from transformers.models.encodec.modeling_encodec import EncodecConv1d
+        
+        original = EncodecConv1d._get_extra_padding_for_conv1d
+        
+        def _extra_padding(hidden_states, kernel_size, stride, padding_total=0):
+            if stride == 1:
+                return 0
+            return original(hidden_states, kernel_size, stride, padding_total)
+        
+        embedding_dim = self.model.config.audio_encoder.hidden_size
+        EncodecConv1d._get_extra_padding_for_conv1d = staticmethod(_extra_padding)
+        try:
+            self._export_module(
+                self.model.audio_encoder.decoder,
+                (torch.zeros(1, embedding_dim, AUDIO_EXPORT_FRAMES),),
+                path,
+                ["embeddings"],
+                ["audio_values"],
+                {"embeddings": {0: "batch", 2: "frames"}, "audio_values": {0: "batch", 2: "samples"}}
+            )
+        finally:
+            EncodecConv1d._get_extra_padding_for_conv1d = staticmethod(original)
+    
+    @staticmethod
+    def _export_module(module, args, path: Path, input_names, output_names, dynamic_axes):
+        """เรียก torch.onnx.export ด้วย exporter แบบ TorchScript (รองรับ dynamic_axes)"""
+        export_kwargs = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            export_kwargs["dynamo"] = False
+        
+        torch.onnx.export(
+            module,
+            args,
+            str(path),
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+            do_constant_folding=True,
+            **export_kwargs
+        )
+    
+    def _decoder_forward(self,
+                         input_ids=None,
+                         attention_mask=None,
+                         encoder_hidden_states=None,
+                         encoder_attention_mask=None,
+                         past_key_values=None,
+                         inputs_embeds=None,
+                         use_cache=None,
+                         output_attentions=None,
+                         output_hidden_states=None,
+                         return_dict=None,
+                         **kwargs):
+        """แทน MusicgenForCausalLM.forward ระหว่าง generate"""
+        from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
+        
+        past_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        unsupported = (
+            input_ids is None
+            or encoder_hidden_states is None
+            or inputs_embeds is not None
+            or output_attentions
+            or output_hidden_states
+            or (attention_mask is not None and not bool(attention_mask.all()))
+            or past_length + input_ids.shape[-1] > self.max_positions
+            or (past_key_values is not None and input_ids.shape[-1] != 1)
+        )
+        if unsupported:
+            return self._torch_decoder_forward(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                past_key_values=past_key_values,
+                inputs_embeds=inputs_embeds,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+                **kwargs
+            )
+        
+        if encoder_attention_mask is None:
+            encoder_attention_mask = torch.ones(encoder_hidden_states.shape[:2], dtype=torch.long)
+        
+        feeds = {
+            "input_ids": input_ids.cpu().numpy(),
+            "encoder_hidden_states": encoder_hidden_states.float().cpu().numpy(),
+            "encoder_attention_mask": encoder_attention_mask.long().cpu().numpy()
+        }
+        if past_key_values is None:
+            session = self._sessions["decoder_init"]
+        else:
+            session = self._sessions["decoder_with_past"]
+            for i, layer in enumerate(past_key_values):
+                for kv, tensor in zip(KV_NAMES, layer):
+                    feeds[f"past.{i}.{kv}"] = tensor.cpu().numpy()
+        
+        # graph ที่มี KV cache ใช้ cross-attention จาก cache แทน encoder_hidden_states
+        # (exporter ตัด input ที่ไม่ได้ใช้ออก) จึงส่งเฉพาะ input ที่ graph ต้องการ
+        feeds = {name: feeds[name] for name in self._input_names[session]}
+        outputs = [torch.from_numpy(output) for output in session.run(None, feeds)]
+        present = tuple(
+            tuple(outputs[1 + i * 4:1 + (i + 1) * 4]) for i in range(self.num_layers)
+        )
+        
+        if return_dict is False:
+            return (outputs[0], present)
+        return CausalLMOutputWithCrossAttentions(logits=outputs[0], past_key_values=present)
+    
+    def _audio_decoder_forward(self, hidden_states):
+        """แทน EncodecDecoder.forward (embeddings -> waveform)"""
+        if hidden_states.shape[-1] < AUDIO_EXPORT_FRAMES:
+            return self._torch_audio_decoder_forward(hidden_states)
+        audio = self._sessions["audio_decoder"].run(
+            None, {"embeddings": hidden_states.float().cpu().numpy()}
+        )[0]
+        return torch.from_numpy(audio)
@@ -4,7 +4,7 @@ from typing import Dict, List, Any, Optional
 from datetime import datetime
 
 from app.config.settings import BASE_DIR
-from app.core.utilities import logger
+from app.core.utilities import logger, LazySingleton
 
 class PresetManager:
     """จัดการ presets สำหรับการสร้างเพลง"""
@@ -186,5 +186,5 @@ class PresetManager:
         """ดึงข้อมูล presets ที่ใช้ล่าสุด"""
         return self.presets['recent']
         
-# สร้าง singleton instance
-preset_manager = PresetManager()
+# สร้าง singleton instance (สร้างจริงเมื่อใช้งานครั้งแรก)
+preset_manager = LazySingleton(PresetManager)
@@ -0,0 +1,51 @@
+import unicodedata
+from typing import Dict, Any, List, Optional
+
+from app.config.settings import (
+    GENERATION_CONFIG, MAX_DURATION, SEGMENTED_GENERATION, SEGMENT_DURATION, SEGMENT_CONTEXT,
+    SEGMENT_CROSSFADE
+)
+
+def normalize_text(text: str) -> str:
+    """รูปแบบมาตรฐานของข้อความในคำขอ: Unicode NFC, ช่องว่างติดกันเหลือหนึ่งช่อง, ไม่สนตัวพิมพ์เล็ก/ใหญ่"""
+    return " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+
+def normalize_instruments(instruments: List[str]) -> List[str]:
+    """เครื่องดนตรีแบบเรียงลำดับและไม่ซ้ำ (ลำดับที่เลือกไม่มีผลต่อความหมายของคำขอ)"""
+    return sorted({normalize_text(instrument) for instrument in instruments})
+
+def request_fingerprint(params: Dict[str, Any],
+                        model_name: str,
+                        quantization: Optional[str] = None) -> Dict[str, Any]:
+    """fingerprint ของคำขอสร้างเพลงที่ใช้เป็นคีย์ cache
+    
+    คำขอสองคำขอที่ต่างกันแค่ตัวพิมพ์/ช่องว่างของ prompt หรือลำดับเครื่องดนตรีได้ fingerprint เดียวกัน
+    (การสร้างเพลงเป็นการสุ่มอยู่แล้ว ผลลัพธ์ใน cache จึงเป็นตัวอย่างที่ใช้ได้ของทั้งสองคำขอ)
+    ส่วนทุกอย่างที่ทำให้เสียงต่างกันจริงถูกใส่ไว้ด้วย: โมเดล, quantization, generation config,
+    การแบ่งช่วงของเพลงยาว และ seed (ถ้าคำขอระบุ)
+    ฟิลด์อื่นใน params (เช่น use_cache) ไม่มีผลต่อ fingerprint
+    """
+    duration = min(params['duration'], MAX_DURATION)
+    fingerprint = {
+        "prompt": normalize_text(params['prompt']),
+        "instruments": normalize_instruments(params['instruments']),
+        "mood": normalize_text(params['mood']),
+        "duration": round(float(duration), 3),
+        "model": model_name,
+        "quantization": quantization,
+        "generation_config": dict(sorted(GENERATION_CONFIG.items())),
+        "seed": params.get('seed')
+    }
+    if SEGMENTED_GENERATION and duration > SEGMENT_DURATION:
+        fingerprint["segments"] = {
+            "duration": SEGMENT_DURATION,
+            "context": SEGMENT_CONTEXT,
+            "crossfade": SEGMENT_CROSSFADE
+        }
+    return fingerprint
+
+def prefix_family(fingerprint: Dict[str, Any]) -> Dict[str, Any]:
+    """ส่วนของ fingerprint ที่ไม่ขึ้นกับความยาวเพลง
+    คำขอที่ต่างกันแค่ความยาวอยู่ใน family เดียวกัน ส่วนต้นของเพลงหนึ่งจึงใช้แทนอีกเพลงได้
+    (การสร้างเป็นแบบ autoregressive เสียงช่วงแรกไม่ขึ้นกับว่าจะสร้างต่ออีกนานเท่าไร)"""
+    return {key: value for key, value in fingerprint.items() if key not in ("duration", "segments")}
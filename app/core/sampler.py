@@ -0,0 +1,164 @@
+from typing import Dict, Any, Optional, List, Callable
+
+import torch
+
+class MusicGenSampler:
+    """ลูปสร้าง token ของ MusicGen ที่เขียนเฉพาะสำหรับโมเดลนี้ ใช้แทน model.generate
+    
+    generate ของ transformers ส่ง logits ผ่าน logits processor/warper ทีละตัวใน Python ทุก token
+    (repetition penalty, classifier-free guidance, temperature, top-k, top-p) และใช้ delay pattern mask
+    กับ input ทั้งหมดทุกรอบ ลูปนี้รวมขั้นตอนเหล่านั้นเป็น tensor op ไม่กี่ตัวต่อ token:
+    - ผสม logits ของ branch ที่มี/ไม่มีเงื่อนไขด้วย lerp ครั้งเดียว
+    - repetition penalty กับ token ที่สร้างแล้ว (ข้าม padding ของ delay pattern ซึ่งอยู่นอก vocab)
+    - เลือก top-k ก่อนแล้วทำ top-p บน k ค่าที่เรียงแล้ว (ไม่ต้องเรียงทั้ง vocab)
+    - เขียน token ลง buffer ของลำดับที่จองไว้ พร้อมแทนตำแหน่ง padding ของ delay pattern ทันที
+    
+    ให้ผลเหมือน generate (greedy ได้ผลตรงกันทุก token) และคืนค่าเป็นเสียงแบบเดียวกัน
+    """
+    
+    def __init__(self, model):
+        self.model = model
+    
+    def _option(self, generation_kwargs: Dict[str, Any], name: str):
+        return generation_kwargs.get(name, getattr(self.model.generation_config, name, None))
+    
+    def _prepare_decoder_input_ids(self, inputs: Dict[str, Any], batch_size: int):
+        """token เริ่มต้นของ decoder: token เริ่ม ตามด้วย code ของ audio prompt (ถ้ามี)
+        audio prompt เป็นได้ทั้งเสียง (input_values) หรือ code ที่มีอยู่แล้ว (decoder_input_ids เหมือน generate)
+        คืนค่า (decoder_input_ids รูป (batch * codebooks, ความยาว), audio_scales)"""
+        decoder = self.model.decoder
+        start_token_id = self.model.generation_config.decoder_start_token_id
+        device = inputs["attention_mask"].device
+        start_ids = torch.full(
+            (batch_size * decoder.num_codebooks, 1), start_token_id, dtype=torch.long, device=device
+        )
+        if inputs.get("decoder_input_ids") is not None:
+            return torch.cat([start_ids, inputs["decoder_input_ids"]], dim=-1), [None] * batch_size
+        if inputs.get("input_values") is None:
+            return start_ids, [None] * batch_size
+        
+        encoded = self.model.audio_encoder.encode(
+            input_values=inputs["input_values"],
+            padding_mask=inputs.get("padding_mask"),
+            return_dict=True
+        )
+        audio_codes = encoded.audio_codes
+        frames, bsz, codebooks, seq_len = audio_codes.shape
+        if frames != 1:
+            raise ValueError(f"audio prompt ต้องเข้ารหัสได้ 1 frame (ได้ {frames}) ปิด chunking ของ EnCodec")
+        prompt_ids = audio_codes[0].reshape(bsz * decoder.num_codebooks, seq_len)
+        return torch.cat([start_ids, prompt_ids], dim=-1), encoded.audio_scales
+    
+    @torch.no_grad()
+    def generate(self,
+                 inputs: Dict[str, Any],
+                 generation_kwargs: Dict[str, Any],
+                 stopping_criteria: Optional[List[Callable]] = None) -> torch.Tensor:
+        """สร้างเสียงจาก inputs ของ MusicGenerator._encode_text (input_ids, attention_mask ที่รวม
+        branch ไม่มีเงื่อนไขแล้ว, encoder_outputs) และ input_values/padding_mask หรือ decoder_input_ids ของ audio prompt
+        stopping_criteria ถูกเรียกทุก token แบบเดียวกับ generate
+        คืนค่าเสียงรูป (batch, 1, samples)"""
+        model = self.model
+        decoder = model.decoder
+        num_codebooks = decoder.num_codebooks
+        pad_token_id = model.generation_config.pad_token_id
+        
+        do_sample = self._option(generation_kwargs, "do_sample")
+        guidance_scale = self._option(generation_kwargs, "guidance_scale") or 1.0
+        temperature = self._option(generation_kwargs, "temperature") or 1.0
+        top_k = self._option(generation_kwargs, "top_k") or 0
+        top_p = self._option(generation_kwargs, "top_p") or 1.0
+        repetition_penalty = self._option(generation_kwargs, "repetition_penalty") or 1.0
+        use_guidance = guidance_scale > 1
+        
+        batch_size = inputs["input_ids"].shape[0]
+        attention_mask = inputs["attention_mask"]
+        encoder_hidden_states = inputs["encoder_outputs"].last_hidden_state
+        # projection และ mask ของ encoder hidden states ทำครั้งเดียว (forward ของโมเดลทำซ้ำทุก token)
+        if (model.text_encoder.config.hidden_size != decoder.config.hidden_size
+                and decoder.config.cross_attention_hidden_size is None):
+            encoder_hidden_states = model.enc_to_dec_proj(encoder_hidden_states)
+        encoder_hidden_states = encoder_hidden_states * attention_mask[..., None]
+        
+        prompt_ids, audio_scales = self._prepare_decoder_input_ids(inputs, batch_size)
+        max_length = prompt_ids.shape[-1] + generation_kwargs["max_new_tokens"]
+        decoder_input_ids, pattern_mask = decoder.build_delay_pattern_mask(
+            prompt_ids, pad_token_id=model.generation_config.decoder_start_token_id, max_length=max_length
+        )
+        
+        # ลำดับทั้งหมดจองไว้ล่วงหน้า ตำแหน่งที่ delay pattern กำหนดไว้แล้วมีค่าอยู่แล้ว (-1 = ต้องสร้าง)
+        sequence = pattern_mask.clone()
+        length = decoder_input_ids.shape[-1]
+        sequence[:, :length] = decoder_input_ids
+        vocab_size = decoder.config.vocab_size
+        criteria = stopping_criteria or []
+        
+        step_ids = decoder_input_ids
+        past_key_values = None
+        while length < max_length:
+            if use_guidance:
+                step_ids = step_ids.repeat((2, 1))
+            outputs = decoder(
+                input_ids=step_ids,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True
+            )
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits[:, -1, :].float()
+            
+            if use_guidance:
+                cond_logits, uncond_logits = logits.chunk(2, dim=0)
+                scores = torch.lerp(uncond_logits, cond_logits, guidance_scale)
+            else:
+                scores = logits
+            
+            if repetition_penalty != 1.0:
+                # padding ของ delay pattern (token id >= vocab) ชี้ไปคอลัมน์สำรองท้าย scores จึงไม่ถูกนับ
+                previous = sequence[:, :length].clamp(max=vocab_size)
+                extended = torch.nn.functional.pad(scores, (0, 1))
+                penalized = extended.gather(1, previous)
+                penalized = torch.where(penalized < 0, penalized * repetition_penalty, penalized / repetition_penalty)
+                scores = extended.scatter(1, previous, penalized)[:, :vocab_size]
+            
+            if do_sample:
+                next_tokens = self._sample(scores, temperature, top_k, top_p)
+            else:
+                next_tokens = scores.argmax(dim=-1)
+            
+            # ใช้ delay pattern กับ token ใหม่ (ตำแหน่ง padding ใช้ค่าจาก mask)
+            expected = pattern_mask[:, length]
+            next_tokens = torch.where(expected == -1, next_tokens, expected)
+            sequence[:, length] = next_tokens
+            length += 1
+            
+            if any([bool(criterion(sequence[:, :length], scores)) for criterion in criteria]):
+                break
+            step_ids = next_tokens[:, None]
+        
+        output_ids = decoder.apply_delay_pattern_mask(sequence[:, :length], pattern_mask)
+        output_ids = output_ids[output_ids != pad_token_id].reshape(batch_size, num_codebooks, -1)
+        return model.audio_encoder.decode(output_ids[None, ...], audio_scales=audio_scales).audio_values
+    
+    @staticmethod
+    def _sample(scores: torch.Tensor, temperature: float, top_k: int, top_p: float) -> torch.Tensor:
+        """สุ่ม token จาก scores หลังใช้ temperature, top-k และ top-p
+        (top-p คิดจาก token ที่ผ่าน top-k แล้ว ได้ผลเท่ากับ warper ของ transformers ที่ใช้ตามลำดับเดียวกัน)"""
+        if temperature != 1.0:
+            scores = scores / temperature
+        if 0 < top_k < scores.shape[-1]:
+            # topk คืนค่าเรียงจากมากไปน้อยอยู่แล้ว
+            values, indices = scores.topk(top_k, dim=-1)
+        else:
+            values, indices = scores.sort(dim=-1, descending=True)
+        
+        probs = values.softmax(dim=-1)
+        if top_p < 1.0:
+            # เก็บ token ที่ความน่าจะเป็นสะสมก่อนหน้ายังไม่ถึง top_p (token แรกอยู่เสมอ)
+            cumulative = probs.cumsum(dim=-1) - probs
+            probs = probs.masked_fill(cumulative >= top_p, 0.0)
+        
+        choice = torch.multinomial(probs, num_samples=1)
+        return indices.gather(-1, choice).squeeze(-1)
@@ -0,0 +1,108 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+from threading import Thread
+from typing import List, Dict, Any, Optional, Callable
+
+from app.config.settings import BASE_DIR, STARTUP_IMPORT_BUDGET
+from app.core.utilities import logger
+
+# โมดูลที่ต้อง import ก่อนหน้าต่างหลักแสดงผล
+STARTUP_MODULES = ("app.ui.main_window",)
+
+# โมดูลที่ใช้เวลา import นาน ไม่ควรถูกโหลดก่อนหน้าต่างแสดงผล
+HEAVY_MODULES = ("torch", "transformers", "librosa", "onnxruntime")
+
+def warm_up(callback: Optional[Callable[[float], None]] = None) -> Thread:
+    """สร้าง singleton ของ core ใน thread แยกหลังหน้าต่างแสดงผลแล้ว
+    (อ่าน cache index, presets และงาน batch ที่ค้างอยู่) เพื่อให้การใช้งานครั้งแรกไม่ต้องรอ
+    callback(เวลาที่ใช้) ถูกเรียกเมื่อเสร็จ"""
+    def _run():
+        start_time = time.perf_counter()
+        try:
+            from app.core.cache_manager import cache_manager
+            from app.core.preset_manager import preset_manager
+            from app.core.audio_utils import audio_manager
+            from app.core.batch_generator import batch_generator
+            
+            for singleton in (cache_manager, preset_manager, audio_manager, batch_generator):
+                singleton.get_instance()
+        
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการเตรียม core: {e}")
+        
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"เตรียม core เบื้องหลังเสร็จแล้ว ใช้เวลา {elapsed:.2f} วินาที")
+        if callback:
+            callback(elapsed)
+    
+    thread = Thread(target=_run, daemon=True)
+    thread.start()
+    return thread
+
+def measure_import(module: str) -> Dict[str, Any]:
+    """วัดเวลา import โมดูลใน interpreter ใหม่ (ไม่มี cache ของ sys.modules)
+    คืนค่าเวลาที่ใช้และโมดูลหนักที่ถูกโหลดไปด้วย"""
+    code = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        "print(json.dumps({'seconds': elapsed, 'heavy': heavy}))\n"
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=str(BASE_DIR),
+        capture_output=True,
+        text=True
+    )
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()
+        return {"module": module, "error": error[-1] if error else f"exit code {process.returncode}"}
+    
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["module"] = module
+    return result
+
+def check_import_budget(modules: List[str] = STARTUP_MODULES,
+                        budget: float = STARTUP_IMPORT_BUDGET) -> List[Dict[str, Any]]:
+    """ตรวจสอบว่า import โมดูลที่ใช้ตอนเปิดโปรแกรมได้ภายในเวลาที่กำหนด และไม่ได้โหลดโมดูลหนัก"""
+    report = []
+    for module in modules:
+        result = measure_import(module)
+        if "error" not in result:
+            result["within_budget"] = result["seconds"] <= budget and not result["heavy"]
+            if not result["within_budget"]:
+                logger.warning(
+                    f"import {module} ใช้เวลา {result['seconds']:.2f} วินาที "
+                    f"(งบ {budget:.2f} วินาที, โมดูลหนัก: {', '.join(result['heavy']) or '-'})"
+                )
+        report.append(result)
+    return report
+
+def format_report(report: List[Dict[str, Any]], budget: float = STARTUP_IMPORT_BUDGET) -> str:
+    """แปลงผลการวัดเป็นตาราง"""
+    lines = [f"{'โมดูล':<40}{'วินาที':>10}  {'ผล':<8}โมดูลหนักที่ถูกโหลด"]
+    for result in report:
+        if "error" in result:
+            lines.append(f"{result['module']:<40}{'-':>10}  ผิดพลาด: {result['error']}")
+            continue
+        status = "ผ่าน" if result["within_budget"] else "เกินงบ"
+        lines.append(
+            f"{result['module']:<40}{result['seconds']:>10.3f}  {status:<8}{', '.join(result['heavy']) or '-'}"
+        )
+    lines.append(f"งบเวลา import: {budget:.2f} วินาที")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="วัดเวลา import ของโมดูลที่ใช้ตอนเปิดโปรแกรม")
+    parser.add_argument("modules", nargs="*", default=list(STARTUP_MODULES))
+    parser.add_argument("--budget", type=float, default=STARTUP_IMPORT_BUDGET, help="งบเวลา (วินาที)")
+    args = parser.parse_args()
+    
+    report = check_import_budget(args.modules, args.budget)
+    print(format_report(report, args.budget))
+    sys.exit(0 if all(result.get("within_budget") for result in report) else 1)
@@ -0,0 +1,181 @@
+import types
+from typing import Dict, Any, Optional, Tuple
+
+import torch
+from torch import nn
+
+from app.config.settings import SEGMENT_DURATION, GENERATION_CONFIG
+from app.core.utilities import logger
+
+def _static_self_attention(self, hidden_states: torch.Tensor,
+                           key_value_states: Optional[torch.Tensor] = None,
+                           past_key_value: Optional[Tuple[torch.Tensor]] = None,
+                           attention_mask: Optional[torch.Tensor] = None,
+                           layer_head_mask: Optional[torch.Tensor] = None,
+                           output_attentions: bool = False):
+    """forward ของ self-attention ใน decoder ที่เขียน key/value ใหม่ลง buffer ที่จองไว้
+    แทนการต่อ tensor (torch.cat) ทุก token
+    
+    past_key_value ที่คืนเป็น view ของ buffer ยาวเท่ากับจำนวน token ที่สร้างแล้ว
+    ส่วนการคำนวณ attention เหมือน MusicgenAttention.forward ทุกอย่าง"""
+    cache = self._static_kv_cache
+    bsz, tgt_len, _ = hidden_states.size()
+    
+    query_states = self.q_proj(hidden_states) * self.scaling
+    key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+    value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+    
+    # ตำแหน่งที่เขียนต่อ = ความยาวของ view ที่คืนไปใน token ก่อนหน้า
+    past_length = past_key_value[0].shape[2] if past_key_value is not None else 0
+    key_states, value_states = cache.write(self, key_states, value_states, past_length)
+    past_key_value = (key_states, value_states)
+    
+    # view ของ buffer ที่เรียงแบบ (batch, head, ตำแหน่ง, head_dim) รวม batch กับ head ได้โดยไม่ต้องคัดลอก
+    proj_shape = (bsz * self.num_heads, -1, self.head_dim)
+    query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
+    key_states = key_states.reshape(*proj_shape)
+    value_states = value_states.reshape(*proj_shape)
+    
+    src_len = key_states.size(1)
+    attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+    
+    if attention_mask is not None:
+        attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
+        attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+    
+    attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+    
+    if layer_head_mask is not None:
+        attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+        attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+    
+    attn_weights_reshaped = None
+    if output_attentions:
+        attn_weights_reshaped = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+    
+    attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+    attn_output = torch.bmm(attn_probs, value_states)
+    
+    attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim).transpose(1, 2)
+    attn_output = attn_output.reshape(bsz, tgt_len, self.embed_dim)
+    attn_output = self.out_proj(attn_output)
+    
+    return attn_output, attn_weights_reshaped, past_key_value
+
+class StaticKVCache:
+    """KV cache ของ self-attention ใน decoder ของ MusicGen ที่จองหน่วยความจำไว้ล่วงหน้า
+    
+    cache ปกติของ transformers ต่อ key/value ใหม่เข้ากับ tensor เดิมทุก token
+    (คัดลอกทั้ง cache ทุกครั้ง งานจึงโตแบบกำลังสองตามความยาวเพลง และมีการจอง/คืนหน่วยความจำตลอด)
+    cache นี้จอง buffer ขนาดเท่ากับจำนวน token ที่จะสร้าง (reserve) ก่อนเรียก generate
+    แล้วเขียน key/value ของแต่ละ token ลงตำแหน่งของมันโดยตรง
+    
+    การจองแต่ละครั้งไม่เกิน window_tokens (หนึ่งช่วงของการสร้างแบบแบ่งช่วง) ถ้าการ generate ยาวกว่านั้น
+    buffer จะขยายเป็นสองเท่าเมื่อเต็ม (ไม่จองทั้งเพลงยาวหลายชั่วโมงไว้ตั้งแต่ token แรก)
+    และคืน buffer หลัง generate จบ (release) เพื่อไม่ให้ค้างอยู่ระหว่างงาน
+    และให้ MemoryAdmission ประมาณหน่วยความจำของ KV cache ได้ตรงกับที่ใช้จริง
+    
+    cross-attention ไม่เปลี่ยน (คำนวณครั้งเดียวต่อการ generate อยู่แล้ว)
+    """
+    
+    def __init__(self, model):
+        self.model = model
+        self.layers = [layer.self_attn for layer in model.decoder.model.decoder.layers]
+        self._buffers: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._reserved_tokens = 0
+        self.window_tokens = (
+            SEGMENT_DURATION * GENERATION_CONFIG.get("max_new_tokens_per_sec", 50) + model.decoder.num_codebooks
+        )
+        self.grow_count = 0
+        self.peak_size = 0
+    
+    def attach(self):
+        """เปลี่ยน forward ของ self-attention ทุกชั้นให้ใช้ buffer ของ cache นี้"""
+        for attention in self.layers:
+            attention._static_kv_cache = self
+            attention.forward = types.MethodType(_static_self_attention, attention)
+        logger.info(f"ใช้ static KV cache กับ self-attention {len(self.layers)} ชั้นของ decoder")
+    
+    def detach(self):
+        """คืน forward เดิมและคืนหน่วยความจำของ buffer"""
+        for attention in self.layers:
+            if "forward" in attention.__dict__:
+                del attention.forward
+            attention.__dict__.pop("_static_kv_cache", None)
+        self._buffers.clear()
+    
+    def reserve(self, max_new_tokens: int):
+        """กำหนดจำนวน token ที่จะสร้างใน generate ครั้งถัดไป (ไม่เกิน window_tokens)
+        (buffer ถูกจองตอน token แรกเมื่อรู้ขนาด batch และความยาว prompt)"""
+        self._reserved_tokens = min(max_new_tokens, self.window_tokens)
+    
+    def release(self):
+        """คืนหน่วยความจำของ buffer หลัง generate จบ"""
+        if self._buffers:
+            self.peak_size = max(self.peak_size, self._size())
+            self._buffers.clear()
+        self._reserved_tokens = 0
+    
+    def write(self,
+              attention,
+              key_states: torch.Tensor,
+              value_states: torch.Tensor,
+              past_length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """เขียน key/value ใหม่ของชั้นนี้ที่ตำแหน่ง past_length แล้วคืน view ของ cache ถึงตำแหน่งล่าสุด"""
+        bsz, num_heads, new_tokens, head_dim = key_states.shape
+        end = past_length + new_tokens
+        key_buffer, value_buffer = self._buffer_for(
+            attention, bsz, end + self._reserved_tokens if past_length == 0 else end,
+            key_states, keep=past_length
+        )
+        key_buffer[:, :, past_length:end] = key_states
+        value_buffer[:, :, past_length:end] = value_states
+        return key_buffer[:, :, :end], value_buffer[:, :, :end]
+    
+    def _buffer_for(self, attention, bsz: int, length: int,
+                    like: torch.Tensor, keep: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """buffer ของชั้นนี้ที่รองรับ batch bsz และความยาว length (จองใหม่ถ้าไม่พอ)
+        ถ้าต้องขยายกลางการ generate จะคัดลอก keep ตำแหน่งแรกไปยัง buffer ใหม่"""
+        key = id(attention)
+        buffers = self._buffers.get(key)
+        if buffers is not None:
+            key_buffer, value_buffer = buffers
+            if (key_buffer.shape[0] == bsz and key_buffer.shape[2] >= length
+                    and key_buffer.dtype == like.dtype and key_buffer.device == like.device):
+                return buffers
+        
+        capacity = length
+        if buffers is not None and keep > 0:
+            # จำนวน token เกินที่จองไว้ (generate ยาวกว่า window_tokens) ขยายเป็นสองเท่า
+            capacity = max(length, buffers[0].shape[2] * 2)
+            self.grow_count += 1
+        
+        shape = (bsz, like.shape[1], capacity, like.shape[3])
+        new_buffers = (
+            torch.empty(shape, dtype=like.dtype, device=like.device),
+            torch.empty(shape, dtype=like.dtype, device=like.device)
+        )
+        if buffers is not None and keep > 0:
+            new_buffers[0][:, :, :keep] = buffers[0][:, :, :keep]
+            new_buffers[1][:, :, :keep] = buffers[1][:, :, :keep]
+        self._buffers[key] = new_buffers
+        return new_buffers
+    
+    def _size(self) -> int:
+        return sum(
+            tensor.nelement() * tensor.element_size()
+            for buffers in self._buffers.values() for tensor in buffers
+        )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """ขนาดของ buffer ที่จองอยู่ (และขนาดสูงสุดที่เคยจอง)"""
+        size = self._size()
+        capacity = max((buffers[0].shape[2] for buffers in self._buffers.values()), default=0)
+        return {
+            "layers": len(self.layers),
+            "window_tokens": self.window_tokens,
+            "capacity_tokens": capacity,
+            "size_mb": size / (1024 * 1024),
+            "peak_size_mb": max(self.peak_size, size) / (1024 * 1024),
+            "grow_count": self.grow_count
+        }
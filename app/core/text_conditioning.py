@@ -0,0 +1,19 @@
+from typing import Dict
+
+import torch
+
+from app.config.settings import TEXT_CONDITIONING_CACHE_MB
+from app.core.byte_lru import ByteLRUCache
+
+def _entry_bytes(entry: Dict[str, torch.Tensor]) -> int:
+    return sum(tensor.nelement() * tensor.element_size() for tensor in entry.values())
+
+class TextConditioningCache(ByteLRUCache):
+    """LRU cache ของผลลัพธ์ text encoder ต่อ prompt
+    
+    แต่ละรายการเก็บ input_ids, attention_mask และ hidden states ของ prompt เดียว (ไม่มี padding)
+    จำกัดขนาดรวมตามจำนวน byte ของ tensor เมื่อเกินจะลบรายการที่ใช้ล่าสุดนานที่สุดออกก่อน
+    """
+    
+    def __init__(self, max_mb: float = TEXT_CONDITIONING_CACHE_MB):
+        super().__init__(max_mb, _entry_bytes)
@@ -0,0 +1,162 @@
+import threading
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+from typing import Dict, Any, List, Optional
+
+from app.config.settings import MAX_CPU_USAGE, THREAD_BUDGET_WEIGHTS
+from app.core.utilities import logger
+
+def _native_thread_limits(threads: int):
+    """จำกัด thread ของ BLAS/OpenMP (numpy, scipy, librosa) ด้วย threadpoolctl ถ้าติดตั้งไว้
+    ถ้าไม่มี threadpoolctl คืน context ที่ไม่ทำอะไร (lease ยังลด thread ของการสร้างเพลงเหมือนเดิม)"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return nullcontext()
+    return threadpool_limits(limits=threads)
+
+class ThreadLease:
+    """ส่วนแบ่ง thread ของงานหนึ่งงานจาก ThreadBudget
+    
+    threads ถูกปรับโดย budget เมื่อมีงานเริ่มหรือจบ เจ้าของ lease เรียก apply() ที่จุดที่ปลอดภัย
+    (เช่น ทุก token ผ่าน stopping_criteria เพราะ lease เรียกได้แบบเดียวกับ criterion)
+    เพื่อให้ intra-op thread ของ torch ใน thread ที่ทำงานนั้นตรงกับส่วนแบ่งล่าสุด
+    """
+    
+    def __init__(self,
+                 budget: "ThreadBudget",
+                 kind: str,
+                 weight: float,
+                 max_threads: Optional[int] = None,
+                 torch_threads: bool = False):
+        self.budget = budget
+        self.kind = kind
+        self.weight = weight
+        self.max_threads = max_threads
+        self.torch_threads = torch_threads
+        self.threads = 1
+        self._applied = None
+        self.owner = threading.get_ident()
+    
+    def apply(self):
+        """ตั้งจำนวน intra-op thread ของ torch ตามส่วนแบ่งปัจจุบัน (เฉพาะ thread เจ้าของ และเมื่อค่าเปลี่ยน)"""
+        threads = self.threads
+        if not self.torch_threads or threads == self._applied or threading.get_ident() != self.owner:
+            return
+        import torch
+        torch.set_num_threads(threads)
+        self._applied = threads
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        # ใช้เป็น stopping criterion: ปรับ thread ทุก token และไม่หยุดการสร้าง
+        self.apply()
+        return False
+    
+    def release(self):
+        self.budget.release(self)
+
+class ThreadBudget:
+    """แบ่ง thread ของ CPU (MAX_CPU_USAGE) ให้งานที่ทำพร้อมกัน
+    
+    การสร้างเพลง, post-processing และการแปลงไฟล์ขอส่วนแบ่งผ่าน lease()
+    budget แบ่ง thread ตามน้ำหนักของงาน (THREAD_BUDGET_WEIGHTS) ทุกครั้งที่มีงานเริ่มหรือจบ
+    ทำให้เมื่องาน batch กับงานที่ผู้ใช้รออยู่ทำพร้อมกัน จำนวน thread รวมไม่เกินจำนวน core
+    (ไม่เกิด oversubscription) และเมื่องานอื่นจบ การสร้างเพลงได้ thread คืนทันทีที่ token ถัดไป
+    
+    ทุกงานได้อย่างน้อย 1 thread ถ้ามีงานมากกว่าจำนวน thread ทั้งหมด
+    """
+    
+    def __init__(self, total: int = MAX_CPU_USAGE, weights: Optional[Dict[str, float]] = None):
+        self.total = max(1, total)
+        self.weights = dict(THREAD_BUDGET_WEIGHTS if weights is None else weights)
+        self._leases: List[ThreadLease] = []
+        self._lock = Lock()
+        self.rebalances = 0
+    
+    def acquire(self,
+                kind: str,
+                max_threads: Optional[int] = None,
+                torch_threads: bool = False) -> ThreadLease:
+        """ขอส่วนแบ่ง thread สำหรับงานประเภท kind (ต้องเรียก release เมื่อจบงาน)
+        torch_threads=True ให้ lease ตั้ง torch.set_num_threads ใน thread ที่ขอ (ดู ThreadLease.apply)"""
+        lease = ThreadLease(self, kind, self.weights.get(kind, 1.0), max_threads, torch_threads)
+        with self._lock:
+            self._leases.append(lease)
+            self._rebalance()
+        lease.apply()
+        return lease
+    
+    def release(self, lease: ThreadLease):
+        with self._lock:
+            if lease in self._leases:
+                self._leases.remove(lease)
+                self._rebalance()
+    
+    @contextmanager
+    def lease(self,
+              kind: str,
+              max_threads: Optional[int] = None,
+              torch_threads: bool = False,
+              native_threads: bool = False):
+        """context manager ของ acquire/release
+        native_threads=True จำกัด thread ของ BLAS/OpenMP ตามส่วนแบ่งตอนเริ่มงานตลอดช่วง lease
+        (สำหรับงานสั้นที่ไม่ได้ใช้ torch เช่น post-processing และการแปลงไฟล์)"""
+        lease = self.acquire(kind, max_threads, torch_threads)
+        try:
+            with _native_thread_limits(lease.threads) if native_threads else nullcontext():
+                yield lease
+        finally:
+            lease.release()
+    
+    def _rebalance(self):
+        """แบ่ง thread ตามน้ำหนัก (ปัดแบบ largest remainder) ทุกงานได้อย่างน้อย 1 และไม่เกิน max_threads"""
+        leases = self._leases
+        if not leases:
+            return
+        shares = {id(lease): 1 for lease in leases}
+        remaining = self.total - len(leases)
+        # แจกทีละรอบเผื่อบางงานเต็ม max_threads แล้วเหลือ thread ให้งานอื่น
+        while remaining > 0:
+            open_leases = [
+                lease for lease in leases
+                if lease.max_threads is None or shares[id(lease)] < lease.max_threads
+            ]
+            if not open_leases:
+                break
+            total_weight = sum(lease.weight for lease in open_leases) or 1.0
+            ideal = {id(lease): remaining * lease.weight / total_weight for lease in open_leases}
+            given = 0
+            for lease in open_leases:
+                extra = int(ideal[id(lease)])
+                if lease.max_threads is not None:
+                    extra = min(extra, lease.max_threads - shares[id(lease)])
+                shares[id(lease)] += extra
+                given += extra
+            if given == 0:
+                # เศษที่เหลือให้งานที่มีเศษมากที่สุด
+                lease = max(open_leases, key=lambda item: ideal[id(item)] - int(ideal[id(item)]))
+                shares[id(lease)] += 1
+                given = 1
+            remaining -= given
+        
+        changed = False
+        for lease in leases:
+            if lease.threads != shares[id(lease)]:
+                lease.threads = shares[id(lease)]
+                changed = True
+        if changed:
+            self.rebalances += 1
+            logger.debug(
+                "แบ่ง thread ใหม่: " + ", ".join(f"{lease.kind}={lease.threads}" for lease in leases)
+            )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total": self.total,
+                "active": [{"kind": lease.kind, "threads": lease.threads} for lease in self._leases],
+                "rebalances": self.rebalances
+            }
+
+# สร้าง singleton instance
+thread_budget = ThreadBudget()
@@ -6,8 +6,8 @@ import shutil
 import logging
 from pathlib import Path
 from datetime import datetime
-from threading import Thread
-from typing import List, Dict, Any, Optional, Tuple
+from threading import Thread, Lock
+from typing import List, Dict, Any, Optional, Tuple, Callable
 
 from app.config.settings import OUTPUT_DIR, MAX_STORAGE_PERCENT, SAMPLE_RATE
 
@@ -146,4 +146,39 @@ def estimate_generation_time(duration: int, instruments_count: int) -> int:
         overhead_factor = duration / 3600  # เพิ่มตามจำนวนชั่วโมง
         estimated_time *= (1 + (overhead_factor * 0.2))  # เพิ่ม 20% ต่อชั่วโมง
     
-    return max(30, int(estimated_time))  # อย่างน้อย 30 วินาที
\ No newline at end of file
+    return max(30, int(estimated_time))  # อย่างน้อย 30 วินาที
+
+class LazySingleton:
+    """ตัวแทนของ singleton ที่สร้าง instance จริงเมื่อถูกใช้งานครั้งแรก
+    
+    ใช้แทนการสร้าง singleton ตอน import (เช่น cache_manager = CacheManager())
+    เพื่อไม่ให้การเปิดโปรแกรมต้องรออ่านไฟล์หรือโหลดข้อมูลของทุก manager
+    การเรียกใช้ attribute/method ถูกส่งต่อไปยัง instance จริงทั้งหมด
+    """
+    
+    def __init__(self, factory: Callable[[], Any]):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", Lock())
+        
+    def get_instance(self) -> Any:
+        """คืนค่า instance จริง (สร้างถ้ายังไม่มี ปลอดภัยเมื่อเรียกจากหลาย thread)"""
+        instance = object.__getattribute__(self, "_instance")
+        if instance is None:
+            with object.__getattribute__(self, "_lock"):
+                instance = object.__getattribute__(self, "_instance")
+                if instance is None:
+                    instance = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+    
+    @property
+    def is_initialized(self) -> bool:
+        """สร้าง instance จริงแล้วหรือยัง"""
+        return object.__getattribute__(self, "_instance") is not None
+        
+    def __getattr__(self, name):
+        return getattr(self.get_instance(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self.get_instance(), name, value)
@@ -0,0 +1,379 @@
+import itertools
+import multiprocessing
+from queue import Empty
+from threading import Thread, Condition, Lock
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+import psutil
+
+from app.config.settings import MAX_CPU_USAGE, MAX_DURATION, WORKER_MAX_PENDING
+from app.core.generation_queue import PRIORITY_PREVIEW, PRIORITY_NORMAL
+from app.core.utilities import logger
+
+def partition_cores(num_workers: int, total: int = MAX_CPU_USAGE) -> List[List[int]]:
+    """แบ่ง core ที่ process นี้ใช้ได้ (ไม่เกิน total core) เป็น num_workers ชุดที่ไม่ซ้อนกัน"""
+    try:
+        available = sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        # macOS ไม่รองรับ cpu_affinity
+        available = list(range(psutil.cpu_count() or 1))
+    available = available[:max(total, 1)]
+    
+    per_worker = max(1, len(available) // num_workers)
+    slices = []
+    for i in range(num_workers):
+        cores = available[i * per_worker:(i + 1) * per_worker]
+        # worker มากกว่า core: ใช้ core ร่วมกัน
+        slices.append(cores or [available[i % len(available)]])
+    return slices
+
+def _worker_main(worker_id: int,
+                 cores: List[int],
+                 generator_kwargs: Dict[str, Any],
+                 tasks,
+                 events):
+    """ลูปของ worker process: โหลดโมเดลหนึ่งครั้ง แล้วรับงานและการยกเลิกจนได้ None
+    
+    คำขอของแต่ละงานเข้าคิวของ MusicGenerator ใน worker เอง (ไม่ใช้ cache เพราะ process หลักตรวจสอบแล้ว)
+    worker จึงเรียงคำขอตาม priority, ให้ตัวอย่างเพลงแทรกเพลงยาว และตรวจสอบหน่วยความจำเหมือนการสร้างใน process เดียว
+    CancellationToken ส่งข้าม process ไม่ได้ process หลักจึงส่ง ("cancel", task_id, index, return_partial)
+    แล้ว worker ยกเลิก token ของคำขอนั้นที่สร้างไว้ใน process นี้"""
+    try:
+        try:
+            psutil.Process().cpu_affinity(cores)
+        except (AttributeError, psutil.Error) as e:
+            logger.warning(f"worker {worker_id}: ไม่สามารถกำหนด core ได้ ({e}) ใช้เฉพาะการจำกัดจำนวน thread")
+        
+        from app.core.ai_engine import MusicGenerator
+        from app.core.cancellation import CancellationToken
+        from app.core.generation_queue import GenerationRequest
+        
+        generator = MusicGenerator(num_threads=len(cores), **generator_kwargs)
+        generator._use_model()
+        generator.is_ready = True
+        generator._start_processing_thread()
+    
+    except Exception as e:
+        events.put(("failed", worker_id, None, str(e)))
+        return
+    
+    logger.info(f"worker {worker_id} พร้อมแล้ว (core {cores})")
+    events.put(("ready", worker_id, None, generator._output_rate()))
+    
+    # token ของคำขอที่ยังไม่เสร็จ ตาม (task_id, ลำดับในงาน)
+    tokens: Dict[Tuple[int, int], CancellationToken] = {}
+    tokens_lock = Lock()
+    
+    def _result_callback(task_id: int, index: int):
+        def _on_result(success: bool, payload):
+            with tokens_lock:
+                tokens.pop((task_id, index), None)
+            events.put(("result", worker_id, task_id, (index, success, payload)))
+        return _on_result
+    
+    while True:
+        message = tasks.get()
+        if message is None:
+            break
+        
+        kind, task_id = message[:2]
+        if kind == "cancel":
+            _, _, index, return_partial = message
+            with tokens_lock:
+                token = tokens.get((task_id, index))
+            # คำขอที่เสร็จไปแล้วไม่มี token ให้ยกเลิก
+            if token is not None:
+                token.cancel(return_partial)
+            continue
+        
+        _, _, params_list, priority = message
+        
+        # callback เดียวต่องาน คำขอของงานเดียวกันที่ถูกรวม batch จึงรายงานความคืบหน้าครั้งเดียว
+        def _on_progress(info: Dict[str, Any], task_id=task_id):
+            events.put(("progress", worker_id, task_id, info))
+        
+        for index, params in enumerate(params_list):
+            params = dict(params)
+            token = CancellationToken()
+            with tokens_lock:
+                tokens[(task_id, index)] = token
+            request = GenerationRequest(
+                params, _result_callback(task_id, index), use_cache=False, priority=priority,
+                progress_callback=_on_progress, cancel_token=token
+            )
+            request.prefix = params.pop("prefix", None)
+            generator._generation_queue.put(request, block=True)
+
+class _Worker:
+    """สถานะของ worker process หนึ่งตัวในมุมของ process หลัก"""
+    
+    def __init__(self, worker_id: int, cores: List[int], process, tasks):
+        self.worker_id = worker_id
+        self.cores = cores
+        self.process = process
+        self.tasks = tasks
+        self.state = "starting"  # starting, ready, failed, stopped
+        self.pending: Dict[int, Dict[str, Any]] = {}
+        self.completed = 0
+    
+    @property
+    def load(self) -> float:
+        """ความยาวเพลงรวม (วินาที) ของงานที่ยังไม่เสร็จ"""
+        return sum(task["load"] for task in self.pending.values())
+
+class WorkerPool:
+    """กลุ่ม worker process ที่แต่ละตัวโหลดโมเดลของตัวเองและใช้ core ชุดที่ไม่ซ้อนกัน
+    
+    การคำนวณในแต่ละ process จึงไม่แย่ง core กันและไม่ติด GIL ร่วมกัน
+    งานถูกส่งให้ worker ที่มีงานค้าง (ความยาวเพลงรวม) น้อยที่สุด
+    ผลลัพธ์และความคืบหน้าถูกส่งกลับผ่าน queue เดียว และเรียก callback จาก thread ของ pool
+    """
+    
+    def __init__(self,
+                 num_workers: int,
+                 generator_kwargs: Optional[Dict[str, Any]] = None,
+                 max_pending: int = WORKER_MAX_PENDING):
+        self.num_workers = num_workers
+        self.generator_kwargs = generator_kwargs or {}
+        self.max_pending = max(1, max_pending)
+        self._context = multiprocessing.get_context("spawn")
+        self._events = self._context.Queue()
+        self._workers: List[_Worker] = []
+        self._condition = Condition()
+        self._task_ids = itertools.count()
+        self._reader_thread = None
+        self._running = False
+        self.sample_rate: Optional[int] = None  # sample rate ของเสียงที่ worker สร้าง (รายงานตอนพร้อม)
+    
+    def start(self, timeout: Optional[float] = None) -> bool:
+        """เริ่ม worker ทั้งหมดและรอจนโหลดโมเดลเสร็จ
+        worker ตัวแรกเริ่มก่อนเพื่อสร้าง artifact ของโมเดล (ถ้ายังไม่มี) ตัวอื่นจึงโหลดจากไฟล์ได้ทันที
+        คืนค่า True ถ้ามี worker ที่พร้อมอย่างน้อยหนึ่งตัว"""
+        self._running = True
+        self._reader_thread = Thread(target=self._read_events, daemon=True)
+        self._reader_thread.start()
+        
+        core_slices = partition_cores(self.num_workers)
+        logger.info(f"กำลังเริ่ม worker {self.num_workers} process (core ต่อ process: {[len(c) for c in core_slices]})")
+        
+        for worker_id, cores in enumerate(core_slices):
+            tasks = self._context.Queue()
+            process = self._context.Process(
+                target=_worker_main,
+                args=(worker_id, cores, self.generator_kwargs, tasks, self._events),
+                daemon=True
+            )
+            self._workers.append(_Worker(worker_id, cores, process, tasks))
+        
+        self._workers[0].process.start()
+        self._wait_started(self._workers[:1], timeout)
+        for worker in self._workers[1:]:
+            worker.process.start()
+        self._wait_started(self._workers[1:], timeout)
+        
+        ready = [worker for worker in self._workers if worker.state == "ready"]
+        logger.info(f"worker พร้อมใช้งาน {len(ready)}/{self.num_workers} process")
+        return bool(ready)
+    
+    def _wait_started(self, workers: List[_Worker], timeout: Optional[float]):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: all(worker.state != "starting" for worker in workers),
+                timeout=timeout
+            )
+    
+    def has_capacity(self, timeout: Optional[float] = None) -> bool:
+        """รอจนมี worker ที่งานค้างไม่ครบ max_pending (หรือไม่มี worker ที่พร้อมเลย ให้ submit แจ้งข้อผิดพลาด)
+        คืนค่า False ถ้าเกิน timeout"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: any(
+                    len(worker.pending) < self.max_pending for worker in self._workers if worker.state == "ready"
+                ) or not any(worker.state == "ready" for worker in self._workers),
+                timeout=timeout
+            )
+    
+    def submit(self,
+               params_list: List[Dict[str, Any]],
+               result_callback: Callable[[int, Optional[Dict[str, Any]], Optional[str]], None],
+               progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+               priority: int = PRIORITY_NORMAL,
+               cancel_tokens: Optional[List[Any]] = None):
+        """ส่งงาน (batch ของคำขอ) ให้ worker ที่มีงานค้างน้อยที่สุด
+        รอถ้าทุก worker มีงานค้างครบ max_pending แล้ว (คำขอที่เหลือจึงยังเรียงตาม priority ในคิวหลัก)
+        ยกเว้นตัวอย่างเพลงที่ส่งได้ทันที เพื่อให้ worker พักเพลงยาวที่กำลังสร้างแล้วสร้างตัวอย่างก่อน
+        result_callback(index, result, error) ถูกเรียกครั้งเดียวต่อคำขอ เมื่อเสร็จ ผิดพลาด หรือ worker หยุดทำงาน
+        cancel_tokens (ตามลำดับ params_list) ส่งการยกเลิกไปยัง worker ที่ได้รับงานนี้"""
+        task = {
+            "load": sum(min(params['duration'], MAX_DURATION) for params in params_list),
+            "result_callback": result_callback,
+            "progress_callback": progress_callback,
+            "remaining": set(range(len(params_list))),
+            "cancel_callbacks": []
+        }
+        
+        with self._condition:
+            while True:
+                ready = [worker for worker in self._workers if worker.state == "ready"]
+                if not ready:
+                    raise RuntimeError("ไม่มี worker process ที่พร้อมใช้งาน")
+                
+                available = [
+                    worker for worker in ready
+                    if priority <= PRIORITY_PREVIEW or len(worker.pending) < self.max_pending
+                ]
+                if available:
+                    worker = min(available, key=lambda w: (w.load, len(w.pending), w.worker_id))
+                    break
+                self._condition.wait()
+            
+            task_id = next(self._task_ids)
+            worker.pending[task_id] = task
+            worker.tasks.put(("task", task_id, params_list, priority))
+            
+            # ลงทะเบียนหลังส่งงาน ข้อความยกเลิกจึงถึง worker หลังงานเสมอ (และถูกถอนเมื่องานเสร็จภายใต้ lock เดียวกัน)
+            for index, token in enumerate(cancel_tokens or []):
+                if token is None:
+                    continue
+                
+                def _on_cancel(token=token, index=index):
+                    self._send_cancel(worker, task_id, index, token.return_partial)
+                task["cancel_callbacks"].append((token, _on_cancel))
+                token.add_callback(_on_cancel)
+    
+    @staticmethod
+    def _send_cancel(worker: _Worker, task_id: int, index: int, return_partial: bool):
+        try:
+            worker.tasks.put(("cancel", task_id, index, return_partial))
+        except (ValueError, OSError) as e:
+            # worker ถูกปิดไปแล้ว
+            logger.warning(f"ไม่สามารถส่งการยกเลิกไปยัง worker {worker.worker_id} ได้: {e}")
+    
+    @staticmethod
+    def _close_task(task: Dict[str, Any]):
+        """ถอน callback การยกเลิกของงานที่ไม่ค้างอยู่ใน worker แล้ว (ต้องถือ lock อยู่)"""
+        for token, callback in task["cancel_callbacks"]:
+            token.remove_callback(callback)
+        task["cancel_callbacks"] = []
+    
+    def _read_events(self):
+        """รับผลลัพธ์และความคืบหน้าจาก worker แล้วเรียก callback ที่เกี่ยวข้อง"""
+        while self._running:
+            try:
+                kind, worker_id, task_id, payload = self._events.get(timeout=1.0)
+            except Empty:
+                self._check_workers()
+                continue
+            except (EOFError, OSError):
+                break
+            
+            worker = self._workers[worker_id]
+            if kind in ("ready", "failed"):
+                with self._condition:
+                    worker.state = kind
+                    if kind == "ready":
+                        self.sample_rate = payload
+                    self._condition.notify_all()
+                if kind == "failed":
+                    logger.error(f"worker {worker_id} โหลดโมเดลไม่สำเร็จ: {payload}")
+                continue
+            
+            if kind == "progress":
+                task = worker.pending.get(task_id)
+                if task and task["progress_callback"]:
+                    try:
+                        task["progress_callback"](payload)
+                    except Exception as e:
+                        logger.error(f"เกิดข้อผิดพลาดในการรายงานความคืบหน้า: {e}")
+                continue
+            
+            # ผลลัพธ์ของคำขอหนึ่งรายการ งานเสร็จเมื่อได้ผลลัพธ์ครบทุกคำขอ
+            index, success, result = payload
+            with self._condition:
+                task = worker.pending.get(task_id)
+                if task is None or index not in task["remaining"]:
+                    continue
+                task["remaining"].discard(index)
+                if not task["remaining"]:
+                    del worker.pending[task_id]
+                    worker.completed += 1
+                    self._close_task(task)
+                    self._condition.notify_all()
+            if success:
+                self._call_result(task, index, result, None)
+            else:
+                self._call_result(task, index, None, result)
+    
+    def _check_workers(self):
+        """ตรวจหา worker ที่หยุดทำงานกะทันหัน แล้วแจ้งข้อผิดพลาดให้งานที่ค้างอยู่"""
+        for worker in self._workers:
+            if worker.state not in ("starting", "ready") or worker.process.is_alive():
+                continue
+            if worker.state == "starting" and worker.process.exitcode is None:
+                continue
+            
+            with self._condition:
+                worker.state = "failed"
+                pending = self._drop_pending(worker)
+                self._condition.notify_all()
+            
+            logger.error(f"worker {worker.worker_id} หยุดทำงาน (exit code {worker.process.exitcode})")
+            self._fail_tasks(pending, f"worker {worker.worker_id} หยุดทำงาน")
+    
+    def _drop_pending(self, worker: _Worker) -> List[Dict[str, Any]]:
+        """ล้างงานที่ค้างของ worker แล้วคืนค่างานเหล่านั้น (ต้องถือ lock อยู่)"""
+        pending = list(worker.pending.values())
+        worker.pending.clear()
+        for task in pending:
+            self._close_task(task)
+        return pending
+    
+    def _fail_tasks(self, tasks: List[Dict[str, Any]], error: str):
+        """แจ้งข้อผิดพลาดให้ทุกคำขอที่ยังไม่ได้ผลลัพธ์ของงานเหล่านี้"""
+        for task in tasks:
+            for index in sorted(task["remaining"]):
+                self._call_result(task, index, None, error)
+    
+    @staticmethod
+    def _call_result(task: Dict[str, Any], index: int, result, error):
+        try:
+            task["result_callback"](index, result, error)
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการส่งผลลัพธ์จาก worker: {e}")
+    
+    def shutdown(self, timeout: float = 10.0):
+        """หยุด worker ทั้งหมด (งานที่ยังค้างอยู่จะถูกแจ้งว่าผิดพลาด)"""
+        for worker in self._workers:
+            if worker.process.is_alive():
+                worker.tasks.put(None)
+        for worker in self._workers:
+            if worker.process.pid is None:
+                continue
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        
+        self._running = False
+        with self._condition:
+            pending = []
+            for worker in self._workers:
+                worker.state = "stopped"
+                pending.extend(self._drop_pending(worker))
+            self._condition.notify_all()
+        self._fail_tasks(pending, "worker pool ถูกปิด")
+        logger.info("ปิด worker pool แล้ว")
+    
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """สถานะของ worker แต่ละตัว (core, งานค้าง, ความยาวเพลงที่ค้าง, จำนวนงานที่เสร็จ)"""
+        with self._condition:
+            return [
+                {
+                    "worker": worker.worker_id,
+                    "state": worker.state,
+                    "cores": worker.cores,
+                    "pending": len(worker.pending),
+                    "load_seconds": worker.load,
+                    "completed": worker.completed
+                }
+                for worker in self._workers
+            ]
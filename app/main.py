@@ -1,7 +1,11 @@
 import sys
 import os
+import time
 import logging
 from pathlib import Path
+# เวลาเริ่มต้น ใช้วัดว่าหน้าต่างหลักแสดงผลได้เร็วแค่ไหน
+_start_time = time.perf_counter()
+
 from PyQt6.QtWidgets import QApplication
 from PyQt6.QtGui import QFont
 
@@ -69,6 +73,11 @@ def main():
     # สร้างและแสดงหน้าต่างหลัก
     window = MainWindow()
     window.show()
+    logger.info(f"แสดงหน้าต่างหลักแล้ว ใช้เวลา {time.perf_counter() - _start_time:.2f} วินาที")
+    
+    # เตรียม manager ต่างๆ เบื้องหลัง (โมเดล AI ถูกโหลดแยกโดย MainWindow)
+    from app.core.startup import warm_up
+    warm_up()
     
     # เริ่มการทำงานของแอพ
     sys.exit(app.exec())
@@ -10,8 +10,9 @@ from typing import Dict, Any, List, Optional
 from datetime import datetime
 
 from app.core.batch_generator import batch_generator
+from app.core.generation_progress import format_progress
 from app.core.preset_manager import preset_manager
-from app.config.settings import INSTRUMENT_CATEGORIES, MOODS
+from app.config.settings import INSTRUMENT_CATEGORIES, MOODS, QUALITY_LABELS, DEFAULT_QUALITY
 
 class BatchGeneratorDialog(QDialog):
     """ไดอะล็อกสำหรับสร้างเพลงแบบ batch"""
@@ -45,6 +46,13 @@ class BatchGeneratorDialog(QDialog):
         self.job_name = QLineEdit()
         form_layout.addRow("ชื่องาน:", self.job_name)
         
+        # คุณภาพของทุกงานในชุด (งาน batch ไม่มีคนรอ จึงใช้คุณภาพสูงสุดเป็นค่าเริ่มต้น)
+        self.quality_input = QComboBox()
+        for quality, label in QUALITY_LABELS.items():
+            self.quality_input.addItem(label, quality)
+        self.quality_input.setCurrentIndex(max(0, self.quality_input.findData(DEFAULT_QUALITY)))
+        form_layout.addRow("คุณภาพ:", self.quality_input)
+        
         # Prompt
         self.prompt_input = QTextEdit()
         self.prompt_input.setAcceptRichText(False)
@@ -210,7 +218,8 @@ class BatchGeneratorDialog(QDialog):
         batch_generator.add_job(
             name=job_name,
             tasks=self.tasks,
-            status_callback=self._on_job_status_changed
+            status_callback=self._on_job_status_changed,
+            quality=self.quality_input.currentData()
         )
         
         # อัพเดต UI
@@ -242,9 +251,7 @@ class BatchGeneratorDialog(QDialog):
         self.current_job = job
         
         # คำนวณความคืบหน้า
-        if job.total_tasks > 0:
-            progress = int((job.completed_tasks / job.total_tasks) * 100)
-            self.progress_bar.setValue(progress)
+        self.progress_bar.setValue(int(job.get_progress_percent()))
             
         # อัพเดตสถานะ
         status = (
@@ -266,21 +273,20 @@ class BatchGeneratorDialog(QDialog):
         """อัพเดตสถานะจาก batch generator"""
         # ดึงงานปัจจุบัน
         current_job = batch_generator.get_current_job()
+        self.current_job = current_job
         
-        if current_job != self.current_job:
-            self.current_job = current_job
+        # อัพเดตทุกครั้งที่งานกำลังทำ เพื่อแสดงความคืบหน้าระดับ token
+        if current_job and current_job.status == 'running':
+            self.progress_bar.setValue(int(current_job.get_progress_percent()))
             
-            if current_job:
-                # อัพเดตสถานะ
-                progress = int((current_job.completed_tasks / current_job.total_tasks) * 100)
-                self.progress_bar.setValue(progress)
-                
-                status = (
-                    f"สร้างเพลงแล้ว {current_job.completed_tasks} "
-                    f"จาก {current_job.total_tasks} เพลง "
-                    f"(ล้มเหลว {current_job.failed_tasks} เพลง)"
-                )
-                self.status_label.setText(status)
+            status = (
+                f"สร้างเพลงแล้ว {current_job.completed_tasks} "
+                f"จาก {current_job.total_tasks} เพลง "
+                f"(ล้มเหลว {current_job.failed_tasks} เพลง)"
+            )
+            if current_job.progress:
+                status += f"\nกลุ่มปัจจุบัน: {format_progress(current_job.progress)}"
+            self.status_label.setText(status)
                 
     def closeEvent(self, event):
         """เรียกเมื่อปิดไดอะล็อก"""
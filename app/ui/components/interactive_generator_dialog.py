@@ -4,19 +4,25 @@ from PyQt6.QtWidgets import (
     QFormLayout, QComboBox, QSpinBox, QTextEdit,
     QTabWidget, QWidget, QProgressBar, QSlider, QListWidgetItem
 )
-from PyQt6.QtCore import Qt, pyqtSignal
+from PyQt6.QtCore import Qt, pyqtSignal, pyqtSlot
 from PyQt6.QtGui import QIcon
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Callable
 from datetime import datetime
 from pathlib import Path
+from threading import Thread
 
 from app.core.interactive_generator import interactive_generator
+from app.core.generation_progress import format_progress
 from app.ui.components.music_player import MusicPlayer
 from app.config.settings import INSTRUMENT_CATEGORIES, MOODS, MAX_DURATION
 
 class InteractiveGeneratorDialog(QDialog):
     """ไดอะล็อกสำหรับแต่งเพลงแบบมีส่วนร่วม"""
     
+    # Signal สำหรับความคืบหน้าและผลลัพธ์ของงานที่รันใน thread แยก
+    progress_signal = pyqtSignal(dict)
+    operation_finished_signal = pyqtSignal(bool, object)
+    
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("แต่งเพลงแบบมีส่วนร่วม")
@@ -26,6 +32,9 @@ class InteractiveGeneratorDialog(QDialog):
         self.session = None
         self._init_ui()
         
+        self.progress_signal.connect(self._on_progress)
+        self.operation_finished_signal.connect(self._on_operation_finished)
+        
     def _init_ui(self):
         """สร้างส่วนประกอบ UI"""
         layout = QVBoxLayout(self)
@@ -63,6 +72,15 @@ class InteractiveGeneratorDialog(QDialog):
         
         layout.addWidget(self.tab_widget)
         
+        # ความคืบหน้าการสร้างเพลง
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setVisible(False)
+        layout.addWidget(self.progress_bar)
+        
+        self.progress_label = QLabel("")
+        layout.addWidget(self.progress_label)
+        
         # ส่วนล่าง: เครื่องเล่นเพลง
         self.music_player = MusicPlayer()
         layout.addWidget(self.music_player)
@@ -172,6 +190,7 @@ class InteractiveGeneratorDialog(QDialog):
             
         try:
             self.session = interactive_generator.create_session(name)
+            self.session.progress_callback = self.progress_signal.emit
             
             # ปลดล็อคส่วนต่างๆ
             self.tab_widget.setEnabled(True)
@@ -205,26 +224,60 @@ class InteractiveGeneratorDialog(QDialog):
             )
             return
             
-        try:
-            # สร้างเพลง
-            result = self.session.start_new_track(
-                prompt=prompt,
-                instruments=instruments,
-                mood=self.mood_input.currentText(),
-                duration=self.duration_input.value()
-            )
-            
-            # อัพเดตประวัติ
-            self._update_history()
-            
-            # เล่นเพลง
-            self.music_player.play_file(Path(result['file_path']))
-            
-            # เปลี่ยนไปแท็บปรับแต่ง
-            self.tab_widget.setCurrentIndex(1)
+        # สร้างเพลงใน thread แยก
+        mood = self.mood_input.currentText()
+        duration = self.duration_input.value()
+        self._run_operation(lambda: self.session.start_new_track(
+            prompt=prompt,
+            instruments=instruments,
+            mood=mood,
+            duration=duration
+        ))
+        
+    def _run_operation(self, operation: Callable[[], Dict[str, Any]]):
+        """รันงานสร้างเพลงของ session ใน thread แยก เพื่อให้ UI แสดงความคืบหน้าได้"""
+        self.tab_widget.setEnabled(False)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.progress_label.setText("กำลังสร้างเพลง...")
+        
+        def _worker():
+            try:
+                result = operation()
+            except Exception as e:
+                self.operation_finished_signal.emit(False, str(e))
+            else:
+                self.operation_finished_signal.emit(True, result)
+                
+        Thread(target=_worker, daemon=True).start()
+        
+    @pyqtSlot(dict)
+    def _on_progress(self, info):
+        """เรียกเมื่อมีความคืบหน้าการสร้างเพลง (เรียกใน UI thread)"""
+        if not self.progress_bar.isVisible():
+            return
+        self.progress_bar.setValue(int(info['percent']))
+        self.progress_label.setText(f"กำลังสร้างเพลง {format_progress(info)}")
+        
+    @pyqtSlot(bool, object)
+    def _on_operation_finished(self, success, result):
+        """เรียกเมื่องานสร้างเพลงเสร็จ (เรียกใน UI thread)"""
+        self.progress_bar.setVisible(False)
+        self.progress_label.setText("")
+        self.tab_widget.setEnabled(True)
+        
+        if not success:
+            QMessageBox.critical(self, "ข้อผิดพลาด", result)
+            return
             
-        except Exception as e:
-            QMessageBox.critical(self, "ข้อผิดพลาด", str(e))
+        # อัพเดตประวัติ
+        self._update_history()
+        
+        # เล่นเพลงเวอร์ชันใหม่
+        self.music_player.play_file(Path(result['file_path']))
+        
+        # เปลี่ยนไปแท็บปรับแต่ง
+        self.tab_widget.setCurrentIndex(1)
             
     def _show_adjust_instruments_dialog(self):
         """แสดงไดอะล็อกปรับเครื่องดนตรี"""
@@ -233,13 +286,8 @@ class InteractiveGeneratorDialog(QDialog):
             
         dialog = AdjustInstrumentsDialog(self)
         if dialog.exec():
-            # อัพเดตประวัติ
-            self._update_history()
-            
-            # เล่นเพลงเวอร์ชันใหม่
-            current = self.session.get_current_version()
-            if current:
-                self.music_player.play_file(Path(current['file_path']))
+            # สร้างเพลงเวอร์ชันใหม่ใน thread แยก
+            self._run_operation(dialog.operation)
                 
     def _show_adjust_mood_dialog(self):
         """แสดงไดอะล็อกปรับอารมณ์"""
@@ -248,13 +296,8 @@ class InteractiveGeneratorDialog(QDialog):
             
         dialog = AdjustMoodDialog(self)
         if dialog.exec():
-            # อัพเดตประวัติ
-            self._update_history()
-            
-            # เล่นเพลงเวอร์ชันใหม่
-            current = self.session.get_current_version()
-            if current:
-                self.music_player.play_file(Path(current['file_path']))
+            # สร้างเพลงเวอร์ชันใหม่ใน thread แยก
+            self._run_operation(dialog.operation)
                 
     def _show_extend_duration_dialog(self):
         """แสดงไดอะล็อกต่อความยาว"""
@@ -263,13 +306,8 @@ class InteractiveGeneratorDialog(QDialog):
             
         dialog = ExtendDurationDialog(self)
         if dialog.exec():
-            # อัพเดตประวัติ
-            self._update_history()
-            
-            # เล่นเพลงเวอร์ชันใหม่
-            current = self.session.get_current_version()
-            if current:
-                self.music_player.play_file(Path(current['file_path']))
+            # สร้างเพลงเวอร์ชันใหม่ใน thread แยก
+            self._run_operation(dialog.operation)
                 
     def _undo(self):
         """ย้อนกลับการแก้ไข"""
@@ -377,6 +415,7 @@ class AdjustInstrumentsDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("ปรับเครื่องดนตรี")
         self.session = parent.session
+        self.operation = None  # งานที่ไดอะล็อกหลักจะรันเมื่อกดตกลง
         self._init_ui()
         
     def _init_ui(self):
@@ -433,15 +472,11 @@ class AdjustInstrumentsDialog(QDialog):
             
         keep_elements = [item.text() for item in self.keep_elements.selectedItems()]
         
-        try:
-            self.session.adjust_instruments(
-                instruments=instruments,
-                keep_elements=keep_elements if keep_elements else None
-            )
-            self.accept()
-            
-        except Exception as e:
-            QMessageBox.critical(self, "ข้อผิดพลาด", str(e))
+        self.operation = lambda: self.session.adjust_instruments(
+            instruments=instruments,
+            keep_elements=keep_elements if keep_elements else None
+        )
+        self.accept()
 
 class AdjustMoodDialog(QDialog):
     """ไดอะล็อกสำหรับปรับอารมณ์เพลง"""
@@ -450,6 +485,7 @@ class AdjustMoodDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("ปรับอารมณ์เพลง")
         self.session = parent.session
+        self.operation = None  # งานที่ไดอะล็อกหลักจะรันเมื่อกดตกลง
         self._init_ui()
         
     def _init_ui(self):
@@ -478,11 +514,9 @@ class AdjustMoodDialog(QDialog):
         
     def _on_apply_clicked(self):
         """เรียกเมื่อกดปุ่มปรับอารมณ์"""
-        try:
-            self.session.adjust_mood(self.mood_input.currentText())
-            self.accept()
-        except Exception as e:
-            QMessageBox.critical(self, "ข้อผิดพลาด", str(e))
+        mood = self.mood_input.currentText()
+        self.operation = lambda: self.session.adjust_mood(mood)
+        self.accept()
 
 class ExtendDurationDialog(QDialog):
     """ไดอะล็อกสำหรับต่อความยาวเพลง"""
@@ -491,6 +525,7 @@ class ExtendDurationDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("ต่อความยาวเพลง")
         self.session = parent.session
+        self.operation = None  # งานที่ไดอะล็อกหลักจะรันเมื่อกดตกลง
         self._init_ui()
         
     def _init_ui(self):
@@ -531,8 +566,6 @@ class ExtendDurationDialog(QDialog):
             
     def _on_apply_clicked(self):
         """เรียกเมื่อกดปุ่มต่อความยาว"""
-        try:
-            self.session.extend_duration(self.duration_input.value())
-            self.accept()
-        except Exception as e:
-            QMessageBox.critical(self, "ข้อผิดพลาด", str(e))
+        additional_seconds = self.duration_input.value()
+        self.operation = lambda: self.session.extend_duration(additional_seconds)
+        self.accept()
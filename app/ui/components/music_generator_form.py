@@ -9,7 +9,8 @@ from PyQt6.QtGui import QFont
 
 from app.config.settings import (
     INSTRUMENT_CATEGORIES, MOODS, 
-    DURATION_PRESETS, MAX_DURATION
+    DURATION_PRESETS, MAX_DURATION,
+    QUALITY_LABELS, DEFAULT_QUALITY
 )
 from app.core.utilities import estimate_generation_time, seconds_to_time_format
 
@@ -129,6 +130,18 @@ class MusicGeneratorForm(QFrame):
         
         main_layout.addWidget(duration_group)
         
+        # ส่วนคุณภาพ (เลือกขนาดโมเดล ดู QUALITY_TIERS)
+        quality_group = QGroupBox("คุณภาพ")
+        quality_layout = QVBoxLayout(quality_group)
+        
+        self.quality_combo = QComboBox()
+        for quality, label in QUALITY_LABELS.items():
+            self.quality_combo.addItem(label, quality)
+        self.quality_combo.setCurrentIndex(max(0, self.quality_combo.findData(DEFAULT_QUALITY)))
+        quality_layout.addWidget(self.quality_combo)
+        
+        main_layout.addWidget(quality_group)
+        
         # ปุ่มสร้างเพลง
         button_layout = QHBoxLayout()
         
@@ -223,8 +236,9 @@ class MusicGeneratorForm(QFrame):
         # รวบรวมข้อมูล
         generation_params = self._collect_parameters()
         
-        # ตั้งค่าความยาวเป็น 10 วินาที
+        # ตั้งค่าความยาวเป็น 10 วินาที ด้วยโมเดลขนาดเล็กที่สุด
         generation_params['duration'] = 10
+        generation_params['quality'] = "preview"
         generation_params['is_preview'] = True
         
         # ส่งสัญญาณ
@@ -268,6 +282,7 @@ class MusicGeneratorForm(QFrame):
             'instruments': instruments,
             'mood': self.mood_combo.currentText(),
             'duration': self.duration_spin.value(),
+            'quality': self.quality_combo.currentData(),
             'is_preview': False
         }
         
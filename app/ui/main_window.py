@@ -2,7 +2,8 @@ import os
 import sys
 import time
 from pathlib import Path
-from PyQt6.QtCore import Qt, QSize, pyqtSlot, pyqtSignal
+from threading import Thread
+from PyQt6.QtCore import Qt, QSize, QTimer, pyqtSlot, pyqtSignal
 from PyQt6.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
     QLabel, QPushButton, QStatusBar, QProgressBar, 
@@ -17,7 +18,9 @@ from app.ui.components.music_generator_form import MusicGeneratorForm
 from app.ui.components.music_player import MusicPlayer
 
 # นำเข้าโมดูลหลัก
-from app.core.ai_engine import load_ai_model, generate_music
+from app.config.settings import DEFAULT_QUALITY
+from app.core.generation_queue import PRIORITY_PREVIEW, PRIORITY_NORMAL
+from app.core.generation_progress import format_progress
 from app.core.audio_utils import save_generated_audio
 from app.core.utilities import logger
 
@@ -33,6 +36,7 @@ class MainWindow(QMainWindow):
         
         # สถานะการโหลดโมเดล
         self.model_loaded = False
+        self._generation_status = ""
         
         # สร้างส่วนประกอบ UI
         self._init_ui()
@@ -40,8 +44,8 @@ class MainWindow(QMainWindow):
         # เชื่อมต่อสัญญาณ
         self._connect_signals()
         
-        # โหลดโมเดล AI
-        self._load_ai_model()
+        # โหลดโมเดล AI หลังจากหน้าต่างแสดงผลแล้ว (ไม่ให้การ import torch ทำให้หน้าต่างเปิดช้า)
+        QTimer.singleShot(0, self._load_ai_model)
         
     def _init_ui(self):
         """สร้างส่วนประกอบ UI"""
@@ -228,6 +232,10 @@ class MainWindow(QMainWindow):
         # เชื่อมต่อฟอร์มสร้างเพลงกับฟังก์ชันสร้างเพลง
         self.music_gen_form.generation_requested.connect(self._on_generation_requested)
         
+        # ความคืบหน้าและผลลัพธ์ถูกส่งมาจาก thread ของ engine จึงต้องผ่าน signal เข้า UI thread
+        self.generation_progress_signal.connect(self._on_generation_progress)
+        self.generation_completed_signal.connect(self._on_generation_completed)
+        
     def _focus_music_gen_form(self):
         """โฟกัสไปที่ฟอร์มสร้างเพลง"""
         self.music_gen_form.setFocus()
@@ -241,6 +249,10 @@ class MainWindow(QMainWindow):
     # Signal สำหรับการโหลดโมเดล
     model_loaded_signal = pyqtSignal(bool)
     
+    # Signal สำหรับความคืบหน้าและผลลัพธ์การสร้างเพลง
+    generation_progress_signal = pyqtSignal(dict)
+    generation_completed_signal = pyqtSignal(bool, object)
+    
     def _load_ai_model(self):
         """โหลดโมเดล AI"""
         # อัพเดตสถานะ
@@ -252,8 +264,16 @@ class MainWindow(QMainWindow):
         # เชื่อมต่อ signal กับ slot
         self.model_loaded_signal.connect(self._on_model_loaded)
         
-        # โหลดโมเดลโดยส่ง signal callback
-        load_ai_model(lambda success: self.model_loaded_signal.emit(success))
+        # import ai_engine (torch, transformers) และโหลดโมเดลใน thread แยก โดยส่ง signal callback
+        def _load_in_background():
+            try:
+                from app.core.ai_engine import load_ai_model
+                load_ai_model(lambda success: self.model_loaded_signal.emit(success))
+            except Exception as e:
+                logger.error(f"ไม่สามารถเริ่มโหลดโมเดลได้: {e}")
+                self.model_loaded_signal.emit(False)
+                
+        Thread(target=_load_in_background, daemon=True).start()
         
     @pyqtSlot(bool)
     def _on_model_loaded(self, success):
@@ -292,28 +312,39 @@ class MainWindow(QMainWindow):
         is_preview = params.get('is_preview', False)
         
         if is_preview:
-            self.status_label.setText(f"กำลังสร้างตัวอย่างเพลง...")
+            self._generation_status = "กำลังสร้างตัวอย่างเพลง..."
         else:
-            self.status_label.setText(f"กำลังสร้างเพลง {params['mood']} ความยาว {params['duration']} วินาที...")
+            self._generation_status = f"กำลังสร้างเพลง {params['mood']} ความยาว {params['duration']} วินาที..."
+        self.status_label.setText(self._generation_status)
             
-        # แสดง progress bar
+        # แสดง progress bar (อัพเดตตาม token ที่สร้างจริง)
         self.progress_bar.setVisible(True)
-        self.progress_bar.setValue(10)  # เริ่มต้นที่ 10%
+        self.progress_bar.setValue(0)
         
-        # เรียกฟังก์ชันสร้างเพลง
+        # เรียกฟังก์ชันสร้างเพลง (ตัวอย่างเพลงได้ทำก่อนงานยาวที่รออยู่ในคิว)
+        from app.core.ai_engine import generate_music
         generate_music(
             prompt=params['prompt'],
             duration=params['duration'],
             instruments=params['instruments'],
             mood=params['mood'],
-            callback=self._on_generation_completed
+            callback=self.generation_completed_signal.emit,
+            priority=PRIORITY_PREVIEW if is_preview else PRIORITY_NORMAL,
+            progress_callback=self.generation_progress_signal.emit,
+            quality=params.get('quality', DEFAULT_QUALITY)
         )
         
-    def _on_generation_completed(self, success, result):
-        """เรียกเมื่อสร้างเพลงเสร็จ"""
-        # อัพเดต progress bar
-        self.progress_bar.setValue(70)
+    @pyqtSlot(dict)
+    def _on_generation_progress(self, info):
+        """เรียกเมื่อ engine รายงานความคืบหน้า (เรียกใน UI thread)"""
+        if not self.progress_bar.isVisible():
+            return
+        self.progress_bar.setValue(int(info['percent']))
+        self.status_label.setText(f"{self._generation_status} {format_progress(info)}")
         
+    @pyqtSlot(bool, object)
+    def _on_generation_completed(self, success, result):
+        """เรียกเมื่อสร้างเพลงเสร็จ (เรียกใน UI thread)"""
         if not success:
             # แสดงข้อความข้อผิดพลาด
             QMessageBox.critical(
@@ -336,9 +367,6 @@ class MainWindow(QMainWindow):
         # บันทึกไฟล์
         file_path = save_generated_audio(audio_data, metadata)
         
-        # อัพเดต progress bar
-        self.progress_bar.setValue(90)
-        
         # อัพเดตรายการเพลง
         self.music_player._load_playlist()
         